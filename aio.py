@@ -0,0 +1,113 @@
+from subfish.ec2 import Ec2
+from subfish.eks import AwsEks
+from subfish.waiter import TIMEOUT
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Lock
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS=32
+# Operations that call AWS and are exposed as coroutines.
+ASYNC_PREFIXES=('create_', 'refresh_', 'delete_', 'destroy_', 'associate_', 'authorize_',
+    'modify_', 'run_', 'terminate_')
+
+_executor = None
+_executor_lock = Lock()
+
+def get_executor():
+    """Returns the worker pool shared by every async object that was not given its own."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS,
+                thread_name_prefix='subfish-aio')
+        return _executor
+
+class AsyncAws(object):
+    """
+    AsyncAws exposes a subfish object to asyncio code. Its create_*, refresh_*, delete_* and
+    similar operations are coroutines that run the blocking calls on a bounded worker pool
+    shared by every environment, and wait_for() awaits the shared WaitMux without holding a
+    thread. The operations that wait on resources run their calls on the pool and await
+    the wait in between, so a pool thread is never parked in one. Everything else,
+    including the state, is the wrapped object's.
+
+    Methods:
+    wait_for - USER; awaits resources of a type reaching a state.
+    create_vpc - USER; creates the VPC and awaits it being available.
+    create_subnet - USER; creates a subnet and awaits it being available.
+    create_nat_gateway - USER; creates a NAT gateway and awaits it being available.
+    delete_nat_gateways - USER; deletes the NAT gateways and awaits them being deleted.
+    run_instances - USER; launches instances and awaits them running.
+    terminate_instances - USER; terminates the instances and awaits them being terminated.
+    in_pool - INTERNAL; awaits a blocking call run on the worker pool.
+    staged - INTERNAL; awaits the stages of an operation split around a wait.
+    """
+
+    sync_class = None
+
+    def __init__(self, path=None, aws=None, executor=None, **kwargs):
+        logger.debug("__init__::Executing")
+        self.aws = aws if aws is not None else self.sync_class(path, **kwargs)
+        self.executor = executor or get_executor()
+
+    def __getattr__(self, name):
+        attr = getattr(self.aws, name)
+        if not callable(attr) or not name.startswith(ASYNC_PREFIXES):
+            return attr
+        async def call(*args, **kwargs):
+            logger.debug("%s::Executing", name)
+            return await self.in_pool(attr, *args, **kwargs)
+        call.__name__ = name
+        return call
+
+    async def in_pool(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def staged(self, name, *args, **kwargs):
+        logger.debug("%s::Executing", name)
+        wait = await self.in_pool(getattr(self.aws, 'start_' + name), *args, **kwargs)
+        if wait is None:
+            return None
+        found = await self.wait_for(*wait)
+        return await self.in_pool(getattr(self.aws, 'finish_' + name), wait[1], found)
+
+    def __getitem__(self, k):
+        return self.aws[k]
+
+    def __contains__(self, k):
+        return k in self.aws
+
+    async def wait_for(self, rtype, ids, state, timeout=TIMEOUT):
+        logger.debug("wait_for::%s::%s::%s", rtype, ids, state)
+        return await asyncio.wrap_future(self.aws.wait_mux.submit(rtype, ids, state, timeout))
+
+    async def create_vpc(self, cidr_block='10.0.0.0/16'):
+        return await self.staged('create_vpc', cidr_block)
+
+    async def create_subnet(self, affinity_group=0, prefix=24):
+        return await self.staged('create_subnet', affinity_group, prefix)
+
+    async def create_nat_gateway(self, affinity_group=0):
+        return await self.staged('create_nat_gateway', affinity_group)
+
+    async def delete_nat_gateways(self):
+        return await self.staged('delete_nat_gateways')
+
+    async def run_instances(self, instance_template, count=1, affinity_group=0,
+            security_groups=('bastion',)):
+        return await self.staged('run_instances', instance_template, count, affinity_group,
+            security_groups)
+
+    async def terminate_instances(self):
+        return await self.staged('terminate_instances')
+
+class AsyncEc2(AsyncAws):
+    sync_class = Ec2
+
+class AsyncEks(AsyncAws):
+    sync_class = AwsEks
@@ -1,41 +1,327 @@
 from botocore.exceptions import ClientError
-import botocore.session
-from time import sleep
-import yaml, re
+from subfish.clients import get_registry
+from subfish.state import get_store, ID_FIELDS
+from subfish.index import TagIndex, INDEXED_KEYS
+from subfish.records import to_record
+from subfish.poll import Poller
+from subfish.waiter import WaitMux, TIMEOUT
+from subfish.tracing import get_tracer
+from subfish.tagging import TagBatcher, tag_list, tag_specifications
+from contextlib import contextmanager
+from threading import RLock, Event, Thread
+import re
 import logging
 
 PATH='./.aws_dict.yml'
+FLUSH_INTERVAL=1.0
 logger = logging.getLogger(__name__)
+trace = get_tracer(__name__)
 
 class AwsBase(dict):
-    def __init__(self, path):
+    def __init__(self, path, session=None, client_config=None, store=None, poller=None,
+            flush_interval=FLUSH_INTERVAL, tags=None, projections=None, **kwargs):
         logger.debug("__init__:l:Executing")
-        self.session = botocore.session.get_session()
+        self.clients = get_registry(session, client_config)
+        self.metrics = self.clients.metrics
         self.path = path
+        self.store = store or get_store(path)
+        self.poller = poller or Poller()
+        self.wait_mux = WaitMux(self.clients, self.poller)
+        self.tags = dict(tags or {})
+        self.projections = dict(projections or {})
+        self.tag_batcher = TagBatcher(self.clients, self.poller)
+        self.lock = RLock()
+        self.tag_index = TagIndex()
+        self.dirty = set()
+        self.batch_depth = 0
+        # Items appended while a refresh is describing, which its result may not show yet.
+        self.refreshing = 0
+        self.appends = []
+        self.flush_interval = flush_interval
+        self.loaded = False
         logger.info("__init__::path::%s", self.path)
-        self.load()
+
+    @property
+    def session(self):
+        return self.clients.session
+
+    @property
+    def ec2_client(self):
+        return self.clients.get('ec2')
+
+    @property
+    def iam_client(self):
+        return self.clients.get('iam')
+
+    @property
+    def eks_client(self):
+        return self.clients.get('eks')
+
+    def wait_for(self, rtype, ids, state, timeout=TIMEOUT):
+        """
+        Blocks until every resource of a type reaches a state, sharing one describe call
+        per tick with every other pending wait. Returns the resources by id.
+        """
+        logger.debug("wait_for::%s::%s::%s", rtype, ids, state)
+        return self.wait_mux.wait(rtype, ids, state, timeout)
+
+    def staged(self, name, *args, **kwargs):
+        """
+        Runs an operation split around the wait in its middle. start_<name> makes the calls
+        before the wait and returns the wait_for() arguments, or None when there is nothing
+        to wait for; finish_<name> gets the ids and the resources waited for and returns
+        the result. AsyncAws awaits the same stages without holding a thread in the wait.
+        """
+        wait = getattr(self, 'start_' + name)(*args, **kwargs)
+        if wait is None:
+            return None
+        return getattr(self, 'finish_' + name)(wait[1], self.wait_for(*wait))
+
+    def resource_tags(self, affinity_group=None):
+        """Returns the user tags, plus affinity_group if given, as a dictionary."""
+        tags = dict(self.tags)
+        if affinity_group is not None:
+            tags['affinity_group'] = str(affinity_group)
+        return tags
+
+    def tag_on_create(self, resource_type, affinity_group=None):
+        """Returns the TagSpecifications keyword argument for a create call."""
+        return tag_specifications(resource_type, self.resource_tags(affinity_group))
+
+    def created_tags(self, data, affinity_group=None):
+        """Fills in the tags of a created resource when the response leaves them out."""
+        if not data.get('Tags'):
+            data['Tags'] = tag_list(self.resource_tags(affinity_group))
+        return data
+
+    def paginate(self, operation, result_key, service='ec2', **kwargs):
+        """
+        Yields the items of a describe/list call one page at a time, following every page
+        when the operation can be paginated.
+        """
+        client = self.clients.get(service)
+        if not client.can_paginate(operation):
+            pages = [getattr(client, operation)(**kwargs)]
+        else:
+            pages = client.get_paginator(operation).paginate(**kwargs)
+        count = 0
+        for page in pages:
+            count = count + 1
+            logger.debug("paginate::%s::page %s::%s items", operation, count,
+                len(page[result_key]))
+            yield from page[result_key]
+
+    def project(self, k, items):
+        """
+        Applies the projection registered for state key k to each item. Without one, the
+        items of keys in RECORD_TYPES are kept as compact records, whose full() hydrates
+        them through hydrate().
+        """
+        projection = self.projections.get(k)
+        for item in items:
+            yield projection(item) if projection else to_record(k, item, self.hydrate)
+
+    def hydrate(self, record):
+        """Describes the resource of a record again by id and returns its full payload."""
+        operation, id_param, result_path = record.DESCRIBE
+        rid = record[record.FIELDS[0]]
+        logger.debug("hydrate::%s::%s", operation, rid)
+        items = self.paginate(operation, result_path[0], **{id_param: [rid]})
+        for p in result_path[1:]:
+            items = (i for item in items for i in item[p])
+        for item in items:
+            return item
+        raise KeyError(rid)
+
+    def refresh_key(self, k, items):
+        """
+        Replaces state key k with the projected items and saves; returns the count. The
+        items are fetched without holding the lock, and items appended to k meanwhile are
+        kept when the fetched ones do not include them.
+        """
+        with self.lock:
+            self.refreshing = self.refreshing + 1
+            start = len(self.appends)
+        data = None
+        try:
+            data = list(self.project(k, items))
+        finally:
+            with self.lock:
+                self.refreshing = self.refreshing - 1
+                if data is not None:
+                    id_field = ID_FIELDS.get(k)
+                    ids = set(d.get(id_field) for d in data)
+                    data.extend(v for key, v in self.appends[start:] \
+                        if key == k and id_field and v.get(id_field) not in ids)
+                    self[k] = data
+                if not self.refreshing:
+                    self.appends = []
+        logger.debug("refresh_key::%s::%s items", k, len(data))
+        self.save()
+        return len(data)
+
+    def __getitem__(self, k):
+        if not self.loaded:
+            self.load()
+        return super().__getitem__(k)
+
+    def __contains__(self, k):
+        if not self.loaded:
+            self.load()
+        return super().__contains__(k)
+
+    def __iter__(self):
+        if not self.loaded:
+            self.load()
+        return super().__iter__()
+
+    def __len__(self):
+        if not self.loaded:
+            self.load()
+        return super().__len__()
+
+    def __repr__(self):
+        if not self.loaded:
+            self.load()
+        return super().__repr__()
+
+    def get(self, k, default=None):
+        if not self.loaded:
+            self.load()
+        return super().get(k, default)
+
+    def keys(self):
+        if not self.loaded:
+            self.load()
+        return super().keys()
+
+    def items(self):
+        if not self.loaded:
+            self.load()
+        return super().items()
+
+    def values(self):
+        if not self.loaded:
+            self.load()
+        return super().values()
+
+    def __setitem__(self, k, v):
+        if not self.loaded:
+            self.load()
+        with self.lock:
+            super().__setitem__(k, v)
+            self.dirty.add(k)
+            if k in INDEXED_KEYS:
+                self.tag_index.rebuild(k, v)
+
+    def __delitem__(self, k):
+        if not self.loaded:
+            self.load()
+        with self.lock:
+            super().__delitem__(k)
+            self.dirty.add(k)
+            if k in INDEXED_KEYS:
+                self.tag_index.rebuild(k, None)
+
+    def tagged(self, k, tag_key, tag_value):
+        """Returns the resources stored under k that carry the tag tag_key=tag_value."""
+        if not self.loaded:
+            self.load()
+        with self.lock:
+            return self.tag_index.get(k, tag_key, tag_value)
+
+    def tag_values(self, k, tag_key):
+        """Returns the values of tag_key across the resources stored under k."""
+        if not self.loaded:
+            self.load()
+        with self.lock:
+            return self.tag_index.values(k, tag_key)
+
+    def touch(self, k):
+        """Marks a key changed in place as needing to be saved."""
+        self.dirty.add(k)
 
     def list_append(self, k, v):
         logger.debug("list_append: Executing")
-        if k not in self:
-            self[k] = []
-        self[k].append(v)
+        v = next(self.project(k, [v]))
+        with self.lock:
+            if k not in self:
+                self[k] = []
+            self[k].append(v)
+            if self.refreshing:
+                self.appends.append((k, v))
+            self.touch(k)
+            if k in INDEXED_KEYS:
+                self.tag_index.add(k, v)
 
     def load(self):
+        """
+        Reads the state file into the dictionary. The constructor leaves this to the first
+        access to the state, so objects that never read it never parse it.
+        """
         logger.debug("load: Executing")
-        try:
-            data = yaml.load(open(self.path).read())
-            for key in data.keys(): self[key] = data[key]
-        except ( FileNotFoundError, AttributeError):
-            self = {}
+        with self.lock:
+            if self.loaded:
+                return
+            data = self.store.load()
+            for key in data.keys():
+                if isinstance(data[key], list) and not self.projections.get(key):
+                    data[key] = [to_record(key, v, self.hydrate) for v in data[key]]
+                super().__setitem__(key, data[key])
+                if key in INDEXED_KEYS:
+                    self.tag_index.rebuild(key, data[key])
+            self.loaded = True
 
     def save(self):
+        """
+        Saves the state file, unless a batch or write-behind context is active, in which case
+        the changes are written when it flushes.
+        """
         logger.debug("save: Executing")
-        f = open(self.path, 'w')
-        logger.debug("saving::%s", self)
-        yaml.safe_dump(dict(self), f, default_flow_style=False)
-
-    def sleep(self, s=1):
-        logger.debug("sleep: Executing")
-        i = .1*s
-        sleep(i)
+        if self.batch_depth == 0:
+            self.flush()
+
+    def flush(self):
+        logger.debug("flush: Executing")
+        with self.lock:
+            if not self.dirty:
+                return
+            trace("flush::write", keys=sorted(self.dirty))
+            self.store.write(self, set(self.dirty))
+            self.dirty.clear()
+
+    @contextmanager
+    def batch(self):
+        """Coalesces every save() inside the block into one flush when it exits."""
+        with self.lock:
+            self.batch_depth = self.batch_depth + 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.batch_depth = self.batch_depth - 1
+                if self.batch_depth == 0:
+                    self.flush()
+
+    @contextmanager
+    def write_behind(self, interval=None):
+        """
+        Like batch(), but also flushes pending changes every `interval` seconds from a
+        background thread while the block runs.
+        """
+        interval = interval or self.flush_interval
+        stop = Event()
+        def flusher():
+            while not stop.wait(interval):
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.error("write_behind::flush::%s", e)
+        with self.batch():
+            thread = Thread(target=flusher, daemon=True)
+            thread.start()
+            try:
+                yield self
+            finally:
+                stop.set()
+                thread.join()
@@ -0,0 +1,205 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+from copy import deepcopy
+from functools import partial
+from threading import Lock
+from time import monotonic
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL=5
+MAX_ENTRIES=512
+# Operations whose answers rarely change get a longer TTL.
+OPERATION_TTLS = {
+    'describe_availability_zones': 3600,
+    'describe_regions': 3600,
+    'describe_account_attributes': 3600}
+# Operations whose answers no mutation made by subfish can change.
+STATIC_OPERATIONS=frozenset(OPERATION_TTLS)
+READ_PREFIXES=('describe_', 'list_')
+# Operations that neither read through the cache nor invalidate it.
+PASSTHROUGH_PREFIXES=('get_', 'can_', 'generate_')
+# Mutations whose effects are visible on every resource type.
+GLOBAL_RESOURCES=('tag',)
+
+def resource_of(operation):
+    """Returns the singular resource name of an operation, e.g. describe_subnets -> subnet."""
+    noun = operation.split('_', 1)[-1]
+    if noun.endswith('ies'):
+        return noun[:-3] + 'y'
+    if noun.endswith('sses'):
+        return noun[:-2]
+    if noun.endswith('s'):
+        return noun[:-1]
+    return noun
+
+class ResponseCache(object):
+    """
+    ResponseCache memoizes read-only API responses with a per-operation TTL and LRU
+    eviction, and drops the entries of a resource type when it is mutated. Concurrent
+    misses of the same read share one call, unless a mutation finished since it started.
+
+    Methods:
+    lookup - INTERNAL; returns a fresh cached response or None.
+    fetch - INTERNAL; makes a read call, or joins the same call already in flight.
+    land - INTERNAL; forgets a read call that finished.
+    store - INTERNAL; caches a response.
+    invalidate - INTERNAL; drops the entries related to a mutated resource.
+    stats - USER; returns hit and miss counts per operation.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, default_ttl=DEFAULT_TTL, ttls=None):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.ttls = dict(OPERATION_TTLS, **(ttls or {}))
+        self.entries = OrderedDict()
+        self.hits = {}
+        self.misses = {}
+        self.generation = 0
+        # Key -> (future, generation) of the read calls in flight.
+        self.flights = {}
+        self.lock = Lock()
+
+    def key(self, service, operation, kwargs):
+        return (service, operation, json.dumps(kwargs, sort_keys=True, default=str))
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > monotonic():
+                self.entries.move_to_end(key)
+                self.hits[key[1]] = self.hits.get(key[1], 0) + 1
+                return deepcopy(entry[1])
+            if entry is not None:
+                del(self.entries[key])
+            self.misses[key[1]] = self.misses.get(key[1], 0) + 1
+
+    def fetch(self, key, call):
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None and (flight[1] == self.generation \
+                    or key[1] in STATIC_OPERATIONS):
+                future, leader = flight[0], False
+            else:
+                future, leader = Future(), True
+                generation = self.generation
+                self.flights[key] = (future, generation)
+        if not leader:
+            logger.debug("fetch::Joining::%s", key[1])
+            return deepcopy(future.result())
+        try:
+            response = call()
+        except Exception as e:
+            self.land(key, future)
+            future.set_exception(e)
+            raise
+        # Stored before it lands, so no caller in between misses both.
+        self.store(key, response, generation)
+        self.land(key, future)
+        future.set_result(deepcopy(response))
+        return response
+
+    def land(self, key, future):
+        with self.lock:
+            if self.flights.get(key, (None,))[0] is future:
+                del(self.flights[key])
+
+    def store(self, key, response, generation):
+        ttl = self.ttls.get(key[1], self.default_ttl)
+        with self.lock:
+            # A mutation finished while the call was in flight, so the response may be stale.
+            if generation != self.generation and key[1] not in STATIC_OPERATIONS:
+                return
+            self.entries[key] = (monotonic() + ttl, deepcopy(response))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, service, operation):
+        mutated = resource_of(operation)
+        with self.lock:
+            stale = [k for k in self.entries if k[0] == service \
+                and k[1] not in STATIC_OPERATIONS and (
+                mutated in GLOBAL_RESOURCES or mutated in resource_of(k[1]) \
+                or resource_of(k[1]) in mutated)]
+            for k in stale:
+                del(self.entries[k])
+            self.generation = self.generation + 1
+        logger.debug("invalidate::%s::%s::%s entries", service, operation, len(stale))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': dict(self.hits),
+                'misses': dict(self.misses),
+                'hit_count': sum(self.hits.values()),
+                'miss_count': sum(self.misses.values())}
+
+class CachingPaginator(object):
+    """
+    CachingPaginator wraps a botocore paginator for a read operation. Results that fit in a
+    single page are cached like any other read; longer results are streamed uncached so
+    memory stays bounded by the page size.
+    """
+
+    def __init__(self, paginator, cache, service, operation):
+        self.paginator = paginator
+        self.cache = cache
+        self.service = service
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        key = self.cache.key(self.service, self.operation, dict(kwargs, Paginated=True))
+        page = self.cache.lookup(key)
+        if page is not None:
+            yield page
+            return
+        generation = self.cache.generation
+        pages = 0
+        for page in self.paginator.paginate(**kwargs):
+            pages = pages + 1
+            if pages == 1:
+                first = page
+            yield page
+        if pages == 1:
+            self.cache.store(key, first, generation)
+
+class CachingClient(object):
+    """
+    CachingClient wraps a botocore client, answering describe_*/list_* calls from a
+    ResponseCache and invalidating it on successful mutating calls. Paginators of read
+    operations cache single-page results. Anything else, including waiters, goes straight
+    to the wrapped client.
+    """
+
+    def __init__(self, client, cache):
+        self.client = client
+        self.cache = cache
+        self.service = client.meta.service_model.service_name
+
+    def get_paginator(self, operation):
+        paginator = self.client.get_paginator(operation)
+        if not operation.startswith(READ_PREFIXES):
+            return paginator
+        return CachingPaginator(paginator, self.cache, self.service, operation)
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name not in self.client.meta.method_to_api_mapping \
+                or name.startswith(PASSTHROUGH_PREFIXES):
+            return attr
+        if name.startswith(READ_PREFIXES):
+            def read(**kwargs):
+                key = self.cache.key(self.service, name, kwargs)
+                res = self.cache.lookup(key)
+                if res is None:
+                    res = self.cache.fetch(key, partial(attr, **kwargs))
+                return res
+            return read
+        def mutate(**kwargs):
+            res = attr(**kwargs)
+            self.cache.invalidate(self.service, name)
+            return res
+        return mutate
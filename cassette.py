@@ -0,0 +1,385 @@
+from base64 import b64encode, b64decode
+from collections import deque
+from copy import deepcopy
+from datetime import datetime
+from threading import Condition, Lock
+from time import monotonic, sleep
+import gzip
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+CASSETTE_VERSION=1
+# Parameters that differ on every run and are left out when matching requests.
+IGNORED_PARAMS=frozenset(('ClientToken',))
+# Operations that read state; they are served their last recording once used up.
+READ_PREFIXES=('Describe', 'List', 'Get')
+# Seconds a replayed call waits for the mutations recorded before it to be replayed.
+PATIENCE=1.0
+
+class CassetteError(Exception):
+    """Raised when a replayed request has no recorded response."""
+
+def _default(o):
+    if isinstance(o, datetime):
+        return {'$datetime': o.isoformat()}
+    if isinstance(o, (bytes, bytearray)):
+        return {'$bytes': b64encode(o).decode('ascii')}
+    raise TypeError("Cannot serialize {}".format(type(o)))
+
+def _object_hook(o):
+    if len(o) == 1 and '$datetime' in o:
+        return datetime.fromisoformat(o['$datetime'])
+    if len(o) == 1 and '$bytes' in o:
+        return b64decode(o['$bytes'])
+    return o
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode)
+
+def request_key(service, operation, params):
+    """Returns the key a request is matched on: its operation and canonical parameters."""
+    params = dict((k, v) for k, v in (params or {}).items() if k not in IGNORED_PARAMS)
+    return (service, operation, json.dumps(params, default=_default, sort_keys=True,
+        separators=(',', ':')))
+
+def request_shape(service, operation, params):
+    """
+    Returns the key requests of the same operation on the same parameters and filters
+    share, whatever their values, such as waiter polls on different ids.
+    """
+    params = params or {}
+    names = sorted(k for k in params if k not in IGNORED_PARAMS)
+    filters = sorted(str(f.get('Name')) for f in params.get('Filters') or [])
+    return (service, operation, json.dumps([names, filters]))
+
+def request_values(params):
+    """
+    Returns the values a request asks about, as a set of (parameter, value) pairs with
+    one pair per filter value or list item, so a request can be tested for asking about
+    a subset of what another one did.
+    """
+    values = set()
+    for k, v in (params or {}).items():
+        if k in IGNORED_PARAMS:
+            continue
+        if k == 'Filters':
+            values.update((f.get('Name'), str(x)) for f in v for x in f.get('Values', []))
+        elif isinstance(v, list):
+            values.update((k, json.dumps(x, default=_default, sort_keys=True)) for x in v)
+        else:
+            values.add((k, json.dumps(v, default=_default, sort_keys=True)))
+    return values
+
+def save_cassette(path, interactions):
+    """Writes interactions to a cassette file, gzipped if the path ends in .gz."""
+    logger.debug("save_cassette::%s::%s interactions", path, len(interactions))
+    with _open(path, 'w') as f:
+        json.dump({'version': CASSETTE_VERSION, 'interactions': interactions}, f,
+            default=_default, separators=(',', ':'))
+
+def load_cassette(path):
+    """Returns the interactions stored in a cassette file."""
+    logger.debug("load_cassette::%s", path)
+    with _open(path, 'r') as f:
+        cassette = json.load(f, object_hook=_object_hook)
+    if cassette.get('version') != CASSETTE_VERSION:
+        raise CassetteError("Unsupported cassette version {}".format(cassette.get('version')))
+    return cassette['interactions']
+
+def profile(interactions):
+    """
+    Returns the number of calls and the total latency of each operation in a list of
+    interactions, keyed by 'service.Operation'.
+    """
+    ops = {}
+    for i in interactions:
+        op = ops.setdefault("{}.{}".format(i['service'], i['operation']),
+            {'calls': 0, 'errors': 0, 'seconds': 0.0})
+        op['calls'] += 1
+        op['errors'] += 1 if i['status'] >= 300 else 0
+        op['seconds'] += i['elapsed']
+    return dict(sorted(ops.items()))
+
+def compare_profiles(before, after):
+    """
+    Returns the operations whose call count or error count differs between two profiles,
+    as a dictionary of operation to (before, after) profile entries.
+    """
+    empty = {'calls': 0, 'errors': 0, 'seconds': 0.0}
+    changes = {}
+    for op in sorted(set(before) | set(after)):
+        b, a = before.get(op, empty), after.get(op, empty)
+        if (b['calls'], b['errors']) != (a['calls'], a['errors']):
+            changes[op] = (b, a)
+    return changes
+
+class ReplayResponse(object):
+    """The parts of a botocore HTTP response that after-call handlers look at."""
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+        self.content = b''
+
+class Recorder(object):
+    """
+    Recorder captures every call made by the botocore clients it instruments, through
+    their event hooks: the operation, its parameters, the parsed response or error, when
+    it started and how long it took. Errors are recorded as the parsed error response,
+    so replaying them raises the same ClientError.
+
+    Methods:
+    instrument - INTERNAL; registers the event hooks on a client.
+    save - USER; writes the recorded interactions to a cassette file.
+    profile - USER; returns the calls and latency recorded per operation.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.interactions = []
+        self.start = monotonic()
+        self.lock = Lock()
+
+    def instrument(self, client):
+        events = client.meta.events
+        logger.debug("instrument::%s", client.meta.service_model.service_name)
+        events.register('before-parameter-build', self.before_parameter_build,
+            unique_id='subfish-recorder-params')
+        events.register('after-call', self.after_call, unique_id='subfish-recorder-after')
+        events.register('after-call-error', self.after_call_error,
+            unique_id='subfish-recorder-error')
+        return client
+
+    def before_parameter_build(self, params=None, context=None, **kwargs):
+        if context is not None:
+            context['subfish_recorder'] = (deepcopy(params), monotonic())
+
+    def add(self, model, context, status, response):
+        call = (context or {}).pop('subfish_recorder', None)
+        if call is None:
+            return
+        params, start = call
+        interaction = {'service': model.service_model.service_name,
+            'operation': model.name, 'params': params, 'status': status,
+            'response': deepcopy(response), 'start': round(start - self.start, 6),
+            'elapsed': round(monotonic() - start, 6)}
+        with self.lock:
+            self.interactions.append(interaction)
+
+    def after_call(self, http_response=None, parsed=None, model=None, context=None, **kwargs):
+        self.add(model, context, http_response.status_code, parsed)
+
+    def after_call_error(self, exception=None, model=None, context=None, **kwargs):
+        # Connection errors never got a response; replay them as a server error.
+        self.add(model, context, 599, {'Error': {'Code': type(exception).__name__,
+            'Message': str(exception)}})
+
+    def save(self, path=None):
+        with self.lock:
+            interactions = sorted(self.interactions, key=lambda i: i['start'])
+        save_cassette(path or self.path, interactions)
+
+    def profile(self):
+        with self.lock:
+            return profile(self.interactions)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.path:
+            self.save()
+
+class Player(object):
+    """
+    Player answers the calls of the botocore clients it instruments from recorded
+    interactions, before anything is sent. Requests are matched on their operation and
+    parameters, ignoring IGNORED_PARAMS. A mutation is served the first unused matching
+    recording, or else one of the same shape (request_shape), or else of the same
+    operation.
+
+    Calls replay in the order they were recorded, whatever thread makes them: a call
+    served recording n waits until every mutation recorded before n has been served, so
+    its response reflects the same mutations it did when it was recorded and a replay
+    makes the same calls every time. A mutation no call asks for within patience seconds
+    is skipped, so a version that stopped making a call still replays, only more slowly.
+
+    A read is served the latest unused matching recording made before the first mutation
+    not yet replayed, so it sees the state the replay has reached and not beyond, or else
+    the next unused one. Reads that used up their matches, such as extra polls, are served
+    the last one again. Reads with other parameters, such as waiter polls batched
+    differently, are served a recording of the same shape that asked about every value
+    they ask about, before falling back to any recording of the operation.
+
+    With speed=None responses come back at once; otherwise each call is answered when it
+    was on the recorded timeline scaled by 1/speed, or at once if the replay is running
+    behind it, so speed=1 plays back the original timing.
+
+    Requests with no recording raise CassetteError, or go out to AWS if strict is False.
+
+    Methods:
+    instrument - INTERNAL; registers the event hooks on a client.
+    profile - USER; returns the calls and latency served per operation.
+    unused - USER; returns the recordings that were never served.
+    """
+
+    def __init__(self, interactions, speed=None, strict=True, patience=PATIENCE):
+        if isinstance(interactions, str):
+            interactions = load_cassette(interactions)
+        self.interactions = interactions
+        self.speed = speed
+        self.strict = strict
+        self.patience = patience
+        # Request key, shape and operation -> unused recordings, and every recording.
+        self.unused_by = {}
+        self.recorded = {}
+        self.reads = set()
+        self.values = []
+        for n, i in enumerate(interactions):
+            for key in self.keys(i['service'], i['operation'], i['params']):
+                self.unused_by.setdefault(key, deque()).append(n)
+                self.recorded.setdefault(key, []).append(n)
+            self.values.append(request_values(i['params']))
+            if i['operation'].startswith(READ_PREFIXES):
+                self.reads.add(n)
+        self.used = set()
+        self.skipped = set()
+        # Every mutation recorded before the frontier has been served or skipped.
+        self.frontier = 0
+        self.served = []
+        self.misses = 0
+        # When the recording started on the replay's clock, once a call was served.
+        self.began = None
+        self.lock = Lock()
+        self.replayed = Condition(self.lock)
+
+    @staticmethod
+    def keys(service, operation, params):
+        return (('exact',) + request_key(service, operation, params),
+            ('shape',) + request_shape(service, operation, params),
+            ('operation', service, operation))
+
+    def instrument(self, client):
+        events = client.meta.events
+        logger.debug("instrument::%s", client.meta.service_model.service_name)
+        events.register('before-parameter-build', self.before_parameter_build,
+            unique_id='subfish-player-params')
+        # Last, so handlers such as Metrics see the call before it is answered.
+        events.register_last('before-call', self.before_call,
+            unique_id='subfish-player-before')
+        return client
+
+    def before_parameter_build(self, params=None, context=None, **kwargs):
+        if context is not None:
+            context['subfish_player'] = deepcopy(params)
+
+    def next_unused(self, key, values=None):
+        candidates = self.unused_by.get(key, ())
+        while candidates and candidates[0] in self.used:
+            candidates.popleft()
+        for n in candidates:
+            if n not in self.used and (values is None or values <= self.values[n]):
+                candidates.remove(n)
+                self.used.add(n)
+                return n
+        return None
+
+    def latest_unused(self, key):
+        # Older unused recordings of the key are left behind as stale.
+        candidates = self.unused_by.get(key, ())
+        latest = None
+        for n in candidates:
+            if n >= self.frontier:
+                break
+            if n not in self.used:
+                latest = n
+        if latest is not None:
+            candidates.remove(latest)
+            self.used.add(latest)
+        return latest
+
+    def last_served(self, key, values=None):
+        for n in reversed(self.recorded.get(key, ())):
+            if n in self.used and (values is None or values <= self.values[n]):
+                return n
+        return None
+
+    def choose(self, service, operation, params):
+        exact, shape, by_operation = self.keys(service, operation, params)
+        if not operation.startswith(READ_PREFIXES):
+            order = ((self.next_unused, exact), (self.next_unused, shape),
+                (self.next_unused, by_operation))
+        else:
+            values = request_values(params)
+            order = ((self.latest_unused, exact), (self.next_unused, exact),
+                (self.next_unused, shape, values),
+                (self.last_served, exact), (self.last_served, shape, values),
+                (self.next_unused, shape), (self.next_unused, by_operation),
+                (self.last_served, by_operation))
+        for find, *args in order:
+            n = find(*args)
+            if n is not None:
+                return n
+        return None
+
+    def advance(self):
+        while self.frontier in self.reads or self.frontier in self.used \
+                or self.frontier in self.skipped:
+            self.frontier += 1
+
+    def wait_turn(self, n):
+        deadline = monotonic() + self.patience
+        self.advance()
+        while self.frontier < n:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                logger.debug("wait_turn::Skipping::%s", self.frontier)
+                self.skipped.add(self.frontier)
+                self.advance()
+                deadline = monotonic() + self.patience
+                continue
+            self.replayed.wait(remaining)
+            self.advance()
+        self.replayed.notify_all()
+
+    def match(self, service, operation, params):
+        with self.lock:
+            self.advance()
+            n = self.choose(service, operation, params)
+            if n is None:
+                self.misses += 1
+                return None
+            self.wait_turn(n)
+            interaction = self.interactions[n]
+            self.served.append(interaction)
+            return interaction
+
+    def before_call(self, model=None, context=None, **kwargs):
+        service, operation = model.service_model.service_name, model.name
+        params = (context or {}).pop('subfish_player', None)
+        interaction = self.match(service, operation, params)
+        if interaction is None:
+            if self.strict:
+                raise CassetteError("No recording of {}.{} {}".format(service, operation,
+                    params))
+            logger.warning("before_call::Not recorded::%s.%s", service, operation)
+            return None
+        if self.speed:
+            with self.lock:
+                if self.began is None:
+                    self.began = monotonic() - interaction['start'] / self.speed
+            end = interaction['start'] + interaction['elapsed']
+            sleep(max(self.began + end / self.speed - monotonic(), 0))
+        return ReplayResponse(interaction['status']), deepcopy(interaction['response'])
+
+    def profile(self):
+        with self.lock:
+            return profile(self.served)
+
+    def unused(self):
+        with self.lock:
+            return [i for n, i in enumerate(self.interactions) if n not in self.used]
@@ -0,0 +1,108 @@
+from threading import Lock
+from time import monotonic
+from weakref import WeakKeyDictionary
+import logging
+
+logger = logging.getLogger(__name__)
+
+CATALOG_TTL=300
+# A missing name lists again only if the index is older than this.
+MISS_TTL=5
+
+_catalogs = WeakKeyDictionary()
+_catalogs_lock = Lock()
+
+def get_catalog(clients, ttl=CATALOG_TTL):
+    """Returns the IamCatalog shared by every object using the same client registry."""
+    with _catalogs_lock:
+        if clients not in _catalogs:
+            _catalogs[clients] = IamCatalog(clients, ttl)
+        return _catalogs[clients]
+
+class IamCatalog(object):
+    """
+    IamCatalog pages through every IAM role and policy once and indexes them by name and
+    ARN. Each index is listed again when it is older than the TTL, or when a name is
+    missing and the index is older than MISS_TTL.
+
+    Methods:
+    role - USER; returns a role by name, or None.
+    policy - USER; returns a policy by name or ARN, or None.
+    policy_arns - USER; resolves many policy names or ARNs to ARNs at once.
+    add_role - INTERNAL; records a role created through subfish.
+    remove_role - INTERNAL; forgets a role deleted through subfish.
+    invalidate - USER; forces the next lookup to list again.
+    """
+
+    def __init__(self, clients, ttl=CATALOG_TTL):
+        self.clients = clients
+        self.ttl = ttl
+        self.indexes = {}
+        self.loaded = {}
+        self.lock = Lock()
+
+    def list_all(self, operation, result_key):
+        logger.debug("list_all::%s", operation)
+        paginator = self.clients.get('iam', cached=False).get_paginator(operation)
+        items = []
+        for page in paginator.paginate():
+            items.extend(page[result_key])
+        logger.debug("list_all::%s::%s items", operation, len(items))
+        return items
+
+    def age(self, kind):
+        with self.lock:
+            if kind not in self.loaded:
+                return None
+            return monotonic() - self.loaded[kind]
+
+    def index(self, kind, max_age=None):
+        # Roles and policies are indexed under both their name and their ARN.
+        age = self.age(kind)
+        if age is not None and age < (self.ttl if max_age is None else max_age):
+            with self.lock:
+                return self.indexes[kind]
+        operation, result_key, name_key = {
+            'roles': ('list_roles', 'Roles', 'RoleName'),
+            'policies': ('list_policies', 'Policies', 'PolicyName')}[kind]
+        index = {}
+        for item in self.list_all(operation, result_key):
+            index.setdefault(item[name_key], item)
+            index[item['Arn']] = item
+        with self.lock:
+            self.indexes[kind] = index
+            self.loaded[kind] = monotonic()
+        return index
+
+    def lookup(self, kind, keys):
+        index = self.index(kind)
+        if [k for k in keys if k not in index]:
+            index = self.index(kind, max_age=MISS_TTL)
+        return dict((k, index.get(k)) for k in keys)
+
+    def role(self, role_name):
+        return self.lookup('roles', [role_name])[role_name]
+
+    def policy(self, policy):
+        return self.lookup('policies', [policy])[policy]
+
+    def policy_arns(self, policies):
+        """Returns a dictionary of policy name or ARN to ARN, or None if there is none."""
+        found = self.lookup('policies', list(policies))
+        return dict((k, p['Arn'] if p else None) for k, p in found.items())
+
+    def add_role(self, role):
+        with self.lock:
+            if 'roles' in self.indexes:
+                self.indexes['roles'][role['RoleName']] = role
+                self.indexes['roles'][role['Arn']] = role
+
+    def remove_role(self, role_name):
+        with self.lock:
+            role = self.indexes.get('roles', {}).pop(role_name, None)
+            if role:
+                self.indexes['roles'].pop(role['Arn'], None)
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded.clear()
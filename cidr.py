@@ -0,0 +1,131 @@
+from bisect import bisect_left, insort
+from ipaddress import ip_network
+import logging
+
+logger = logging.getLogger(__name__)
+
+class CidrAllocator(object):
+    """
+    CidrAllocator is a buddy allocator over the address space of a CIDR block. Free space is
+    kept as sorted lists of aligned block addresses, one list per prefix length, so the lowest
+    free block of any size is found with one lookup per prefix length.
+
+    Methods:
+    allocate - USER; allocates the lowest free block with a given prefix length.
+    allocate_many - USER; allocates several blocks with a given prefix length.
+    reserve - USER; marks a given block as allocated, if it is free.
+    release - USER; returns an allocated block to the free space.
+    to_dict - INTERNAL; returns the allocator in a form that can be stored in the state.
+    from_dict - INTERNAL; rebuilds an allocator from its stored form.
+    """
+
+    def __init__(self, cidr_block):
+        network = ip_network(cidr_block)
+        self.cidr_block = str(network)
+        self.version = network.version
+        self.bits = network.max_prefixlen
+        self.prefix = network.prefixlen
+        self.base = int(network.network_address)
+        self.free = {self.prefix: [0]}
+        self.allocated = {}
+
+    def size(self, prefix):
+        return 1 << (self.bits - prefix)
+
+    def to_cidr(self, offset, prefix):
+        return str(ip_network((self.base + offset, prefix)))
+
+    def from_cidr(self, cidr_block):
+        network = ip_network(cidr_block)
+        offset = int(network.network_address) - self.base
+        if network.version != self.version or network.prefixlen < self.prefix \
+                or offset < 0 or offset >= self.size(self.prefix):
+            raise ValueError("{} is not within {}".format(cidr_block, self.cidr_block))
+        return offset, network.prefixlen
+
+    def take(self, prefix, offset):
+        blocks = self.free[prefix]
+        del(blocks[bisect_left(blocks, offset)])
+        if not blocks:
+            del(self.free[prefix])
+
+    def put(self, prefix, offset):
+        insort(self.free.setdefault(prefix, []), offset)
+
+    def has(self, prefix, offset):
+        blocks = self.free.get(prefix, ())
+        i = bisect_left(blocks, offset)
+        return i < len(blocks) and blocks[i] == offset
+
+    def split(self, prefix, offset, target_prefix, target_offset):
+        # Split the free block down to the target, returning the unused halves.
+        while prefix < target_prefix:
+            prefix = prefix + 1
+            half = self.size(prefix)
+            if target_offset >= offset + half:
+                self.put(prefix, offset)
+                offset = offset + half
+            else:
+                self.put(prefix, offset + half)
+
+    def allocate(self, prefix=24):
+        logger.debug("allocate::%s::/%s", self.cidr_block, prefix)
+        if prefix < self.prefix or prefix > self.bits:
+            raise ValueError("Cannot allocate a /{} from {}".format(prefix, self.cidr_block))
+        candidates = [(blocks[0], p) for p, blocks in self.free.items() if p <= prefix]
+        if not candidates:
+            raise ValueError("No free /{} left in {}".format(prefix, self.cidr_block))
+        offset, p = min(candidates)
+        self.take(p, offset)
+        self.split(p, offset, prefix, offset)
+        self.allocated[offset] = prefix
+        cidr_block = self.to_cidr(offset, prefix)
+        logger.debug("allocate::Returning::%s", cidr_block)
+        return cidr_block
+
+    def allocate_many(self, count, prefix=24):
+        return [self.allocate(prefix) for i in range(count)]
+
+    def reserve(self, cidr_block):
+        logger.debug("reserve::%s", cidr_block)
+        offset, prefix = self.from_cidr(cidr_block)
+        for p in range(prefix, self.prefix - 1, -1):
+            start = offset & ~(self.size(p) - 1)
+            if self.has(p, start):
+                self.take(p, start)
+                self.split(p, start, prefix, offset)
+                self.allocated[offset] = prefix
+                return True
+        return False
+
+    def release(self, cidr_block):
+        logger.debug("release::%s", cidr_block)
+        offset, prefix = self.from_cidr(cidr_block)
+        if self.allocated.get(offset) != prefix:
+            return False
+        del(self.allocated[offset])
+        while prefix > self.prefix:
+            buddy = offset ^ self.size(prefix)
+            if not self.has(prefix, buddy):
+                break
+            self.take(prefix, buddy)
+            offset = min(offset, buddy)
+            prefix = prefix - 1
+        self.put(prefix, offset)
+        return True
+
+    def is_allocated(self, cidr_block):
+        offset, prefix = self.from_cidr(cidr_block)
+        return self.allocated.get(offset) == prefix
+
+    def to_dict(self):
+        return {
+            'CidrBlock': self.cidr_block,
+            'Allocated': [self.to_cidr(o, p) for o, p in sorted(self.allocated.items())]}
+
+    @classmethod
+    def from_dict(cls, data):
+        allocator = cls(data['CidrBlock'])
+        for cidr_block in data.get('Allocated', []):
+            allocator.reserve(cidr_block)
+        return allocator
@@ -0,0 +1,115 @@
+from subfish.cache import ResponseCache, CachingClient
+from subfish.metrics import Metrics
+from threading import Lock
+from weakref import WeakKeyDictionary
+import logging
+
+logger = logging.getLogger(__name__)
+
+CLIENT_CONFIG = {
+    'max_pool_connections': 32,
+    'tcp_keepalive': True,
+    'retries': {'mode': 'adaptive', 'max_attempts': 10}}
+
+class ClientRegistry(object):
+    """
+    ClientRegistry builds each botocore service client of a session once, on first use,
+    so every object sharing the session also shares its clients and their connection pools.
+
+    Clients are wrapped in a CachingClient sharing one ResponseCache, unless cache is False,
+    and instrumented by one Metrics object, unless metrics is False.
+
+    botocore is only imported when the first client is created. Without a session, a
+    default botocore session is also created then, so a process that only reads the state
+    never loads botocore.session.
+
+    Methods:
+    get - USER; returns the client for a service, creating it if needed. Polling loops
+          pass cached=False to read around the response cache.
+    instrument - USER; hooks an observer into every client, created now or later.
+    """
+
+    def __init__(self, session=None, config=None, cache=True, metrics=True):
+        logger.debug("__init__::Executing")
+        self._session = session
+        self._config = config
+        if cache is True:
+            cache = ResponseCache()
+        self.cache = cache or None
+        if metrics is True:
+            metrics = Metrics()
+        self.metrics = metrics or None
+        self.clients = {}
+        self.observers = []
+        self.lock = Lock()
+
+    @property
+    def session(self):
+        if self._session is None:
+            import botocore.session
+            self._session = botocore.session.get_session()
+        return self._session
+
+    @property
+    def config(self):
+        if self._config is None or isinstance(self._config, dict):
+            from botocore.config import Config
+            self._config = Config(**dict(CLIENT_CONFIG, **(self._config or {})))
+        return self._config
+
+    def get(self, service, cached=True):
+        client = self.create(service)
+        if not cached and isinstance(client, CachingClient):
+            return client.client
+        return client
+
+    def create(self, service):
+        try:
+            return self.clients[service]
+        except KeyError:
+            with self.lock:
+                if service not in self.clients:
+                    logger.debug("get::create_client::%s", service)
+                    client = self.session.create_client(service, config=self.config)
+                    if self.metrics is not None:
+                        self.metrics.instrument(client)
+                    for observer in self.observers:
+                        observer.instrument(client)
+                    if self.cache is not None:
+                        client = CachingClient(client, self.cache)
+                    self.clients[service] = client
+            return self.clients[service]
+
+    def instrument(self, observer):
+        """
+        Calls observer.instrument(client) on every client of the registry, such as a
+        cassette Recorder or Player, and on every client it creates from now on.
+        """
+        logger.debug("instrument::%s", type(observer).__name__)
+        with self.lock:
+            self.observers.append(observer)
+            clients = list(self.clients.values())
+        for client in clients:
+            observer.instrument(client.client if isinstance(client, CachingClient) \
+                else client)
+        return observer
+
+_registries = WeakKeyDictionary()
+_registries_lock = Lock()
+
+def get_registry(session, config=None):
+    """
+    Returns the ClientRegistry of a session. The config only applies when the registry is
+    created by this call. Without a session, returns a new registry that creates its own
+    default session on first use.
+    """
+    if session is None:
+        return ClientRegistry(None, config)
+    with _registries_lock:
+        try:
+            registry = _registries[session]
+            if config is not None:
+                logger.warning("get_registry::Registry exists, ignoring config")
+        except KeyError:
+            registry = _registries[session] = ClientRegistry(session, config)
+    return registry
@@ -1,6 +1,24 @@
-from subfish.ec2.vpc import AwsVpc
-from subfish.ec2.secgroup import AwsSG
-from subfish.ec2.compute import AwsCompute
-from subfish.ec2.gateways import AwsGW
+from importlib import import_module
 
-class Ec2(AwsVpc, AwsSG, AwsCompute, AwsGW): pass
+# Class -> module defining it. Each module is imported on first use of its class, so
+# importing subfish.ec2 is cheap until a class is needed.
+CLASSES = {
+    'AwsVpc': 'subfish.ec2.vpc',
+    'AwsSG': 'subfish.ec2.secgroup',
+    'AwsCompute': 'subfish.ec2.compute',
+    'AwsGW': 'subfish.ec2.gateways'}
+
+__all__ = ['Ec2'] + list(CLASSES)
+
+def __getattr__(name):
+    if name in CLASSES:
+        value = getattr(import_module(CLASSES[name]), name)
+    elif name == 'Ec2':
+        value = type('Ec2', tuple(__getattr__(c) for c in CLASSES), {})
+    else:
+        raise AttributeError("module {} has no attribute {}".format(__name__, name))
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
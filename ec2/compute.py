@@ -1,14 +1,18 @@
 from subfish.base import AwsBase
+from subfish.templates import get_template_store
+from subfish.taskgraph import parallel_map
+from subfish.tracing import get_tracer
 
-from os import listdir, remove
-import re, json
+from os import remove
+import re
 from uuid import uuid1
-from jinja2 import Template
+from heapq import heapify, heappop, heappush
 import logging
 
 from botocore.exceptions import ClientError, WaiterError
 
 logger = logging.getLogger(__name__)
+trace = get_tracer(__name__)
 
 RELATIVE_LAUNCH_TEMPLATES="launch_templates"
 RELATIVE_SG_AUTHORIZATIONS="sg_authorizations"
@@ -16,14 +20,14 @@ RELATIVE_USER_DATA="user_data"
 
 class AwsCompute(AwsBase):
 
-    def __init__(self, path, config_path="."):
+    def __init__(self, path, config_path=".", **kwargs):
         logger.info("__init__::Executing")
-        super().__init__(path)
-        self.ec2_client = self.session.create_client('ec2')
+        super().__init__(path, config_path=config_path, **kwargs)
         self.launch_templates_path = "{}/{}".format(config_path,RELATIVE_LAUNCH_TEMPLATES)
-        logger.debug("__init__::launch_templates_path::{}".format(self.launch_templates_path))
+        logger.debug("__init__::launch_templates_path::%s", self.launch_templates_path)
+        self.launch_template_store = get_template_store(self.launch_templates_path)
         self.user_data_path = "{}/{}".format(config_path,RELATIVE_USER_DATA)
-        logger.debug("__init__::user_data_path::{}".format(self.user_data_path))
+        logger.debug("__init__::user_data_path::%s", self.user_data_path)
 
     def create_launch_template(self, launch_template_name, jinja2_vars={}):
         logger.info("create_launch_template::Executing")
@@ -35,47 +39,37 @@ class AwsCompute(AwsBase):
                 key_material = res['KeyMaterial']
                 f = open("./.instance_key-{}".format(key_name), 'w')
                 f.write(key_material)
-                jinja2_vars['key_name'] = key_name
+                jinja2_vars = dict(jinja2_vars, key_name=key_name)
             except ClientError as c:
                 print(c)
-            regex = re.compile(r'\.json\.j2')
-            f = open("{}/{}.json.j2".format(self.launch_templates_path, launch_template_name))
-            data = f.read()
             res = self.ec2_client.create_launch_template(
                 ClientToken = idemp_token,
                 LaunchTemplateName = launch_template_name,
                 VersionDescription = launch_template_name,
-                LaunchTemplateData=json.loads(Template(data).render(jinja2_vars)))
+                LaunchTemplateData=self.launch_template_store.render_json(
+                    "{}.json.j2".format(launch_template_name), jinja2_vars),
+                **self.tag_on_create('launch-template'))
             meta = res['ResponseMetadata']
             data = res['LaunchTemplate']
-            logger.debug(
-                "create_launch_template::create_launch_template::meta::{}".format(meta))
-            logger.debug(
-                "create_launch_template::create_launch_template::data::{}".format(data))
+            trace("create_launch_template::create_launch_template", meta=meta, data=data)
             self.refresh_launch_templates()
         except ClientError as c:
             if c.response['Error']['Code'] == 'InvalidLaunchTemplateName.AlreadyExistsException':
-                logger.warning(
-                    "create_launch_template::ClientError::{}".format(
-                        c.response['Error']['Message']))
+                logger.warning("create_launch_template::ClientError::%s",
+                    c.response['Error']['Message'])
 
     def modify_launch_template(self, launch_template_name, jinja2_vars={}):
         logger.debug("create_launch_template::Executing")
         idemp_token = str(uuid1())
-        regex = re.compile(r'\.json\.j2')
-        f = open("{}/{}.json.j2".format(self.launch_templates, launch_template_name))
-        data = f.read()
         res = self.ec2_client.create_launch_template_version(
             ClientToken = idemp_token,
             LaunchTemplateName = launch_template_name,
             VersionDescription = launch_template_name,
-            LaunchTemplateData=json.loads(Template(data).render(jinja2_vars)))
+            LaunchTemplateData=self.launch_template_store.render_json(
+                "{}.json.j2".format(launch_template_name), jinja2_vars))
         meta = res['ResponseMetadata']
         data = res['LaunchTemplateVersion']
-        logger.debug(
-            "modify_launch_template::create_launch_template_version::meta::{}".format(meta))
-        logger.debug(
-            "modify_launch_template::create_launch_template_version::data::{}".format(data))
+        trace("modify_launch_template::create_launch_template_version", meta=meta, data=data)
         idemp_token2 = str(uuid1())
         res = self.ec2_client.modify_launch_template(
             ClientToken = idemp_token2,
@@ -83,31 +77,22 @@ class AwsCompute(AwsBase):
             DefaultVersion = str(data['VersionNumber']))
         meta = res['ResponseMetadata']
         data = res['LaunchTemplate']
-        logger.debug(
-            "modify_launch_template::modify_launch_template::meta::{}".format(meta))
-        logger.debug(
-            "modify_launch_template::modify_launch_template::data::{}".format(data))
+        trace("modify_launch_template::modify_launch_template", meta=meta, data=data)
         self.refresh_launch_templates()
 
     def refresh_launch_templates(self):
         logger.debug("refresh_launch_templates::Executing")
         regex = re.compile(r'(\w+)\.json(\.j2)*')
         lts = []
-        for f in listdir(self.launch_templates_path):
+        for f in self.launch_template_store.names():
             r = regex.search(f)
             if r:
                 lts.append(r.group(1))
-        logger.debug("refresh_launch_templates::launch_templates::{}".format(lts))
-        res = self.ec2_client.describe_launch_templates(Filters=[
-            {'Name': 'launch-template-name', 'Values': lts}])
-        meta = res['ResponseMetadata']
-        data = res['LaunchTemplates']
-        logger.debug(
-            "refresh_launch_templates::describe_launch_templates::meta::{}".format(meta))
-        logger.debug(
-            "refresh_launch_templates::describe_launch_templates::data::{}".format(data))
-        self['LaunchTemplates'] = data
-        self.save()
+        logger.debug("refresh_launch_templates::launch_templates::%s", lts)
+        count = self.refresh_key('LaunchTemplates', self.paginate(
+            'describe_launch_templates', 'LaunchTemplates', Filters=[
+                {'Name': 'launch-template-name', 'Values': lts}]))
+        logger.debug("refresh_launch_templates::describe_launch_templates::%s", count)
 
     def delete_launch_templates(self):
         logger.info("delete_launch_templates::Executing")
@@ -121,14 +106,13 @@ class AwsCompute(AwsBase):
                     remove("./.instance_key-{}".format(key_name))
                 except ClientError as c:
                     print(c)
+                except FileNotFoundError:
+                    logger.warning("delete_launch_templates::No key file::%s", key_name)
                 res = self.ec2_client.delete_launch_template(
                     LaunchTemplateId=lt['LaunchTemplateId'])
                 meta = res['ResponseMetadata']
                 data = res['LaunchTemplate']
-                logger.info(
-                    "delete_launch_templates::delete_launch_template::{}".format(meta))
-                logger.info(
-                    "delete_launch_templates::delete_launch_template::{}".format(data))
+                trace("delete_launch_templates::delete_launch_template", meta=meta, data=data)
             del(self['LaunchTemplates'])
             self.save()
         except KeyError as k:
@@ -136,65 +120,129 @@ class AwsCompute(AwsBase):
 
     def run_instance(self, instance_template, affinity_group=0):
         logger.info("run_instance::Executing")
-        vpc_id = self['Vpc']['VpcId']
-        subnet_ids = [s['SubnetId'] for s in self['Subnets'] for t in s['Tags'] \
-            if t['Key'] == 'affinity_group' and t['Value'] == str(affinity_group)]
-        sg_ids = next(g['GroupId'] for g in self['SecurityGroups'] if g['GroupName'] == 'bastion')
-        res = self.ec2_client.describe_instances(Filters=[
-            {'Name': 'subnet-id', 'Values': subnet_ids}])
-        meta = res['ResponseMetadata']
-        data = res['Reservations']
-        logger.debug("run_instances::describe_instances::meta::%s", meta)
-        logger.debug("run_instances::describe_instances::data::%s", data)
-        res = self.ec2_client.run_instances(LaunchTemplate={
-            'LaunchTemplateName': instance_template},
-            SecurityGroupIds=[sg_ids],
-            SubnetId=subnet_ids[0],
-            MinCount=1,
-            MaxCount=1)
-        meta = res['ResponseMetadata']
-        data = res['Instances']
-        logger.debug("run_instances::run_instances::meta::%s", meta)
-        logger.debug("run_instances::run_instances::data::{}", data)
-        inst_id = [i['InstanceId'] for i in data]
-        logger.info("run_instances::waiting for instance")
-        waiter = self.ec2_client.get_waiter('instance_exists')
-        waiter.wait(InstanceIds=inst_id)
-        waiter = self.ec2_client.get_waiter('instance_running')
-        waiter.wait(InstanceIds=inst_id)
-        self.refresh_instances()
+        return self.run_instances(instance_template, 1, affinity_group)
+
+    def spread_instances(self, count, affinity_group=0):
+        """
+        Returns a dictionary of subnet id to the number of instances to launch there, so that
+        the affinity group's subnets, one per AZ, end up with as even a number of running
+        instances as possible.
+        """
+        subnet_ids = sorted(s['SubnetId'] for s in \
+            self.tagged('Subnets', 'affinity_group', affinity_group))
+        if not subnet_ids:
+            raise KeyError("No subnets in affinity group {}".format(affinity_group))
+        running = dict((s, 0) for s in subnet_ids)
+        for i in self.get('Instances', []):
+            if i.get('SubnetId') in running \
+                    and i.get('State', {}).get('Name') not in ('shutting-down', 'terminated'):
+                running[i['SubnetId']] = running[i['SubnetId']] + 1
+        heap = [(n, s) for s, n in running.items()]
+        heapify(heap)
+        spread = {}
+        for n in range(count):
+            load, subnet_id = heappop(heap)
+            spread[subnet_id] = spread.get(subnet_id, 0) + 1
+            heappush(heap, (load + 1, subnet_id))
+        logger.debug("spread_instances::Returning::%s", spread)
+        return spread
+
+    def run_instances(self, instance_template, count=1, affinity_group=0,
+            security_groups=('bastion',)):
+        """
+        Launches count instances from a launch template, spread evenly over the subnets of
+        an affinity group with one run_instances call per subnet. Waits for all of them at
+        once and merges them into the state. Returns the new instance ids.
+        """
+        logger.info("run_instances::Executing::%s", count)
+        return self.staged('run_instances', instance_template, count, affinity_group,
+            security_groups)
+
+    def start_run_instances(self, instance_template, count=1, affinity_group=0,
+            security_groups=('bastion',)):
+        logger.debug("start_run_instances::Executing")
+        groups = dict((g['GroupName'], g['GroupId']) for g in self.get('SecurityGroups', []) \
+            if g['GroupName'] in security_groups)
+        missing = sorted(set(security_groups) - set(groups))
+        if missing:
+            raise KeyError("Unknown security groups {}".format(missing))
+        sg_ids = list(groups.values())
+        def launch(placement):
+            subnet_id, n = placement
+            try:
+                res = self.ec2_client.run_instances(LaunchTemplate={
+                    'LaunchTemplateName': instance_template},
+                    SecurityGroupIds=sg_ids,
+                    SubnetId=subnet_id,
+                    MinCount=n,
+                    MaxCount=n,
+                    **self.tag_on_create('instance', affinity_group))
+            except Exception as e:
+                logger.error("run_instances::run_instances::%s::%s", subnet_id, e)
+                return [], e
+            meta = res['ResponseMetadata']
+            trace("run_instances::run_instances", meta=meta)
+            return res['Instances'], None
+        launched = parallel_map(launch,
+            sorted(self.spread_instances(count, affinity_group).items()))
+        errors = [e for instances, e in launched if e is not None]
+        if errors:
+            # Instances launched in the other subnets are kept, so a teardown terminates
+            # them before deleting their subnets.
+            self.merge_instances([i for instances, e in launched for i in instances])
+            raise errors[0]
+        inst_id = [i['InstanceId'] for instances, e in launched for i in instances]
+        logger.info("run_instances::waiting for %s instances", len(inst_id))
+        return ('instance', inst_id, 'running')
+
+    def finish_run_instances(self, inst_id, found):
+        logger.debug("finish_run_instances::Executing")
+        self.merge_instances([found[i] for i in inst_id])
+        return inst_id
+
+    def merge_instances(self, instances):
+        """Replaces or adds instance payloads in the state, by instance id, and saves."""
+        logger.debug("merge_instances::%s", len(instances))
+        with self.lock:
+            new = dict((i['InstanceId'], i) for i in instances)
+            kept = [i for i in self.get('Instances', []) if i['InstanceId'] not in new]
+            self['Instances'] = kept + list(self.project('Instances', new.values()))
+            self.save()
 
     def refresh_instances(self):
         logger.debug("refresh_instances::Executing")
         vpc_id = self['Vpc']['VpcId']
-        res = self.ec2_client.describe_instances(Filters=[
+        reservations = self.paginate('describe_instances', 'Reservations', Filters=[
             {'Name': 'vpc-id', 'Values': [vpc_id]}])
-        meta = res['ResponseMetadata']
-        data = res['Reservations'][0]
-        logger.debug("refresh_instances::run_instances::meta::%s", meta)
-        logger.debug("refresh_instances::run_instances::data::%s", data)
-        self['Instances'] = data['Instances']
-        self.save()
+        count = self.refresh_key('Instances',
+            (i for r in reservations for i in r['Instances']))
+        logger.debug("refresh_instances::describe_instances::%s", count)
 
     def terminate_instances(self):
         logger.info("terminate_instances::Executing")
+        return self.staged('terminate_instances')
+
+    def start_terminate_instances(self):
+        logger.debug("start_terminate_instances::Executing")
         inst_id = [i['InstanceId'] for i in self['Instances']]
         res = self.ec2_client.terminate_instances(InstanceIds=inst_id)
         meta = res['ResponseMetadata']
         data = res['TerminatingInstances']
-        logger.debug("terminate_instances::terminate_instances::meta::%s", meta)
-        logger.debug("terminate_instances::terminate_instances::data::{}", data)
-        waiter = self.ec2_client.get_waiter('instance_terminated')
+        trace("terminate_instances::terminate_instances", meta=meta, data=data)
         logger.info("terminate_instances::waiter::%s", inst_id)
-        waiter.wait(InstanceIds=inst_id)
+        return ('instance', inst_id, 'terminated')
+
+    def finish_terminate_instances(self, inst_id, found):
+        logger.debug("finish_terminate_instances::Executing")
+        del(self['Instances'])
         self.save()
 
 
     def create_autoscaling_group(self, instance_template, affinity_group=0):
         logger.info("create_autoscaling_group::Executing")
         vpc_id = self['Vpc']['VpcId']
-        azs = [s['AvailabilityZone'] for s in self['Subnets'] for t in s['Tags']\
-            if t['Key'] == 'affinity_group' and t['Value'] == str(affinity_group)]
+        azs = [s['AvailabilityZone'] for s in \
+            self.tagged('Subnets', 'affinity_group', affinity_group)]
         res = self.ec2_client.create_auto_scaling_group(
             AutoScalingGroupName=instance_template,
             LaunchTemplate={
@@ -204,13 +252,12 @@ class AwsCompute(AwsBase):
             MaxSize=2,
             DesiredCapacity=2,
             AvailabilityZones=azs)
-        meta = res
-        logger.info("create_autoscaling_group::create_autoscaling_group::%s", meta)
+        meta = res['ResponseMetadata']
+        trace("create_autoscaling_group::create_autoscaling_group", meta=meta)
         res = self.ec2_client.describe_auto_scaling_group(Filters=[
             {'Name': 'vpc-id', 'Values': [vpc_id]}])
         meta = res['ResponseMetadata']
         data = res['AvailabilityZones']
-        logger.info("create_autoscaling_group::describe_auto_scaling_group::%s", meta)
-        logger.info("create_autoscaling_group::describe_auto_scaling_group::%s", data)
+        trace("create_autoscaling_group::describe_auto_scaling_group", meta=meta, data=data)
         self['AvailabilityZones'] = data
         self.save()
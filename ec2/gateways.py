@@ -1,56 +1,40 @@
 from subfish.base import AwsBase
+from subfish.taskgraph import parallel_map
+from subfish.tracing import get_tracer
 
 import re, json
 import logging
-from ipaddress import ip_network
-from jinja2 import Template
 from botocore.exceptions import ClientError, WaiterError
 
 logger = logging.getLogger(__name__)
+trace = get_tracer(__name__)
 
 class AwsGW(AwsBase):
 
     def __init__(self, path, **kwargs):
-        super().__init__(path=path)
+        super().__init__(path=path, **kwargs)
         logger.debug("__init__::Executing")
-        self.ec2_client = self.session.create_client('ec2')
 
     def create_internet_gateway(self, affinity_group=0):
         logger.info("create_internet_gateway::Executing")
         try:
             vpc_id = self['Vpc']['VpcId']
-            res = self.ec2_client.create_internet_gateway()
+            res = self.ec2_client.create_internet_gateway(
+                **self.tag_on_create('internet-gateway', affinity_group))
             meta = res['ResponseMetadata']
             data = res['InternetGateway']
             igw_id = data['InternetGatewayId']
-            logger.debug(
-                "create_internet_gateway::create_internet_gateway::meta::{}".format(meta))
-            logger.debug(
-                "create_internet_gateway::create_internet_gateway::data::{}".format(data))
+            trace("create_internet_gateway::create_internet_gateway", meta=meta, data=data)
             rt_id = self.get_af_rt(affinity_group)
             res = self.ec2_client.attach_internet_gateway(InternetGatewayId=igw_id, VpcId=vpc_id)
             meta = res['ResponseMetadata']
-            logger.debug(
-                "create_internet_gateway::attach_internet_gateway::meta::{}".format(meta))
+            trace("create_internet_gateway::attach_internet_gateway", meta=meta)
             meta = self.ec2_client.create_route(
                 DestinationCidrBlock='0.0.0.0/0',
                 GatewayId=igw_id,
                 RouteTableId=rt_id)
-            logger.debug("create_internet_gateway::create_route::meta::{}".format(meta))
-            for s in self['Subnets']:
-                for t in s['Tags']:
-                    if t['Key'] == 'affinity_group' and t['Value'] == str(affinity_group):
-                        res = self.ec2_client.modify_subnet_attribute(
-                            MapPublicIpOnLaunch={'Value': True},
-                            SubnetId=s['SubnetId'])
-                        meta = res['ResponseMetadata']
-                        logger.debug(
-                            "create_internet_gateway::attach_internet_gateway::meta::%s", meta)
-            res = self.ec2_client.create_tags(
-                Resources=[igw_id],
-                Tags=[{'Key': 'affinity_group', 'Value': str(affinity_group)}])
-            meta = res['ResponseMetadata']
-            logger.debug("create_internet_gateway::create_tags::meta::%s", meta)
+            trace("create_internet_gateway::create_route", meta=meta)
+            self.map_public_ip_on_launch(affinity_group)
             self.refresh_route_tables()
             self.refresh_internet_gateway()
         except KeyError as k:
@@ -60,28 +44,37 @@ class AwsGW(AwsBase):
                 raise
         except ClientError as c:
             if c.response['Error']['Code'] == 'InvalidParameterValue':
-                logger.error("create_internet_gateway::ClientError::{}".format(c.message))
+                logger.error("create_internet_gateway::ClientError::%s", c.message)
             else:
                 raise
 
+    def map_public_ip_on_launch(self, affinity_group=0):
+        logger.debug("map_public_ip_on_launch::Executing")
+        subnets = [s['SubnetId'] for s in \
+            self.tagged('Subnets', 'affinity_group', affinity_group) \
+            if not s.get('MapPublicIpOnLaunch')]
+        for subnet_id in subnets:
+            res = self.ec2_client.modify_subnet_attribute(
+                MapPublicIpOnLaunch={'Value': True},
+                SubnetId=subnet_id)
+            meta = res['ResponseMetadata']
+            trace("map_public_ip_on_launch::modify_subnet_attribute", meta=meta)
+        if subnets:
+            self.refresh_subnets()
+
     def refresh_internet_gateway(self):
         try:
             logger.debug("refresh_internet_gateway::Executing")
             vpc_id = self['Vpc']['VpcId']
-            res = self.ec2_client.describe_internet_gateways(Filters=[
-                {'Name': 'attachment.vpc-id', 'Values': [vpc_id]}])
-            meta = res['ResponseMetadata']
-            data = res['InternetGateways']
-            logger.debug(
-                "refresh_internet_gateway::describe_internet_gateways::meta::{}".format(meta))
-            logger.debug(
-                "refresh_internet_gateway::describe_internet_gateways::data::{}".format(data))
-            self['InternetGateway'] = data[0]
+            igws = self.project('InternetGateway', self.paginate(
+                'describe_internet_gateways', 'InternetGateways', Filters=[
+                    {'Name': 'attachment.vpc-id', 'Values': [vpc_id]}]))
+            self['InternetGateway'] = next(igws)
             self.save()
         except KeyError as k:
-            logger.error("refresh_internet_gateway::KeyError:{}".format(k.args[0]))
-        except IndexError:
-            logger.warning("refresh_internet_gateway::IndexError")
+            logger.error("refresh_internet_gateway::KeyError:%s", k.args[0])
+        except StopIteration:
+            logger.warning("refresh_internet_gateway::NoInternetGateway")
 
     def delete_internet_gateway(self):
         logger.info("delete_internet_gateway::Executing")
@@ -90,126 +83,122 @@ class AwsGW(AwsBase):
             igw_id = self['InternetGateway']['InternetGatewayId']
             res = self.ec2_client.detach_internet_gateway(InternetGatewayId=igw_id, VpcId=vpc_id)
             meta = res['ResponseMetadata']
-            logger.debug(
-                "delete_internet_gateway::delete_internet_gateways::meta::{}".format(meta))
-            self.sleep()
-            res = self.ec2_client.delete_internet_gateway(InternetGatewayId=igw_id)
+            trace("delete_internet_gateway::delete_internet_gateways", meta=meta)
+            res = self.poller.retry('delete_internet_gateway',
+                self.ec2_client.delete_internet_gateway,
+                InternetGatewayId=igw_id,
+                retry_on=('DependencyViolation',))
             meta = res['ResponseMetadata']
-            logger.debug(
-                "delete_internet_gateway::delete_internet_gateways::meta::{}".format(meta))
+            trace("delete_internet_gateway::delete_internet_gateways", meta=meta)
             del(self['InternetGateway'])
             self.save()
         except KeyError as k:
-            logger.debug("delete_internet_gateways::KeyError::{}".format(k.args[0]))
+            logger.debug("delete_internet_gateways::KeyError::%s", k.args[0])
             return 0
 
 
     def create_nat_gateway(self, affinity_group=0):
         logger.info("create_nat_gateway::Executing")
+        return self.staged('create_nat_gateway', affinity_group)
+
+    def start_create_nat_gateway(self, affinity_group=0):
+        logger.debug("start_create_nat_gateway::Executing")
         self.refresh_internet_gateway()
         if 'InternetGateway' not in self:
             raise Exception("No Internet Gateway")
-        data = self.ec2_client.allocate_address(Domain='vpc')
+        data = self.ec2_client.allocate_address(Domain='vpc',
+            **self.tag_on_create('elastic-ip', affinity_group))
         eipalloc_id = data['AllocationId']
-        logger.debug("create_nat_gateway::create_nat_gateway::data::{}".format(data))
+        trace("create_nat_gateway::create_nat_gateway", data=data)
         subnet_id = self.get_af_subnets(affinity_group)[0]
         res = self.ec2_client.create_nat_gateway(
             AllocationId=eipalloc_id,
-            SubnetId=subnet_id)
+            SubnetId=subnet_id,
+            **self.tag_on_create('natgateway', affinity_group))
         meta = res['ResponseMetadata']
         data = res['NatGateway']
-        logger.debug("create_nat_gateway::create_nat_gateway::meta::{}".format(meta))
-        logger.debug("create_nat_gateway::create_nat_gateway::data::{}".format(data))
+        trace("create_nat_gateway::create_nat_gateway", meta=meta, data=data)
         ngw_id = data['NatGatewayId']
-        self.sleep()
-        logger.info("create_nat_gateway::waiter::{}".format(ngw_id))
-        waiter = self.ec2_client.get_waiter('nat_gateway_available')
-        waiter.wait(NatGatewayIds=[ngw_id])
-        res = self.ec2_client.create_tags(
-            Resources=[ngw_id],
-            Tags=[{'Key': 'affinity_group', 'Value': str(affinity_group)}])
-        meta = res['ResponseMetadata']
-        logger.debug("create_nat_gateway::create_tags::meta::{}".format(meta))
+        logger.info("create_nat_gateway::waiter::%s", ngw_id)
+        return ('nat_gateway', [ngw_id], 'available', 900)
+
+    def finish_create_nat_gateway(self, ids, found):
+        logger.debug("finish_create_nat_gateway::Executing")
         self.refresh_nat_gateways()
 
     def create_nat_default_route(self, rt_affinity_group, nat_affinity_group=0):
         logger.debug("create_nat_default_route::Executing")
         ngw_id = self.get_af_ngw(nat_affinity_group)
         rt_id = self.get_af_rt(rt_affinity_group)
-        while True:
+        def create_route():
             try:
                 res = self.ec2_client.create_route(
                     DestinationCidrBlock='0.0.0.0/0',
                     NatGatewayId=ngw_id,
                     RouteTableId=rt_id)
                 meta = res['ResponseMetadata']
-                logger.debug(
-                   "create_nat_default_route::create_route::meta::{}".format(meta))
-                break
+                trace("create_nat_default_route::create_route", meta=meta)
             except ClientError as c:
-                logger.warning(
-                    "create_nat_default_route::ClientError::{}".format(
-                        c.response['Error']['Message']))
-                if c.response['Error']['Code'] == 'RouteAlreadyExists':
-                    res = self.ec2_client.delete_route(
-                        DestinationCidrBlock='0.0.0.0/0',
-                        RouteTableId=rt_id)
-                    meta = res['ResponseMetadata']
-                    logger.debug(
-                        "create_nat_default_route::delete_route::meta::{}".format(meta))
-                    continue
+                if c.response['Error']['Code'] != 'RouteAlreadyExists':
+                    raise
+                logger.warning("create_nat_default_route::ClientError::%s",
+                    c.response['Error']['Message'])
+                res = self.ec2_client.replace_route(
+                    DestinationCidrBlock='0.0.0.0/0',
+                    NatGatewayId=ngw_id,
+                    RouteTableId=rt_id)
+                meta = res['ResponseMetadata']
+                trace("create_nat_default_route::replace_route", meta=meta)
+        self.poller.retry('create_nat_default_route', create_route,
+            retry_on=('InvalidNatGatewayID.NotFound', 'InvalidRouteTableID.NotFound'))
         self.refresh_route_tables()
-        self.sleep()
 
     def refresh_nat_gateways(self):
         logger.debug("refresh_nat_gateways::Executing")
         vpc_id = self['Vpc']['VpcId']
-        res = self.ec2_client.describe_nat_gateways(Filters=[
+        ngws = self.paginate('describe_nat_gateways', 'NatGateways', Filters=[
             {'Name': 'vpc-id', 'Values': [vpc_id]},
             {'Name': 'state', 'Values': ['pending', 'available']}])
-        meta = res['ResponseMetadata']
-        data = res['NatGateways']
-        logger.debug("refresh_nat_gateway::describe_nat_gateways::meta::{}".format(meta))
-        logger.debug("refresh_nat_gateway::describe_nat_gateways::data::{}".format(data))
-        self['NatGateways'] = data
-        self.save()
+        count = self.refresh_key('NatGateways', ngws)
+        logger.debug("refresh_nat_gateway::describe_nat_gateways::%s", count)
 
     def delete_nat_gateways(self):
         logger.info("delete_nat_gateway::Executing")
+        return self.staged('delete_nat_gateways')
+
+    def start_delete_nat_gateways(self):
+        logger.debug("start_delete_nat_gateways::Executing")
         try:
-            eipalloc_ids = []
-            for n in self['NatGateways']:
-                ngw_id = n['NatGatewayId']
-                for a in n['NatGatewayAddresses']:
-                    eipalloc_ids.append(a['AllocationId'])
-                res = self.ec2_client.delete_nat_gateway(NatGatewayId=ngw_id)
-                meta = res['ResponseMetadata']
-                logger.debug(
-                    "delete_nat_gateway::delete_nat_gateway::meta::{}".format(meta))
-                logger.info("delete_nat_gateway::waiter::{}".format(ngw_id))
-                #Create a waiter
-                while self.ec2_client.describe_nat_gateways(NatGatewayIds=[ngw_id])\
-                    ['NatGateways'][0]['State'] != 'deleted': self.sleep(5)
-                for rt in self['RouteTables']:
-                    for r in rt['Routes']:
-                        try:
-                            logger.debug("Route: {}".format(r))
-                            if r['NatGatewayId'] == ngw_id:
-                                res = self.ec2_client.delete_route(
-                                    DestinationCidrBlock='0.0.0.0/0',
-                                    RouteTableId=rt['RouteTableId'])
-                                meta = res['ResponseMetadata']
-                                logger.debug(
-                                    "delete_nat_gateway::delete_route::meta::{}".format(meta))
-                                break
-                        except KeyError as k:
-                            logger.debug("delete_nat_gateway::KeyError::{}".format(k.args[0]))
-                            continue
-            for a in eipalloc_ids:
-                res = self.ec2_client.release_address(AllocationId=a)
-                meta = res['ResponseMetadata']
-                logger.debug("delete_nat_gateway::release_address::meta::{}".format(meta))
-            del(self['NatGateways'])
-            self.save()
+            ngw_ids = [n['NatGatewayId'] for n in self['NatGateways']]
         except KeyError as k:
-            logger.debug("delete_nat_gateway::KeyError::{}".format(k.args[0]))
+            logger.debug("delete_nat_gateway::KeyError::%s", k.args[0])
+            return None
+        def delete_nat_gateway(ngw_id):
+            res = self.ec2_client.delete_nat_gateway(NatGatewayId=ngw_id)
+            meta = res['ResponseMetadata']
+            trace("delete_nat_gateway::delete_nat_gateway", meta=meta)
+        parallel_map(delete_nat_gateway, ngw_ids)
+        logger.info("delete_nat_gateway::waiter::%s", ngw_ids)
+        return ('nat_gateway', ngw_ids, 'deleted', 900)
+
+    def finish_delete_nat_gateways(self, ngw_ids, found):
+        logger.debug("finish_delete_nat_gateways::Executing")
+        eipalloc_ids = [a['AllocationId'] for n in self['NatGateways'] \
+            for a in n['NatGatewayAddresses']]
+        routes = [(rt['RouteTableId'], r['DestinationCidrBlock']) \
+            for rt in self.get('RouteTables', []) for r in rt['Routes'] \
+            if r.get('NatGatewayId') in ngw_ids]
+        def delete_route(route):
+            res = self.ec2_client.delete_route(
+                DestinationCidrBlock=route[1],
+                RouteTableId=route[0])
+            meta = res['ResponseMetadata']
+            trace("delete_nat_gateway::delete_route", route=route, meta=meta)
+        parallel_map(delete_route, routes)
+        def release_address(eipalloc_id):
+            res = self.ec2_client.release_address(AllocationId=eipalloc_id)
+            meta = res['ResponseMetadata']
+            trace("delete_nat_gateway::release_address", meta=meta)
+        parallel_map(release_address, eipalloc_ids)
+        del(self['NatGateways'])
+        self.save()
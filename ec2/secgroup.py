@@ -1,27 +1,34 @@
 from subfish.base import AwsBase
+from subfish.taskgraph import parallel_map
+from subfish.tracing import get_tracer
+from subfish.templates import get_template_store
+from subfish.permissions import diff_permissions, referencing
 
 import logging
-from os import listdir
-import re, json
+import re
 from uuid import uuid1
-from jinja2 import Template
 
 from botocore.exceptions import ClientError, WaiterError
 
 RELATIVE_LAUNCH_TEMPLATES="launch_templates"
 RELATIVE_SG_AUTHORIZATIONS="sg_authorizations"
 RELATIVE_USER_DATA="user_data"
+# Rule template suffix -> state field holding the rules of that direction.
+DIRECTIONS=(('ingress', 'IpPermissions'), ('egress', 'IpPermissionsEgress'))
+# Errors that mean the stored rules no longer match the group.
+STALE_CODES=('InvalidPermission.Duplicate', 'InvalidPermission.NotFound')
 
 logger = logging.getLogger(__name__)
+trace = get_tracer(__name__)
 
 class AwsSG(AwsBase):
 
-    def __init__(self, path, config_path):
+    def __init__(self, path, config_path=".", **kwargs):
         logger.info("__init__::Executing")
-        super().__init__(path)
-        self.ec2_client = self.session.create_client('ec2')
+        super().__init__(path, config_path=config_path, **kwargs)
         self.sg_authorization_path = "{}/{}".format(config_path,RELATIVE_SG_AUTHORIZATIONS)
-        logger.debug("__init__::sg_authorization_path::{}".format(self.sg_authorization_path))
+        logger.debug("__init__::sg_authorization_path::%s", self.sg_authorization_path)
+        self.sg_authorization_store = get_template_store(self.sg_authorization_path)
 
     def create_security_group(self, sg_name):
         logger.info("create_security_group::Executing")
@@ -30,13 +37,11 @@ class AwsSG(AwsBase):
             res = self.ec2_client.create_security_group(
                 Description=sg_name,
                 GroupName=sg_name,
-                VpcId=vpc_id)
+                VpcId=vpc_id,
+                **self.tag_on_create('security-group'))
             data = res
             group_id = res
-            logger.debug(
-                "create_security_group::create_security_group::data::{}".format(data))
-            self.refresh_security_groups()
-            self.sleep()
+            trace("create_security_group::create_security_group", data=data)
         except ClientError as c:
             if c.response['Error']['Code'] == 'InvalidGroup.Duplicate':
                 pass
@@ -47,70 +52,124 @@ class AwsSG(AwsBase):
     def refresh_security_groups(self):
         logger.debug("refresh_security_group::Executing")
         vpc_id = self['Vpc']['VpcId']
-        res = self.ec2_client.describe_security_groups(
+        sgs = self.paginate('describe_security_groups', 'SecurityGroups',
             Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])
-        meta = res['ResponseMetadata']
-        data = res['SecurityGroups']
-        logger.debug(
-            "refresh_security_groups::describe_security_groups::meta::{}".format(meta))
-        logger.debug(
-            "refresh_security_groups::describe_security_groups::data::{}".format(data))
-        self['SecurityGroups'] = [s for s in data if s['GroupName'] != 'default']
-        self.save()
+        count = self.refresh_key('SecurityGroups',
+            (s for s in sgs if s['GroupName'] != 'default'))
+        logger.debug("refresh_security_groups::describe_security_groups::%s", count)
+
+    def security_group_vars(self):
+        """Returns a <group name>_sg_id template variable for every stored security group."""
+        return dict(("{}_sg_id".format(sg['GroupName']), sg['GroupId']) \
+            for sg in self.get('SecurityGroups', []))
+
+    def render_security_group_rules(self, sg_name, jinja2_vars={}):
+        """
+        Renders the rule templates of a security group and returns them as IpPermissions by
+        state field, for the directions that have a template.
+        """
+        jinja2_vars = dict(self.security_group_vars(), **jinja2_vars)
+        rules = {}
+        for direction, field in DIRECTIONS:
+            template = "{}_{}.json.j2".format(sg_name, direction)
+            if self.sg_authorization_store.has(template):
+                rules[field] = self.sg_authorization_store.render_json(template, jinja2_vars)
+        return rules
 
     def authorize_security_group_policies(self, sg_name, jinja2_vars={}):
         logger.debug("authorize_security_group_policies::Executing")
-        sg_id = next(sg['GroupId'] for sg in self['SecurityGroups'] \
-            if sg['GroupName'] == sg_name)
-        if "{}_ingress.json.j2".format(sg_name) in listdir(self.sg_authorization_path):
-            f = open("{}/{}_ingress.json.j2".format(self.sg_authorization_path, sg_name))
-            data = f.read()
-            res = self.ec2_client.authorize_security_group_ingress(
-                GroupId=sg_id,
-                IpPermissions=json.loads(Template(data).render(jinja2_vars)))
-            meta = res['ResponseMetadata']
-            logger.debug(
-                "authorize_security_group_policies::authorize_security_group_ingresss::meta::{}".format(meta))
-        if "{}_egress.json.j2".format(sg_name) in listdir(self.sg_authorization_path):
-            f = open("{}/{}_egress.json.j2".format(self.sg_authorization_path, sg_name))
-            data = f.read()
-            res = self.ec2_client.authorize_security_group_egress(
-                GroupId=sg_id,
-                IpPermissions=json.loads(Template(data).render(jinja2_vars)))
-            meta = res['ResponseMetadata']
-            logger.debug(
-                "authorize_security_group_policies::authorize_security_group_egresss::meta::{}".format(meta))
-        self.refresh_security_groups()
+        return self.sync_security_group_rules({sg_name: jinja2_vars})
 
-    def delete_security_groups(self):
-        logger.info("delete_security_group::Executing")
+    def sync_security_group_rules(self, groups):
+        """
+        Brings the rules of security groups in line with their templates; groups is a
+        dictionary of group name to template variables. The rendered rules are diffed
+        against the stored ones, so re-runs authorize nothing, and rules dropped from a
+        template are revoked. Each group takes at most one authorize and one revoke call
+        per direction, and groups are synced concurrently. Directions without a template
+        are left as they are. Returns the number of calls made.
+        """
+        logger.debug("sync_security_group_rules::%s", sorted(groups))
+        sgs = dict((sg['GroupName'], sg) for sg in self.get('SecurityGroups', []))
+        missing = [name for name in groups if name not in sgs]
+        if missing:
+            raise KeyError("Unknown security groups {}".format(missing))
+        changes = [(sgs[name], self.render_security_group_rules(name, jinja2_vars)) \
+            for name, jinja2_vars in groups.items()]
+        def sync(change):
+            sg, rules = change
+            return sum(self.sync_permissions(sg, direction, rules[field], sg.get(field)) \
+                for direction, field in DIRECTIONS if field in rules)
+        calls = sum(parallel_map(sync, changes))
+        if calls:
+            self.refresh_security_groups()
+        return calls
+
+    def sync_permissions(self, sg, direction, desired, live, retry=True):
+        """
+        Authorizes and revokes the difference between the desired and live permissions of
+        one direction of a security group. When the stored rules turn out to be stale, the
+        group is described again and the difference applied once more. Returns the number
+        of calls made.
+        """
+        add, remove = diff_permissions(desired, live)
+        calls = 0
         try:
-            for sg in [s for s in self['SecurityGroups'] if s['GroupName'] != 'default']:
-                if sg['IpPermissions']:
-                    res = self.ec2_client.revoke_security_group_ingress(
-                        GroupId=sg['GroupId'],
-                        IpPermissions=sg['IpPermissions'])
-                    meta = res['ResponseMetadata']
-                    logger.debug(
-                        "delete_security_groups::revoke_security_group_ingresss::meta::{}".format(meta))
-                if sg['IpPermissionsEgress']:
-                    res = self.ec2_client.revoke_security_group_egress(
-                        GroupId=sg['GroupId'],
-                        IpPermissions=sg['IpPermissionsEgress'])
-                    meta = res['ResponseMetadata']
-                    logger.debug(
-                        "delete_security_groups::revoke_security_group_egresss::meta::{}".format(meta))
-                    self.ec2_client.delete_security_group(GroupId=sg['GroupId'])
-            del(self['SecurityGroups'])
+            # Authorize first so traffic moving between rules is never cut off.
+            for action, permissions in (('authorize', add), ('revoke', remove)):
+                if permissions:
+                    api = "{}_security_group_{}".format(action, direction)
+                    res = getattr(self.ec2_client, api)(GroupId=sg['GroupId'],
+                        IpPermissions=permissions)
+                    calls = calls + 1
+                    trace("sync_permissions::{}".format(api), group_id=sg['GroupId'],
+                        permissions=permissions, meta=res['ResponseMetadata'])
         except ClientError as c:
-            if c.response['Error']['Code'] == 'InvalidGroup.NotFound':
-                logger.debug("delete_security_group")
-                pass
-            else:
+            if not retry or c.response['Error']['Code'] not in STALE_CODES:
                 raise
+            logger.warning("sync_permissions::Stale rules::%s::%s", sg['GroupId'],
+                c.response['Error']['Code'])
+            res = self.clients.get('ec2', cached=False).describe_security_groups(
+                GroupIds=[sg['GroupId']])
+            live = res['SecurityGroups'][0][dict(DIRECTIONS)[direction]]
+            return calls + 1 + self.sync_permissions(sg, direction, desired, live, False)
+        return calls
+
+    def delete_security_groups(self):
+        logger.info("delete_security_group::Executing")
+        try:
+            sgs = [s for s in self['SecurityGroups'] if s['GroupName'] != 'default']
         except KeyError as k:
             if k.args[0] == 'SecurityGroups':
-                pass
-            else:
-                raise
+                return
+            raise
+        group_ids = set(sg['GroupId'] for sg in sgs)
+        # A group cannot be deleted while another group's rules name it, so revoke just
+        # those rules first; rules naming their own group do not block anything.
+        def break_references(sg):
+            for direction, field in DIRECTIONS:
+                permissions = referencing(sg.get(field), group_ids - {sg['GroupId']})
+                if not permissions:
+                    continue
+                api = "revoke_security_group_{}".format(direction)
+                try:
+                    res = getattr(self.ec2_client, api)(GroupId=sg['GroupId'],
+                        IpPermissions=permissions)
+                    trace("delete_security_groups::{}".format(api), group_id=sg['GroupId'],
+                        meta=res['ResponseMetadata'])
+                except ClientError as c:
+                    code = c.response['Error']['Code']
+                    if code != 'InvalidGroup.NotFound' and code not in STALE_CODES:
+                        raise
+        def delete_security_group(sg):
+            try:
+                self.ec2_client.delete_security_group(GroupId=sg['GroupId'])
+            except ClientError as c:
+                if c.response['Error']['Code'] == 'InvalidGroup.NotFound':
+                    logger.debug("delete_security_group")
+                else:
+                    raise
+        parallel_map(break_references, sgs)
+        parallel_map(delete_security_group, sgs)
+        del(self['SecurityGroups'])
         self.save()
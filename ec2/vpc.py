@@ -1,12 +1,13 @@
 from subfish.base import AwsBase
+from subfish.taskgraph import parallel_map
+from subfish.tracing import get_tracer
 
 import re, json
 import logging
-from ipaddress import ip_network
-from jinja2 import Template
-from botocore.exceptions import ClientError, WaiterError
+from botocore.exceptions import ClientError
 
 logger = logging.getLogger(__name__)
+trace = get_tracer(__name__)
 
 class AwsVpc(AwsBase):
     """
@@ -14,12 +15,22 @@ class AwsVpc(AwsBase):
 
     Methods:
     __init__ - initialize
+    get_cidr_allocator - INTERNAL; returns the allocator for the VPC cidr block.
     get_available_cidr_block - INTERNAL; returns an available cidr block to use for a subnet.
+    allocate_af_cidr_blocks - INTERNAL; reserves the cidr blocks and picks the availability
+                              zones of a whole affinity group.
+    release_cidr_blocks - INTERNAL; returns cidr blocks to the VPC address space.
+    release_af_cidr_blocks - INTERNAL; drops the placements of affinity groups that no
+                             subnet took.
+    describe_azs - INTERNAL; returns the availability zones and where the VPC's subnets are.
+    get_az_loads - INTERNAL; returns the number of subnets in each availability zone.
     get_next_az - INTERNAL; returns next unused availability zone.
     get_af_subnets - INTERNAL; returns the subnets associated with an affinity group.
     get_at_rt - INTERNAL; returns the route tables associated with an affinity group.
     get_af_ngw - INTERNAL; returns the NAT gateways associated with an affinity group.
     create_vpc - USER; Creates a VPC with a cidr block.
+    start_create_vpc - INTERNAL; creates the VPC and returns the wait for it.
+    finish_create_vpc - INTERNAL; turns on the DNS attributes of the available VPC.
     refresh_vpc - INTERNAL; refreshes the dictionary with the VPC ID.
     delete_vpc - USER; Deletes the VPC in the dictionary.
     create_route_table - USER; creates a route table for an affinity group.
@@ -28,55 +39,142 @@ class AwsVpc(AwsBase):
     associate_rt_subnet - INTERNAL; associate the route table with the subnet.
     delete_route_tables - USER; delete all route tables in the dictionary.
     create_subnet - USER; create a subnet for an affinity group.
+    start_create_subnet - INTERNAL; creates the subnet and returns the wait for it.
+    finish_create_subnet - INTERNAL; refreshes the subnets once it is available.
     refresh_subnets - INTERNAL; updates the dictionary with the subnets associated with the VPC.
     delte_subnets - USER; deletes all subnets in the dictionary.
     """
 
     def __init__(self, path, **kwargs):
         logger.debug("__init__::Executing")
+        self.cidr_allocator = None
+        self.af_cidr_blocks = {}
+        # Availability zones of subnets placed but not in the state yet.
+        self.placed_azs = []
         super().__init__(path, **kwargs)
-        self.ec2_client = self.session.create_client('ec2')
 
-    def get_available_cidr_block(self):
-        logger.debug("get_available_cidr_block::Executing")
-        try:
+    def get_cidr_allocator(self):
+        logger.debug("get_cidr_allocator::Executing")
+        from subfish.cidr import CidrAllocator
+        from ipaddress import ip_network
+        with self.lock:
             cidr_block = self['Vpc']['CidrBlock']
-            used_cidrs = [s['CidrBlock'] for s in self['Subnets']]
-        except KeyError as k:
-            logger.debug("get_available_cidr_block::KeyError::%s", k.args[0])
-            if k.args[0] == 'Vpc':
-                return 0
-            if k.args[0] in ('CidrBlock', 'Subnets'):
-                used_cidrs = []
-        all_cidrs = [str(c) for c in list(ip_network(cidr_block).subnets(new_prefix=24))]
-        cidrs = list(set(all_cidrs) - set(used_cidrs))
-        cidrs.sort()
-        logger.debug("get_available_cidr_block::Returning::%s", cidrs[0])
-        return cidrs[0]
+            allocator = self.cidr_allocator
+            if allocator is None or allocator.cidr_block != cidr_block:
+                stored = self.get('CidrAllocator')
+                if stored and stored['CidrBlock'] == cidr_block:
+                    allocator = CidrAllocator.from_dict(stored)
+                else:
+                    allocator = CidrAllocator(cidr_block)
+                self.cidr_allocator = allocator
+            # Subnets created outside subfish still occupy their blocks. Those in a secondary
+            # cidr block of the VPC are not the allocator's to reserve.
+            network = ip_network(allocator.cidr_block)
+            for s in self.get('Subnets', []):
+                if not ip_network(s['CidrBlock']).subnet_of(network):
+                    continue
+                if not allocator.is_allocated(s['CidrBlock']):
+                    allocator.reserve(s['CidrBlock'])
+            return allocator
+
+    def save_cidr_allocator(self):
+        self['CidrAllocator'] = self.cidr_allocator.to_dict()
+        self.save()
+
+    def get_available_cidr_block(self, prefix=24):
+        logger.debug("get_available_cidr_block::Executing")
+        if 'Vpc' not in self:
+            logger.debug("get_available_cidr_block::KeyError::Vpc")
+            return 0
+        with self.lock:
+            cidr = self.get_cidr_allocator().allocate(prefix)
+            self.save_cidr_allocator()
+        logger.debug("get_available_cidr_block::Returning::%s", cidr)
+        return cidr
+
+    def allocate_af_cidr_blocks(self, affinity_group, count, prefix=24):
+        """
+        Reserves count cidr blocks for an affinity group and places each in the least used
+        availability zone, counting subnets placed but not created yet. create_subnet takes
+        the placements in order, so the subnets of a group can be created concurrently.
+        """
+        logger.debug("allocate_af_cidr_blocks::%s::%s::/%s", affinity_group, count, prefix)
+        zones, described = self.describe_azs()
+        with self.lock:
+            loads = self.get_az_loads(zones, described)
+            azs = []
+            for n in range(count):
+                az = min(loads, key=lambda k: loads[k])
+                loads[az] = loads[az] + 1
+                azs.append(az)
+            # Blocks are reserved once the zones are picked, and recorded as placements in
+            # the same step, so a failure never leaves a block no one will release.
+            cidrs = self.get_cidr_allocator().allocate_many(count, prefix)
+            placements = list(zip(cidrs, azs))
+            self.placed_azs.extend(azs)
+            self.af_cidr_blocks.setdefault(str(affinity_group), []).extend(placements)
+            self.save_cidr_allocator()
+        logger.debug("allocate_af_cidr_blocks::Returning::%s", placements)
+        return cidrs
+
+    def release_cidr_blocks(self, cidrs):
+        logger.debug("release_cidr_blocks::%s", cidrs)
+        with self.lock:
+            allocator = self.get_cidr_allocator()
+            for cidr in cidrs:
+                allocator.release(cidr)
+            self.save_cidr_allocator()
+
+    def release_af_cidr_blocks(self, affinity_groups):
+        """
+        Releases the cidr blocks and availability zones placed for affinity groups that
+        create_subnet did not take, once the operation that placed them has failed.
+        """
+        logger.debug("release_af_cidr_blocks::%s", affinity_groups)
+        with self.lock:
+            placements = [p for af in affinity_groups \
+                for p in self.af_cidr_blocks.pop(str(af), [])]
+            for cidr, az in placements:
+                if az in self.placed_azs:
+                    self.placed_azs.remove(az)
+        if placements:
+            self.release_cidr_blocks([cidr for cidr, az in placements])
+
+    def describe_azs(self):
+        logger.debug("describe_azs::Executing")
+        vpc_id = self['Vpc']['VpcId']
+        az_zones = self.ec2_client.describe_availability_zones()
+        meta = az_zones['ResponseMetadata']
+        azs = az_zones['AvailabilityZones']
+        trace("describe_azs::describe_availability_zones", meta=meta, data=azs)
+        subnets = self.paginate('describe_subnets', 'Subnets',
+            Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])
+        return [a['ZoneName'] for a in azs], \
+            dict((s['SubnetId'], s['AvailabilityZone']) for s in subnets)
+
+    def get_az_loads(self, zones, described):
+        """
+        Returns the number of subnets in each availability zone: described, stored, or
+        placed and not created yet. Callers hold the lock.
+        """
+        # Subnets created by concurrent callers may not be described yet.
+        known = dict(described)
+        for s in self.get('Subnets', []):
+            known.setdefault(s['SubnetId'], s['AvailabilityZone'])
+        az_dict = dict((z, 0) for z in zones)
+        for az in list(known.values()) + self.placed_azs:
+            az_dict[az] = az_dict.get(az, 0) + 1
+        return az_dict
 
     def get_next_az(self, affinity_group=0):
+        """Returns the least used availability zone and counts it as placed."""
         logger.debug("get_next_az::Executing")
         try:
-            vpc_id = self['Vpc']['VpcId']
-            az_zones = self.ec2_client.describe_availability_zones()
-            meta = az_zones['ResponseMetadata']
-            azs = az_zones['AvailabilityZones']
-            logger.debug(
-                "get_next_az::describe_availability_zones::meta::%s", meta)
-            logger.debug(
-                "get_next_az::describe_availability_zones::data::%s", azs)
-            az_dict = {a['ZoneName']: 0 for a in azs}
-            subnets = self.ec2_client.describe_subnets(
-                Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])
-            meta = subnets['ResponseMetadata']
-            logger.debug(
-                "get_next_az::describe_subnets::meta::%s", meta)
-            logger.debug(
-                "get_next_az::describe_subnets::data::%s", subnets['Subnets'])
-            for az in [s['AvailabilityZone'] for s in subnets['Subnets']]:
-                    az_dict[az] = az_dict[az] + 1
-            min_value = min(az_dict.values())
-            az = next(k for k, v in az_dict.items() if v == min_value)
+            zones, described = self.describe_azs()
+            with self.lock:
+                az_dict = self.get_az_loads(zones, described)
+                az = min(az_dict, key=lambda k: az_dict[k])
+                self.placed_azs.append(az)
             logger.debug("get_next_az::Returning::%s", az)
             return az
         except KeyError as k:
@@ -85,61 +183,56 @@ class AwsVpc(AwsBase):
 
     def get_af_subnets(self, affinity_group=0):
         logger.debug("get_af_subnets::Executing")
-        try:
-            subnets = [s['SubnetId'] for s in self['Subnets'] for t in s['Tags'] \
-                if t['Key'] == 'affinity_group' and t['Value'] == str(affinity_group)]
-            logger.debug("get_af_subnets::Returning::%s", subnets)
-            return subnets
-        except KeyError as k:
-            logger.error("get_af_subnets::KeyError::%s", k.args[0])
+        subnets = [s['SubnetId'] for s in self.tagged('Subnets', 'affinity_group', affinity_group)]
+        logger.debug("get_af_subnets::Returning::%s", subnets)
+        return subnets
 
     def get_af_rt(self, affinity_group=0):
         logger.debug("get_af_rt::Executing")
-        try:
-            rts = next(rt['RouteTableId'] for rt in self['RouteTables'] for t in rt['Tags'] \
-                if t['Key'] == 'affinity_group' and t['Value'] == str(affinity_group))
-            logger.debug("get_af_rt::Returning::%s", rts)
-        except KeyError as k:
-            logger.debug("get_af_rt::NoKey::%s", k.args[0])
+        rts = self.tagged('RouteTables', 'affinity_group', affinity_group)
+        if not rts:
+            logger.debug("get_af_rt::NoRouteTable::%s", affinity_group)
             return 0
-        return rts
+        logger.debug("get_af_rt::Returning::%s", rts[0]['RouteTableId'])
+        return rts[0]['RouteTableId']
 
     def get_af_ngw(self, affinity_group=0):
         logger.debug("get_af_ngw::Executing")
-        try:
-            ngw = next(ngw['NatGatewayId'] for ngw in self['NatGateways'] for t in ngw['Tags'] \
-                if t['Key'] == 'affinity_group' and t['Value'] == str(affinity_group))
-            logger.debug("get_af_ngw: Returning <{}>".format(ngw))
-        except KeyError as k:
-            logger.debug("get_af_ngw::NoKey::%s", k.args[0])
+        ngws = self.tagged('NatGateways', 'affinity_group', affinity_group)
+        if not ngws:
+            logger.debug("get_af_ngw::NoNatGateway::%s", affinity_group)
             return 0
-        return ngw
+        logger.debug("get_af_ngw: Returning <%s>", ngws[0]['NatGatewayId'])
+        return ngws[0]['NatGatewayId']
 
 
     def create_vpc(self, cidr_block='10.0.0.0/16'):
         logger.info("create_vpc::Executing")
+        return self.staged('create_vpc', cidr_block)
+
+    def start_create_vpc(self, cidr_block='10.0.0.0/16'):
+        logger.debug("start_create_vpc::Executing")
         if 'Vpc' in self:
             self.refresh_vpc()
-            return 0
-        res = self.ec2_client.create_vpc(CidrBlock = cidr_block)
+            return None
+        res = self.ec2_client.create_vpc(CidrBlock = cidr_block, **self.tag_on_create('vpc'))
         meta = res['ResponseMetadata']
-        data = res['Vpc']
+        data = self.created_tags(res['Vpc'])
         self['Vpc'] = data
-        logger.debug("create_vpc::create_vpc::meta::%s", meta)
-        logger.debug("create_vpc::create_vpc::data::%s", data)
-        vpc_id = res['Vpc']['VpcId']
-        waiter = self.ec2_client.get_waiter('vpc_exists')
-        waiter.wait(VpcIds=[vpc_id])
-        waiter = self.ec2_client.get_waiter('vpc_available')
-        waiter.wait(VpcIds=[vpc_id])
+        trace("create_vpc::create_vpc", meta=meta, data=data)
+        return ('vpc', [res['Vpc']['VpcId']], 'available')
+
+    def finish_create_vpc(self, ids, found):
+        logger.debug("finish_create_vpc::Executing")
+        vpc_id = ids[0]
         res = self.ec2_client.modify_vpc_attribute(
             EnableDnsHostnames={'Value': True}, VpcId=vpc_id)
         meta = res
-        logger.debug("create_vpc::modify_vpc_attribute::meta::%s", meta)
+        trace("create_vpc::modify_vpc_attribute", meta=meta)
         res = self.ec2_client.modify_vpc_attribute(
             EnableDnsSupport={'Value': True}, VpcId=vpc_id)
         meta = res
-        logger.debug("create_vpc::modify_vpc_attribute::meta::%s", meta)
+        trace("create_vpc::modify_vpc_attribute", meta=meta)
         self.save()
 
     def refresh_vpc(self):
@@ -149,8 +242,7 @@ class AwsVpc(AwsBase):
         meta = res['ResponseMetadata']
         data = res['Vpcs']
         self['Vpc'] = data[0]
-        logger.debug("refresh_vpc::describe_vpcs::meta::%s", meta)
-        logger.debug("refresh_vpc::describe_vpcs::data::%s", data)
+        trace("refresh_vpc::describe_vpcs", meta=meta, data=data)
         self.save()
 
     def delete_vpc(self):
@@ -160,8 +252,11 @@ class AwsVpc(AwsBase):
             logger.debug("delete_vpc::Deleting::%s", vpc_id)
             res = self.ec2_client.delete_vpc(VpcId=vpc_id)
             meta = res['ResponseMetadata']
-            logger.debug("delete_vpc::describe_vpcs::meta::%s", meta)
+            trace("delete_vpc::describe_vpcs", meta=meta)
             del(self['Vpc'])
+            if 'CidrAllocator' in self:
+                del(self['CidrAllocator'])
+            self.cidr_allocator = None
             self.save()
         except KeyError as k:
             logger.debug("delete_vpc::KeyError::%s", k.args[0])
@@ -170,74 +265,52 @@ class AwsVpc(AwsBase):
     def create_route_table(self, affinity_group=0):
         logger.info("create_route_table::Executing")
         vpc_id = self['Vpc']['VpcId']
-        res = self.ec2_client.create_route_table(VpcId=vpc_id)
+        res = self.ec2_client.create_route_table(VpcId=vpc_id,
+            **self.tag_on_create('route-table', affinity_group))
         meta = res['ResponseMetadata']
-        data = res['RouteTable']
-        logger.debug("create_route_table::create_route_table::meta::%s", meta)
-        logger.debug("create_route_table::create_route_table::data::%s", data)
-        rt_id = data['RouteTableId']
-#       waiter = get_waiter('router_exists')
-        i=.1
-        while True:
-            try:
-                logger.debug("create_route_table::Tagging::%s", rt_id)
-                res = self.ec2_client.create_tags(
-                    Resources=[rt_id],
-                    Tags=[{'Key': 'affinity_group', 'Value': str(affinity_group)}])
-                logger.debug("create_route_table::create_tags::meta::%s", meta)
-            except ClientError as c:
-                if c.response['Error']['Code'] == 'InvalidRouteTableID.NotFound':
-                    logger.debug(
-                        "create_route_table::InvalidRouteTableID.NotFound::Trying Again...")
-                    self.sleep(i)
-                    i=i+.1
-                    continue
-            break
+        data = self.created_tags(res['RouteTable'], affinity_group)
+        trace("create_route_table::create_route_table", meta=meta, data=data)
+        self.list_append('RouteTables', data)
         self.refresh_route_tables()
 
     def refresh_route_tables(self):
         logger.debug("refresh_route_tables::Executing")
         try:
             vpc_id = self['Vpc']['VpcId']
-            res = self.ec2_client.describe_route_tables(Filters=[
+            rts = self.paginate('describe_route_tables', 'RouteTables', Filters=[
                 {'Name': 'vpc-id', 'Values': [vpc_id]},
                 {'Name': 'tag-key', 'Values': ['affinity_group']}])
-            meta = res['ResponseMetadata']
-            data = res['RouteTables']
-            logger.debug(
-                "refresh_route_tables::describe_route_tables::meta::%s", meta)
-            logger.debug(
-                "refresh_route_tables::describe_route_tables::data::%s", data)
-            self['RouteTables'] = data
-            self.save()
+            count = self.refresh_key('RouteTables', rts)
+            logger.debug("refresh_route_tables::describe_route_tables::%s", count)
         except KeyError as k:
             logger.debug("refresh_route_tables::KeyError::%s", k.args[0])
 
     def associate_rt_subnet(self, affinity_group=0):
         logger.debug("associate_rt_subnet::Executing")
-        rt_id = next(rt['RouteTableId'] for rt in self['RouteTables'] \
-            for t in rt['Tags'] if t['Key'] == 'affinity_group' \
-            and t['Value'] == str(affinity_group))
+        rt_id = self.get_af_rt(affinity_group)
+        associated = set(a.get('SubnetId') for rt in self.get('RouteTables', []) \
+            for a in rt.get('Associations', []))
         for s in self.get_af_subnets(affinity_group):
+            if s in associated:
+                continue
             data = self.ec2_client.associate_route_table(RouteTableId=rt_id, SubnetId=s)
-            logger.debug(
-                "associate_rt_subnet::associate_route_table::data::%s", data)
-        self.sleep()
+            trace("associate_rt_subnet::associate_route_table", data=data)
         self.refresh_route_tables()
 
     def delete_route_tables(self, affinity_group=0):
         logger.info("delete_route_tables::Executing")
         self.refresh_route_tables()
         try:
-            for rt in self['RouteTables']:
-                for association in rt['Associations']:
-                    meta = self.ec2_client.disassociate_route_table(
-                        AssociationId=association['RouteTableAssociationId'])
-                    logger.debug(
-                        "delete_route_tables::disassociate_route_table::meta::%s", meta)
-                meta = self.ec2_client.delete_route_table(RouteTableId=rt['RouteTableId'])
-                logger.debug(
-                    "delete_route_tables::delete_route_tables::meta::%s", meta)
+            associations = [a['RouteTableAssociationId'] for rt in self['RouteTables'] \
+                for a in rt['Associations'] if not a.get('Main')]
+            def disassociate_route_table(association_id):
+                meta = self.ec2_client.disassociate_route_table(AssociationId=association_id)
+                trace("delete_route_tables::disassociate_route_table", meta=meta)
+            parallel_map(disassociate_route_table, associations)
+            def delete_route_table(rt_id):
+                meta = self.ec2_client.delete_route_table(RouteTableId=rt_id)
+                trace("delete_route_tables::delete_route_tables", meta=meta)
+            parallel_map(delete_route_table, [rt['RouteTableId'] for rt in self['RouteTables']])
             del(self['RouteTables'])
             self.save()
         except KeyError as k:
@@ -245,59 +318,64 @@ class AwsVpc(AwsBase):
             return 0
         
 
-    def create_subnet(self, affinity_group=0):
+    def create_subnet(self, affinity_group=0, prefix=24):
         logger.info("create_subnet::Executing")
+        return self.staged('create_subnet', affinity_group, prefix)
+
+    def start_create_subnet(self, affinity_group=0, prefix=24):
+        logger.debug("start_create_subnet::Executing")
         vpc_id = self['Vpc']['VpcId']
-        az = self.get_next_az(affinity_group)
-        cidr = self.get_available_cidr_block()
-        res = self.ec2_client.create_subnet(
-            VpcId=vpc_id,
-            AvailabilityZone=az,
-            CidrBlock=cidr)
+        with self.lock:
+            pending = self.af_cidr_blocks.get(str(affinity_group))
+            placement = pending.pop(0) if pending else None
+        cidr, az = placement or (None, None)
+        try:
+            if not placement:
+                az = self.get_next_az(affinity_group)
+                cidr = self.get_available_cidr_block(prefix)
+            res = self.ec2_client.create_subnet(
+                VpcId=vpc_id,
+                AvailabilityZone=az,
+                CidrBlock=cidr,
+                **self.tag_on_create('subnet', affinity_group))
+        except Exception:
+            with self.lock:
+                if az in self.placed_azs:
+                    self.placed_azs.remove(az)
+            if cidr:
+                self.release_cidr_blocks([cidr])
+            raise
         meta = res['ResponseMetadata']
         data = res['Subnet']
         subnet_id = data['SubnetId']
-        logger.debug("create_subnet::create_subnet::meta::%s", meta)
-        logger.debug("create_subnet::create_subnet::data::%s", data)
-        waiter = self.ec2_client.get_waiter('subnet_available')
-        i=.1
-        while True:
-            try:
-                waiter.wait(SubnetIds=[subnet_id])
-            except WaiterError as w:
-                print(w.args)
-                logger.debug(
-                    "create_subnet::{}::waiter failed trying again...".format(w.args[0]))
-                self.sleep(i)
-                i=i+.1
-                continue
-            break
-        res = self.ec2_client.create_tags(
-            Resources=[subnet_id],
-            Tags=[{'Key': 'affinity_group', 'Value': str(affinity_group)}])
-        meta = res['ResponseMetadata']
-        logger.debug("create_subnet::create_subnet::meta::%s", meta)
+        trace("create_subnet::create_subnet", meta=meta, data=data)
+        with self.lock:
+            self.list_append('Subnets', self.created_tags(data, affinity_group))
+            self.placed_azs.remove(az)
+        return ('subnet', [subnet_id], 'available')
+
+    def finish_create_subnet(self, ids, found):
+        logger.debug("finish_create_subnet::Executing")
         self.refresh_subnets()
 
     def refresh_subnets(self):
         logger.debug("refresh_subnets::Executing")
         vpc_id = self['Vpc']['VpcId']
-        res = self.ec2_client.describe_subnets(Filters=[
+        subnets = self.paginate('describe_subnets', 'Subnets', Filters=[
             {'Name': 'vpc-id', 'Values': [vpc_id]}])
-        meta = res['ResponseMetadata']
-        data = res['Subnets']
-        self['Subnets'] = data
-        logger.debug("refresh_subnets::describe_subnets::meta::%s", meta)
-        logger.debug("refresh_subnets::describe_subnets::data::%s", data)
-        self.save()
+        count = self.refresh_key('Subnets', subnets)
+        logger.debug("refresh_subnets::describe_subnets::%s", count)
 
     def delete_subnets(self):
         logger.info("delete_subnets::Executing")
         try:
-            for s in self['Subnets']:
-                res = self.ec2_client.delete_subnet(SubnetId=s['SubnetId'])
+            def delete_subnet(subnet_id):
+                res = self.ec2_client.delete_subnet(SubnetId=subnet_id)
                 meta = res['ResponseMetadata']
-                logger.debug("delete_subnets::describe_subnets::meta::%s", meta)
+                trace("delete_subnets::describe_subnets", meta=meta)
+            parallel_map(delete_subnet, [s['SubnetId'] for s in self['Subnets']])
+            if 'Vpc' in self:
+                self.release_cidr_blocks([s['CidrBlock'] for s in self['Subnets']])
             del(self['Subnets'])
             self.save()
         except KeyError as k:
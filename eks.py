@@ -1,64 +1,197 @@
-from subfish.ec2 import AwsEc2
+from subfish.ec2 import Ec2
 from subfish.iam import AwsIam
+from subfish.taskgraph import TaskGraph
+from subfish.plan import Planner, AFFINITY_GROUP_TYPES
+import logging
 
-class AwsEks(AwsEc2, AwsIam):
+logger = logging.getLogger(__name__)
 
-    def __init__(self, path, config_path="."):
+class AwsEks(Ec2, AwsIam):
+
+    def __init__(self, path, config_path=".", **kwargs):
         super().__init__(path=path,
-                ec2_path=config_path,
-                iam_path=config_path)
-        self.logger.debug("Executing AwsEks Constructor")
-        self.eks_client = self.session.create_client('eks')
+                config_path=config_path,
+                iam_path=config_path,
+                **kwargs)
+        logger.debug("Executing AwsEks Constructor")
 
-    def create_vpc_environment(self, num_affinity_groups=2):
-        self.logger.debug("Executing AwsEks create_vpc_environment")
-        self.create_vpc()
-        self.create_affinity_group(zones=num_affinity_groups)
+    def get_next_af_group_number(self):
+        logger.debug("get_next_af_group_number::Executing")
+        af_groups = self.tag_values('Subnets', 'affinity_group')
+        if not af_groups:
+            logger.debug("Generating first subnet")
+            return 0
+        next_af_group_number = max(int(v) for v in af_groups)+1
+        logger.debug("Generated next_af_group_number: <%s>", next_af_group_number)
+        return next_af_group_number
 
-    def create_affinity_group(self, type='private', zones=2):
-        self.logger.debug("Executing AwsEks create_affinity_group")
-        try:
-            next_af_group_number = int(max([t['Value'] \
-                for s in self['Subnets'] for t in s['Tags'] \
-                if t['Key'] == 'affinity_group']))+1
-            self.logger.debug(
-                "Generated next_af_group_number: <{}>".format(next_af_group_number))
-        except KeyError as k:
-            if k.args[0] == 'Subnets':
-                self.logger.debug("Generating first subnet")
-                next_af_group_number = 0
-            else:
-                raise
-        if type == 'public' or type == 'public-private-access' and 'InternetGateway' in self:
-            self.logger.error("Cannot have two public affinity groups.")
-            return -1
-        self.logger.debug("Generating subnets for {} availability zones.".format(zones))
-        for i in range(zones):
-            self.logger.debug("Creating subnet <{}>.".format(i))
-            self.create_subnet(affinity_group=next_af_group_number)
-        self.create_route_table(affinity_group=next_af_group_number)
-        self.associate_rt_subnet(affinity_group=next_af_group_number)
-        if type == 'public':
-            self.create_internet_gateway(affinity_group=next_af_group_number)
+    def get_nat_af_group(self):
+        logger.debug("get_nat_af_group::Executing")
+        af_groups = self.tag_values('NatGateways', 'affinity_group')
+        return af_groups[0] if af_groups else None
+
+    def plan_affinity_group(self, graph, affinity_group, type='private', zones=2,
+            after=None, nat_task=None, nat_af_group=None):
+        """
+        Adds the tasks that build one affinity group to a TaskGraph and returns the name of
+        the NAT gateway task, if the group creates one. Subnets and the route table only
+        depend on `after`, so they are created concurrently.
+        """
+        logger.debug("plan_affinity_group::%s::%s::%s", affinity_group, type, zones)
+        af = affinity_group
+        cidrs = graph.add("cidr_blocks-{}".format(af), self.allocate_af_cidr_blocks,
+            affinity_group=af, count=zones, deps=(after,))
+        subnets = [graph.add("subnet-{}-{}".format(af, i), self.create_subnet,
+            affinity_group=af, deps=(cidrs,)) for i in range(zones)]
+        rt = graph.add("route_table-{}".format(af), self.create_route_table,
+            affinity_group=af, deps=(after,))
+        graph.add("associate_rt_subnet-{}".format(af), self.associate_rt_subnet,
+            affinity_group=af, deps=subnets + [rt])
+        if type in ('public', 'public-private-access'):
+            igw = graph.add("internet_gateway-{}".format(af), self.create_internet_gateway,
+                affinity_group=af, deps=subnets + [rt])
         if type == 'public-private-access':
-            self.create_internet_gateway(affinity_group=next_af_group_number)
-            self.create_nat_gateway(affinity_group=next_af_group_number)
+            return graph.add("nat_gateway-{}".format(af), self.create_nat_gateway,
+                affinity_group=af, deps=(igw,))
         if type == 'private-access-public':
-            if 'InternetGateway' not in self:
-                return -1
-            nat_af_group = next(t['Value'] for t in self['NatGateway']['Tags'] \
-                if t['Key'] == 'affinitiy_group')
-            self.create_nat_default_route(
-                rt_affinity_group=next_af_group_number,
-                nat_affinity_group=nat_af_group)
+            graph.add("nat_default_route-{}".format(af), self.create_nat_default_route,
+                rt_affinity_group=af, nat_affinity_group=nat_af_group, deps=(rt, nat_task))
+
+    def plan_affinity_groups(self, graph, groups, after=None):
+        """
+        Adds every (type, zones) pair in `groups` to a TaskGraph with consecutive affinity
+        group numbers. Returns the list of affinity group numbers, or -1 if the groups cannot
+        be built in this VPC.
+        """
+        logger.debug("plan_affinity_groups::%s", groups)
+        public = [t for t, z in groups if t in ('public', 'public-private-access')]
+        for t, z in groups:
+            if t not in AFFINITY_GROUP_TYPES:
+                raise ValueError("Unknown affinity group type {}".format(t))
+        if public and 'InternetGateway' in self or len(public) > 1:
+            logger.error("Cannot have two public affinity groups.")
+            return -1
+        nat_af_group = self.get_nat_af_group()
+        if 'private-access-public' in [t for t, z in groups] \
+                and 'public-private-access' not in public and nat_af_group is None:
+            logger.error("No NAT gateway for a private-access-public affinity group.")
+            return -1
+        af = self.get_next_af_group_number()
+        nat_task = None
+        af_groups = []
+        # The NAT gateway group goes first so the others can route through it.
+        for t, z in sorted(groups, key=lambda g: g[0] != 'public-private-access'):
+            logger.debug("Generating subnets for %s availability zones.", z)
+            task = self.plan_affinity_group(graph, af, type=t, zones=z, after=after,
+                nat_task=nat_task, nat_af_group=nat_af_group)
+            if task:
+                nat_task, nat_af_group = task, af
+            af_groups.append(af)
+            af = af + 1
+        return af_groups
+
+    def create_vpc_environment(self, num_affinity_groups=2, affinity_groups=None,
+            cidr_block='10.0.0.0/16'):
+        """
+        Builds the VPC and its affinity groups, or completes them if the environment
+        already exists, and returns the affinity group numbers.
+        """
+        logger.debug("Executing AwsEks create_vpc_environment")
+        if affinity_groups is None:
+            affinity_groups = [('private', num_affinity_groups)]
+        try:
+            plan = self.apply_vpc_environment(
+                {'cidr_block': cidr_block, 'affinity_groups': affinity_groups})
+        except ValueError as e:
+            logger.error("create_vpc_environment::%s", e)
+            return -1
+        return plan.affinity_groups
+
+    def apply_vpc_environment(self, spec, refresh=False):
+        """Brings the environment to a declarative spec; see subfish.plan."""
+        logger.debug("Executing AwsEks apply_vpc_environment")
+        return Planner(self).apply(spec, refresh=refresh)
+
+    def create_affinity_group(self, type='private', zones=2):
+        logger.debug("Executing AwsEks create_affinity_group")
+        return self.create_affinity_groups([(type, zones)])[0]
+
+    def create_affinity_groups(self, groups):
+        logger.debug("Executing AwsEks create_affinity_groups")
+        graph = TaskGraph()
+        af_groups = self.plan_affinity_groups(graph, groups)
+        if af_groups == -1:
+            return [-1]
+        with self.write_behind():
+            try:
+                graph.run()
+            except Exception:
+                self.release_af_cidr_blocks(af_groups)
+                raise
+        return af_groups
+
+    def refresh_vpc_environment(self):
+        logger.debug("Executing AwsEks refresh_vpc_environment")
+        if 'Vpc' not in self:
+            return
+        graph = TaskGraph()
+        graph.add('vpc', self.refresh_vpc)
+        graph.add('subnets', self.refresh_subnets)
+        graph.add('route_tables', self.refresh_route_tables)
+        graph.add('nat_gateways', self.refresh_nat_gateways)
+        for k, refresh in (('InternetGateway', self.refresh_internet_gateway),
+                ('SecurityGroups', self.refresh_security_groups),
+                ('Instances', self.refresh_instances)):
+            if k in self:
+                graph.add(k, refresh)
+        with self.write_behind():
+            graph.run()
+
+    def tag_vpc_environment(self, tags):
+        """
+        Adds user tags to every resource of the environment, with one create_tags call per
+        thousand resources, and to everything it creates from now on.
+        """
+        logger.debug("Executing AwsEks tag_vpc_environment")
+        if 'Vpc' not in self:
+            return 0
+        self.tags.update(tags)
+        ids = [self['Vpc']['VpcId']]
+        if 'InternetGateway' in self:
+            ids.append(self['InternetGateway']['InternetGatewayId'])
+        for k, id_field in (('Subnets', 'SubnetId'), ('RouteTables', 'RouteTableId'),
+                ('NatGateways', 'NatGatewayId'), ('SecurityGroups', 'GroupId'),
+                ('Instances', 'InstanceId'), ('LaunchTemplates', 'LaunchTemplateId')):
+            ids.extend(r[id_field] for r in self.get(k, []))
+        ids.extend(a['AllocationId'] for n in self.get('NatGateways', []) \
+            for a in n.get('NatGatewayAddresses', []) if 'AllocationId' in a)
+        with self.tag_batcher as batcher:
+            batcher.add(ids, tags)
+        self.refresh_vpc_environment()
+        return len(ids)
+
+    def plan_vpc_teardown(self, graph):
+        """
+        Adds the tasks that tear down the VPC environment to a TaskGraph, in reverse
+        dependency order, and returns the name of the final VPC task.
+        """
+        logger.debug("plan_vpc_teardown::Executing")
+        instances = None
+        if 'Instances' in self:
+            instances = graph.add('instances', self.terminate_instances)
+        graph.add('launch_templates', self.delete_launch_templates)
+        graph.add('iam_roles', self.delete_iam_roles)
+        ngw = graph.add('nat_gateways', self.delete_nat_gateways, deps=(instances,))
+        igw = graph.add('internet_gateway', self.delete_internet_gateway,
+            deps=(ngw, instances))
+        rts = graph.add('route_tables', self.delete_route_tables, deps=(ngw,))
+        subnets = graph.add('subnets', self.delete_subnets, deps=(ngw, rts, instances))
+        sgs = graph.add('security_groups', self.delete_security_groups, deps=(instances,))
+        return graph.add('vpc', self.delete_vpc, deps=(igw, rts, subnets, sgs))
 
     def destroy_vpc_environment(self):
-#       self.delete_nat_gateway()
-#       self.delete_internet_gateway()
-#       self.delete_iam_roles()
-#       self.refresh_route_tables()
-#       self.refresh_subnets()
-#       self.delete_route_tables()
-#       self.delete_subnets()
-#       self.delete_security_groups()
-        self.delete_vpc()
+        logger.debug("Executing AwsEks destroy_vpc_environment")
+        graph = TaskGraph()
+        self.plan_vpc_teardown(graph)
+        with self.write_behind():
+            graph.run()
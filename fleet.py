@@ -0,0 +1,114 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import monotonic
+import logging
+import traceback
+
+logger = logging.getLogger(__name__)
+
+MAX_PROCESSES=4
+ACTIONS=('create', 'refresh', 'destroy')
+
+def get_spec(spec):
+    """Returns an environment spec as a dictionary; a bare string is a state file path."""
+    if isinstance(spec, str):
+        spec = {'path': spec}
+    if 'path' not in spec:
+        raise ValueError("Environment spec {} has no path".format(spec))
+    return spec
+
+def run_environment(spec, action):
+    """
+    Runs one fleet action against one environment. It lives at module level so worker
+    processes can unpickle it, and reports failures in its result instead of raising.
+    """
+    from subfish.eks import AwsEks
+    start = monotonic()
+    result = {'path': spec['path'], 'action': action, 'result': None, 'error': None}
+    try:
+        aws = AwsEks(spec['path'], config_path=spec.get('config_path', '.'),
+            **spec.get('options', {}))
+        if action == 'create':
+            res = aws.create_vpc_environment(
+                num_affinity_groups=spec.get('num_affinity_groups', 2),
+                affinity_groups=spec.get('affinity_groups'),
+                cidr_block=spec.get('cidr_block', '10.0.0.0/16'))
+            if res == -1:
+                raise ValueError("Invalid affinity groups for {}".format(spec['path']))
+            result['result'] = res
+        elif action == 'refresh':
+            aws.refresh_vpc_environment()
+        elif action == 'destroy':
+            aws.destroy_vpc_environment()
+        if 'Vpc' in aws:
+            result['vpc_id'] = aws['Vpc']['VpcId']
+    except Exception as e:
+        logger.error("run_environment::%s::%s::%s", spec['path'], action, e)
+        result['error'] = "{}: {}".format(type(e).__name__, e)
+        result['traceback'] = traceback.format_exc()
+    result['elapsed'] = monotonic() - start
+    return result
+
+class Fleet(object):
+    """
+    Fleet runs create, refresh and destroy over many environments at once, one worker
+    process per environment and at most max_processes at a time. Each environment is a
+    state file path or a dictionary with a 'path' and the arguments of
+    create_vpc_environment ('affinity_groups', 'num_affinity_groups', 'cidr_block'), plus
+    optional 'config_path' and constructor 'options'.
+
+    Methods:
+    create - USER; creates the VPC environment of every spec.
+    refresh - USER; refreshes the state of every environment.
+    destroy - USER; destroys every environment.
+    run - INTERNAL; runs an action over the fleet and returns the fleet report.
+    """
+
+    def __init__(self, specs, max_processes=MAX_PROCESSES):
+        logger.debug("__init__::Executing")
+        self.specs = [get_spec(s) for s in specs]
+        paths = [s['path'] for s in self.specs]
+        if len(set(paths)) != len(paths):
+            raise ValueError("Environments must not share a state file")
+        self.max_processes = max_processes
+
+    def create(self):
+        return self.run('create')
+
+    def refresh(self):
+        return self.run('refresh')
+
+    def destroy(self):
+        return self.run('destroy')
+
+    def run(self, action):
+        logger.info("run::%s::%s environments", action, len(self.specs))
+        if action not in ACTIONS:
+            raise ValueError("Unknown fleet action {}".format(action))
+        start = monotonic()
+        results = {}
+        if self.specs:
+            workers = min(self.max_processes, len(self.specs))
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = dict((pool.submit(run_environment, s, action), s)
+                    for s in self.specs)
+                for future in as_completed(futures):
+                    path = futures[future]['path']
+                    try:
+                        results[path] = future.result()
+                    except Exception as e:
+                        # The worker process itself died.
+                        results[path] = {'path': path, 'action': action, 'result': None,
+                            'error': "{}: {}".format(type(e).__name__, e), 'elapsed': None}
+                    logger.debug("run::Finished::%s::%s", path, results[path]['error'])
+        elapsed = monotonic() - start
+        failed = sorted(p for p, r in results.items() if r['error'])
+        report = {
+            'action': action,
+            'environments': results,
+            'succeeded': len(results) - len(failed),
+            'failed': failed,
+            'elapsed': elapsed,
+            'throughput': len(results) / elapsed if elapsed else 0.0}
+        logger.info("run::%s::%s succeeded::%s failed::%.2fs::%.2f environments/s",
+            action, report['succeeded'], len(failed), elapsed, report['throughput'])
+        return report
@@ -1,66 +1,78 @@
 from subfish.base import AwsBase 
-from jinja2 import Template
+from subfish.taskgraph import parallel_map
+from subfish.catalog import get_catalog
 from os import path
 from botocore.exceptions import ClientError
+import logging
 
 RELATIVE_ASSUME_ROLE_POLICIES="assume_policies"
 RELATIVE_ROLE_POLICIES="role_policies"
 
+logger = logging.getLogger(__name__)
+
 class AwsIam(AwsBase):
 
-    def __init__(self, path, iam_path="."):
-        super().__init__(path=path)
-        self.logger.debug("Executing AwsIam Constructor")
-        self.iam_client = self.session.create_client('iam')
+    def __init__(self, path, iam_path=".", **kwargs):
+        super().__init__(path=path, **kwargs)
+        logger.debug("Executing AwsIam Constructor")
         self.assume_policy_path = "/".join([iam_path, RELATIVE_ASSUME_ROLE_POLICIES])
         self.role_policy_path = "/".join([iam_path, RELATIVE_ROLE_POLICIES])
+        self.iam_catalog = get_catalog(self.clients)
 
     def get_iam_role_policy_arn(self, policy_name):
-        try:
-            return next(p['Arn'] for p in self.iam_client.list_policies()['Policies'] \
-                if p['PolicyName'] == policy_name)
-        except StopIteration:
-            return 0
+        arn = self.iam_catalog.policy_arns([policy_name])[policy_name]
+        return arn or 0
+
+    def get_iam_role_policy_arns(self, policies):
+        """
+        Resolves policy names to ARNs in one pass over the IAM catalog; ARNs are returned
+        as they are. Raises KeyError naming every policy that does not exist.
+        """
+        names = [p for p in policies if not p.startswith('arn:')]
+        arns = self.iam_catalog.policy_arns(names) if names else {}
+        missing = [p for p, arn in arns.items() if arn is None]
+        if missing:
+            raise KeyError("Unknown IAM policies {}".format(missing))
+        return [arns.get(p, p) for p in policies]
 
     def create_iam_role(self, role_name, policy_attachments):
         try:
             role = next(r for r in self['Roles'] if r['RoleName'] == role_name)
-            try:
-                arole = next(r['RoleName'] for r in \
-                    self.iam_client.list_roles()['Roles'] \
-                    if r['RoleName'] == role_name)
-            except StopIteration:
+            if self.iam_catalog.role(role_name) is None:
                 self['Roles'].remove(role)
+                self.touch('Roles')
                 raise StopIteration
         except (StopIteration, KeyError):
             pfile = open("{}/{}.json".format(self.assume_policy_path, role_name))
             assume_policy = pfile.read().replace("\n", " ")
             pfile.close()
             try:
-                self.list_append('Roles', self.iam_client.create_role(
+                role = self.iam_client.create_role(
                     RoleName=role_name,
-                    AssumeRolePolicyDocument=assume_policy)['Role'])
+                    AssumeRolePolicyDocument=assume_policy)['Role']
             except ClientError as c:
                 if c.response['Error']['Code'] == 'EntityAlreadyExists':
-                    self.list_append(
-                        k='Roles',
-                        v=self.iam_client.get_role(RoleName=role_name)['Role'])
+                    role = self.iam_client.get_role(RoleName=role_name)['Role']
                 else:
                     raise
-        for policy in policy_attachments:
-            self.iam_client.attach_role_policy(RoleName=role_name, PolicyArn=policy)
+            self.iam_catalog.add_role(role)
+            self.list_append('Roles', role)
+        policy_arns = self.get_iam_role_policy_arns(policy_attachments)
+        parallel_map(lambda policy: self.iam_client.attach_role_policy(
+            RoleName=role_name, PolicyArn=policy), policy_arns)
         self.save()
 
     def delete_iam_roles(self):
         if 'Roles' not in self:
             return 0
-        roles = [r['RoleName'] for r in self['Roles']]
-        for role_name in roles:
-            policy_list = [p['PolicyArn'] for p in \
-                self.iam_client.list_attached_role_policies(
-                    RoleName=role_name)['AttachedPolicies']]
-            for policy in policy_list:
-                self.iam_client.detach_role_policy(RoleName=role_name, PolicyArn=policy)
+        def delete_iam_role(role_name):
+            paginator = self.iam_client.get_paginator('list_attached_role_policies')
+            policy_list = [p['PolicyArn'] for page in paginator.paginate(RoleName=role_name) \
+                for p in page['AttachedPolicies']]
+            parallel_map(lambda policy: self.iam_client.detach_role_policy(
+                RoleName=role_name, PolicyArn=policy), policy_list)
             self.iam_client.delete_role(RoleName=role_name)
+            self.iam_catalog.remove_role(role_name)
+        parallel_map(delete_iam_role, [r['RoleName'] for r in self['Roles']])
         del(self['Roles'])
         self.save()
@@ -0,0 +1,44 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# State keys whose resources carry tags worth indexing.
+INDEXED_KEYS=('Vpc', 'Subnets', 'RouteTables', 'InternetGateway', 'NatGateways',
+    'SecurityGroups', 'Instances', 'LaunchTemplates')
+
+class TagIndex(object):
+    """
+    TagIndex maps (state key, tag key, tag value) to the resources carrying that tag. The
+    entries of a state key are rebuilt whenever its value is replaced.
+
+    Methods:
+    rebuild - INTERNAL; replaces the entries of a state key.
+    add - INTERNAL; adds one resource to the entries of a state key.
+    get - USER; returns the resources of a state key carrying a tag.
+    values - USER; returns the values of a tag key across the resources of a state key.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.tags = {}
+
+    def rebuild(self, rtype, resources):
+        logger.debug("rebuild::%s", rtype)
+        for tag in self.tags.pop(rtype, ()):
+            del(self.entries[(rtype,) + tag])
+        if isinstance(resources, dict):
+            resources = [resources]
+        for r in resources or []:
+            self.add(rtype, r)
+
+    def add(self, rtype, resource):
+        for t in resource.get('Tags') or []:
+            tag = (t['Key'], t['Value'])
+            self.entries.setdefault((rtype,) + tag, []).append(resource)
+            self.tags.setdefault(rtype, set()).add(tag)
+
+    def get(self, rtype, key, value):
+        return list(self.entries.get((rtype, key, str(value)), ()))
+
+    def values(self, rtype, key):
+        return [v for k, v in self.tags.get(rtype, ()) if k == key]
@@ -0,0 +1,192 @@
+from bisect import bisect_left
+from contextvars import ContextVar
+from threading import Lock
+from time import monotonic
+import json
+import sys
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets, in seconds.
+BUCKETS=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+THROTTLE_CODES=frozenset(('Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+    'TooManyRequestsException', 'RequestThrottled', 'RequestThrottledException',
+    'SlowDown', 'PriorRequestNotComplete', 'EC2ThrottledException'))
+# Modules whose frames are plumbing rather than provisioning steps.
+PLUMBING_MODULES=frozenset(('subfish.base', 'subfish.cache', 'subfish.clients',
+    'subfish.metrics', 'subfish.taskgraph', 'subfish.poll', 'subfish.aio'))
+PATH_SEPARATOR=' > '
+
+# The caller path of the thread that handed work to a worker thread.
+_call_path = ContextVar('subfish_call_path', default=())
+
+def call_path(depth=1):
+    """
+    Returns the subfish methods on the stack of the calling thread, outermost first,
+    following work handed over from other threads by bind_call_path().
+    """
+    names = []
+    frame = sys._getframe(depth)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        name = frame.f_code.co_name
+        if module.startswith('subfish.') and module not in PLUMBING_MODULES \
+                and not name.startswith('<'):
+            if not names or names[-1] != name:
+                names.append(name)
+        frame = frame.f_back
+    path = _call_path.get() + tuple(reversed(names))
+    return tuple(n for i, n in enumerate(path) if i == 0 or path[i - 1] != n)
+
+def bind_call_path(func):
+    """Wraps func so calls made by it in another thread are attributed to this caller."""
+    path = call_path(2)
+    def bound(*args, **kwargs):
+        token = _call_path.set(path)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _call_path.reset(token)
+    return bound
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metrics(object):
+    """
+    Metrics records every API call made by the botocore clients it instruments, through
+    their event hooks: call counts, errors, retries, throttles and a latency histogram
+    per operation, and call counts and latency per subfish caller path.
+
+    Methods:
+    instrument - INTERNAL; registers the event hooks on a client.
+    snapshot - USER; returns every metric as a dictionary.
+    to_json - USER; returns every metric as JSON.
+    to_prometheus - USER; returns every metric in the Prometheus text format.
+    reset - USER; clears every metric.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+            self.callers = {}
+
+    def instrument(self, client):
+        events = getattr(client.meta, 'events', None)
+        if events is None:
+            return client
+        logger.debug("instrument::%s", client.meta.service_model.service_name)
+        events.register('before-call', self.before_call, unique_id='subfish-metrics-before')
+        events.register('after-call', self.after_call, unique_id='subfish-metrics-after')
+        events.register('after-call-error', self.after_call_error,
+            unique_id='subfish-metrics-error')
+        events.register('needs-retry', self.needs_retry, unique_id='subfish-metrics-retry')
+        return client
+
+    def operation(self, service, name):
+        key = (service, name)
+        op = self.operations.get(key)
+        if op is None:
+            op = self.operations[key] = {'calls': 0, 'errors': 0, 'retries': 0,
+                'throttles': 0, 'sum': 0.0, 'buckets': [0] * (len(BUCKETS) + 1)}
+        return op
+
+    def before_call(self, model=None, context=None, **kwargs):
+        if context is not None:
+            context['subfish_metrics'] = (model.service_model.service_name, model.name,
+                call_path(2), monotonic())
+
+    def after_call(self, http_response=None, parsed=None, context=None, **kwargs):
+        retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        error = http_response is not None and http_response.status_code >= 300
+        self.record(context, retries, error)
+
+    def after_call_error(self, context=None, **kwargs):
+        self.record(context, 0, True)
+
+    def needs_retry(self, response=None, operation=None, **kwargs):
+        if not response or operation is None:
+            return None
+        code = response[1].get('Error', {}).get('Code')
+        if code in THROTTLE_CODES:
+            with self.lock:
+                self.operation(operation.service_model.service_name,
+                    operation.name)['throttles'] += 1
+        return None
+
+    def record(self, context, retries, error):
+        call = (context or {}).pop('subfish_metrics', None)
+        if call is None:
+            return
+        service, name, path, start = call
+        elapsed = monotonic() - start
+        caller = PATH_SEPARATOR.join(path)
+        with self.lock:
+            op = self.operation(service, name)
+            op['calls'] += 1
+            op['errors'] += 1 if error else 0
+            op['retries'] += retries
+            op['sum'] += elapsed
+            op['buckets'][bisect_left(BUCKETS, elapsed)] += 1
+            c = self.callers.setdefault((caller, service, name),
+                {'calls': 0, 'errors': 0, 'sum': 0.0})
+            c['calls'] += 1
+            c['errors'] += 1 if error else 0
+            c['sum'] += elapsed
+
+    def snapshot(self):
+        with self.lock:
+            operations = [dict(v, service=s, operation=n, buckets=dict(
+                zip([str(b) for b in BUCKETS] + ['+Inf'], v['buckets']))) \
+                for (s, n), v in sorted(self.operations.items())]
+            callers = [dict(v, caller=c, service=s, operation=n) \
+                for (c, s, n), v in sorted(self.callers.items())]
+        return {'operations': operations, 'callers': callers}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.snapshot(), **kwargs)
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+        def metric(name, kind, help, samples):
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, value in samples:
+                lines.append("{}{{{}}} {}".format(name, ','.join('{}="{}"'.format(k,
+                    escape(v)) for k, v in labels), value))
+        ops = [((('service', o['service']), ('operation', o['operation'])), o) \
+            for o in snapshot['operations']]
+        metric('subfish_api_calls_total', 'counter', 'API calls made.',
+            [(l, o['calls']) for l, o in ops])
+        metric('subfish_api_call_errors_total', 'counter', 'API calls that failed.',
+            [(l, o['errors']) for l, o in ops])
+        metric('subfish_api_retries_total', 'counter', 'Retries made by botocore.',
+            [(l, o['retries']) for l, o in ops])
+        metric('subfish_api_throttles_total', 'counter', 'Throttled API call attempts.',
+            [(l, o['throttles']) for l, o in ops])
+        lines.append("# HELP subfish_api_call_duration_seconds API call latency.")
+        lines.append("# TYPE subfish_api_call_duration_seconds histogram")
+        for l, o in ops:
+            labels = ','.join('{}="{}"'.format(k, escape(v)) for k, v in l)
+            total = 0
+            for le, n in o['buckets'].items():
+                total = total + n
+                lines.append('subfish_api_call_duration_seconds_bucket{{{},le="{}"}} {}'.format(
+                    labels, le, total))
+            lines.append("subfish_api_call_duration_seconds_sum{{{}}} {}".format(labels,
+                o['sum']))
+            lines.append("subfish_api_call_duration_seconds_count{{{}}} {}".format(labels,
+                o['calls']))
+        callers = [((('caller', c['caller']), ('service', c['service']),
+            ('operation', c['operation'])), c) for c in snapshot['callers']]
+        metric('subfish_caller_api_calls_total', 'counter',
+            'API calls made per subfish caller path.', [(l, c['calls']) for l, c in callers])
+        metric('subfish_caller_api_call_seconds_total', 'counter',
+            'API call time per subfish caller path.', [(l, c['sum']) for l, c in callers])
+        return '\n'.join(lines) + '\n'
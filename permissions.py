@@ -0,0 +1,63 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Protocol numbers AWS may report in place of the names templates use.
+PROTOCOLS={'6': 'tcp', '17': 'udp', '1': 'icmp', '58': 'icmpv6', 'all': '-1'}
+# IpPermissions field -> key of the peer each of its entries names.
+PEER_FIELDS=(('IpRanges', 'CidrIp'), ('Ipv6Ranges', 'CidrIpv6'),
+    ('PrefixListIds', 'PrefixListId'), ('UserIdGroupPairs', 'GroupId'))
+
+def normalize_permissions(permissions):
+    """
+    Returns IpPermissions as a dictionary of rule to description. A rule is one
+    (protocol, from port, to port, peer field, peer) tuple, so permissions written with
+    different groupings, protocol numbers or extra response fields such as UserId compare
+    equal. Descriptions do not tell rules apart, the same way AWS does not.
+    """
+    rules = {}
+    for p in permissions or []:
+        protocol = str(p.get('IpProtocol', '-1')).lower()
+        protocol = PROTOCOLS.get(protocol, protocol)
+        ports = (None, None) if protocol == '-1' else (p.get('FromPort'), p.get('ToPort'))
+        for field, key in PEER_FIELDS:
+            for peer in p.get(field) or []:
+                rules[(protocol,) + ports + (field, peer.get(key))] = peer.get('Description')
+    return rules
+
+def to_permissions(rules):
+    """
+    Returns a dictionary of rule to description as IpPermissions, with one entry per
+    protocol and port range.
+    """
+    keys = dict(PEER_FIELDS)
+    permissions = {}
+    for rule in sorted(rules, key=repr):
+        protocol, from_port, to_port, field, peer = rule
+        p = permissions.get(rule[:3])
+        if p is None:
+            p = permissions[rule[:3]] = {'IpProtocol': protocol}
+            if protocol != '-1':
+                p['FromPort'], p['ToPort'] = from_port, to_port
+        entry = {keys[field]: peer}
+        if rules[rule]:
+            entry['Description'] = rules[rule]
+        p.setdefault(field, []).append(entry)
+    return list(permissions.values())
+
+def diff_permissions(desired, live):
+    """
+    Returns the IpPermissions to authorize and to revoke to turn the live permissions into
+    the desired ones, as two lists that are empty when nothing differs.
+    """
+    desired, live = normalize_permissions(desired), normalize_permissions(live)
+    add = dict((r, d) for r, d in desired.items() if r not in live)
+    remove = dict((r, d) for r, d in live.items() if r not in desired)
+    logger.debug("diff_permissions::%s to add::%s to remove", len(add), len(remove))
+    return to_permissions(add), to_permissions(remove)
+
+def referencing(permissions, group_ids):
+    """Returns the IpPermissions that name one of group_ids as their peer group."""
+    rules = normalize_permissions(permissions)
+    return to_permissions(dict((r, d) for r, d in rules.items() \
+        if r[3] == 'UserIdGroupPairs' and r[4] in group_ids))
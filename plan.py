@@ -0,0 +1,174 @@
+from subfish.taskgraph import TaskGraph
+import logging
+
+logger = logging.getLogger(__name__)
+
+AFFINITY_GROUP_TYPES=('private', 'public', 'public-private-access', 'private-access-public')
+PUBLIC_TYPES=('public', 'public-private-access')
+CIDR_BLOCK='10.0.0.0/16'
+
+def normalize_spec(spec):
+    """
+    Returns an environment spec with every field filled in. A spec is a dictionary with
+    'cidr_block', 'affinity_groups' as a list of (type, zones) pairs or {'type', 'zones'}
+    dictionaries, 'security_groups' as a list of group names and 'roles' as a dictionary
+    of role name to policy ARNs. Affinity groups are numbered in order, NAT gateway group
+    first, the same way create_affinity_groups numbers them.
+    """
+    groups = []
+    for g in spec.get('affinity_groups', []):
+        if isinstance(g, dict):
+            g = (g.get('type', 'private'), g.get('zones', 2))
+        t, z = g
+        if t not in AFFINITY_GROUP_TYPES:
+            raise ValueError("Unknown affinity group type {}".format(t))
+        groups.append((t, int(z)))
+    groups.sort(key=lambda g: g[0] != 'public-private-access')
+    if len([t for t, z in groups if t in PUBLIC_TYPES]) > 1:
+        raise ValueError("Cannot have two public affinity groups.")
+    if 'private-access-public' in [t for t, z in groups] \
+            and 'public-private-access' not in [t for t, z in groups]:
+        raise ValueError("No NAT gateway for a private-access-public affinity group.")
+    return {
+        'cidr_block': spec.get('cidr_block', CIDR_BLOCK),
+        'affinity_groups': groups,
+        'security_groups': list(spec.get('security_groups', [])),
+        'roles': dict(spec.get('roles', {}))}
+
+class Plan(object):
+    """
+    Plan is the set of changes that bring an environment to a spec, as a TaskGraph of
+    named tasks. An empty plan means the environment already matches the spec.
+
+    Methods:
+    changes - USER; returns the names of the planned tasks.
+    run - INTERNAL; runs the planned tasks.
+    """
+
+    def __init__(self, affinity_groups):
+        self.graph = TaskGraph()
+        self.affinity_groups = affinity_groups
+
+    def add(self, name, func, *args, deps=(), **kwargs):
+        return self.graph.add(name, func, *args, deps=deps, **kwargs)
+
+    def changes(self):
+        return list(self.graph.tasks)
+
+    def __len__(self):
+        return len(self.graph.tasks)
+
+    def run(self):
+        return self.graph.run()
+
+class Planner(object):
+    """
+    Planner diffs a declarative spec against the cached state of an AwsEks object and
+    plans only the calls needed to converge, so that applying the spec to an environment
+    that already matches it makes no API calls. Planning reads the cached state only; pass
+    refresh=True to apply() to refresh it first. Resources that are not in the spec are
+    left alone.
+
+    Methods:
+    plan - USER; returns the Plan that brings the environment to a spec.
+    apply - USER; plans and runs the changes for a spec.
+    plan_affinity_group - INTERNAL; plans the missing parts of one affinity group.
+    """
+
+    def __init__(self, aws):
+        self.aws = aws
+
+    def plan(self, spec):
+        logger.debug("plan::Executing")
+        aws = self.aws
+        spec = normalize_spec(spec)
+        plan = Plan(list(range(len(spec['affinity_groups']))))
+        vpc = None
+        if 'Vpc' not in aws:
+            vpc = plan.add('vpc', aws.create_vpc, cidr_block=spec['cidr_block'])
+        elif aws['Vpc']['CidrBlock'] != spec['cidr_block']:
+            raise ValueError("VPC {} has cidr block {}, not {}".format(aws['Vpc']['VpcId'],
+                aws['Vpc']['CidrBlock'], spec['cidr_block']))
+        nat_task, nat_af_group = None, None
+        for af, (t, z) in enumerate(spec['affinity_groups']):
+            task = self.plan_affinity_group(plan, af, t, z, vpc, nat_task, nat_af_group)
+            if t == 'public-private-access':
+                nat_task, nat_af_group = task, af
+        existing = [g['GroupName'] for g in aws.get('SecurityGroups', [])]
+        for sg_name in spec['security_groups']:
+            if sg_name not in existing:
+                plan.add("security_group-{}".format(sg_name), aws.create_security_group,
+                    sg_name, deps=(vpc,))
+        existing = [r['RoleName'] for r in aws.get('Roles', [])]
+        for role_name, policies in spec['roles'].items():
+            if role_name not in existing:
+                plan.add("iam_role-{}".format(role_name), aws.create_iam_role,
+                    role_name, policies)
+        logger.debug("plan::Returning::%s", plan.changes())
+        return plan
+
+    def plan_affinity_group(self, plan, af, type, zones, vpc, nat_task, nat_af_group):
+        """
+        Adds the tasks that complete one affinity group to a plan and returns the name of
+        the task that creates its NAT gateway, if the group needs one and has none.
+        """
+        aws = self.aws
+        subnets = aws.tagged('Subnets', 'affinity_group', af)
+        rts = aws.tagged('RouteTables', 'affinity_group', af)
+        new_subnets = []
+        if len(subnets) < zones:
+            cidrs = plan.add("cidr_blocks-{}".format(af), aws.allocate_af_cidr_blocks,
+                affinity_group=af, count=zones - len(subnets), deps=(vpc,))
+            new_subnets = [plan.add("subnet-{}-{}".format(af, i), aws.create_subnet,
+                affinity_group=af, deps=(cidrs,)) for i in range(len(subnets), zones)]
+        rt = None
+        if not rts:
+            rt = plan.add("route_table-{}".format(af), aws.create_route_table,
+                affinity_group=af, deps=(vpc,))
+        associated = set(a.get('SubnetId') for r in rts for a in r.get('Associations', []))
+        if new_subnets or rt or [s for s in subnets if s['SubnetId'] not in associated]:
+            plan.add("associate_rt_subnet-{}".format(af), aws.associate_rt_subnet,
+                affinity_group=af, deps=new_subnets + [rt])
+        igw = None
+        if type in PUBLIC_TYPES:
+            if not aws.tagged('InternetGateway', 'affinity_group', af):
+                igw = plan.add("internet_gateway-{}".format(af),
+                    aws.create_internet_gateway, affinity_group=af, deps=new_subnets + [rt])
+            elif new_subnets or [s for s in subnets if not s.get('MapPublicIpOnLaunch')]:
+                plan.add("map_public_ip_on_launch-{}".format(af),
+                    aws.map_public_ip_on_launch, affinity_group=af, deps=new_subnets)
+        if type == 'public-private-access' \
+                and not aws.tagged('NatGateways', 'affinity_group', af):
+            return plan.add("nat_gateway-{}".format(af), aws.create_nat_gateway,
+                affinity_group=af, deps=new_subnets + [igw])
+        if type == 'private-access-public':
+            ngw_id = aws.get_af_ngw(nat_af_group) if nat_task is None else None
+            routes = [r for table in rts for r in table.get('Routes', []) \
+                if r.get('DestinationCidrBlock') == '0.0.0.0/0']
+            if nat_task or rt or not [r for r in routes if r.get('NatGatewayId') == ngw_id]:
+                plan.add("nat_default_route-{}".format(af), aws.create_nat_default_route,
+                    rt_affinity_group=af, nat_affinity_group=nat_af_group,
+                    deps=(rt, nat_task))
+        return None
+
+    def apply(self, spec, refresh=False):
+        """
+        Brings the environment to a spec and returns the Plan that was run. With
+        refresh=True the cached state is refreshed before planning.
+        """
+        logger.debug("apply::Executing")
+        if refresh:
+            self.aws.refresh_vpc_environment()
+        plan = self.plan(spec)
+        if not plan:
+            logger.info("apply::Converged")
+            return plan
+        logger.info("apply::%s changes", len(plan))
+        with self.aws.write_behind():
+            try:
+                plan.run()
+            except Exception:
+                # Subnet tasks cancelled by the failure leave their placements behind.
+                self.aws.release_af_cidr_blocks(plan.affinity_groups)
+                raise
+        return plan
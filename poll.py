@@ -0,0 +1,112 @@
+from botocore.exceptions import ClientError
+from random import uniform
+from threading import Lock
+from time import monotonic, sleep
+import logging
+
+logger = logging.getLogger(__name__)
+
+BASE_DELAY=0.2
+MAX_DELAY=10
+DEADLINE=300
+
+class DeadlineExceeded(Exception):
+    pass
+
+class Poller(object):
+    """
+    Poller retries calls and polls conditions with capped exponential backoff and full
+    jitter until a deadline, and records how long each wait took.
+
+    Methods:
+    delays - INTERNAL; yields the backoff delays of one wait.
+    retry - USER; calls a function until it stops raising a retryable error.
+    wait_until - USER; calls a function until it returns a true value.
+    stats - USER; returns wait counts and durations per label.
+    """
+
+    def __init__(self, base=BASE_DELAY, cap=MAX_DELAY, deadline=DEADLINE):
+        self.base = base
+        self.cap = cap
+        self.deadline = deadline
+        self.waits = {}
+        self.lock = Lock()
+
+    def delays(self, base=None, cap=None):
+        base = base or self.base
+        cap = cap or self.cap
+        attempt = 0
+        while True:
+            yield uniform(0, min(cap, base * 2 ** attempt))
+            attempt = attempt + 1
+
+    def retryable(self, e, retry_on):
+        for r in retry_on:
+            if isinstance(r, str):
+                if isinstance(e, ClientError) and e.response['Error']['Code'] == r:
+                    return True
+            elif isinstance(e, r):
+                return True
+        return False
+
+    def record(self, label, start, attempts):
+        elapsed = monotonic() - start
+        logger.debug("record::%s::%.3fs::%s attempts", label, elapsed, attempts)
+        with self.lock:
+            w = self.waits.setdefault(label,
+                {'count': 0, 'attempts': 0, 'total': 0.0, 'max': 0.0})
+            w['count'] = w['count'] + 1
+            w['attempts'] = w['attempts'] + attempts
+            w['total'] = w['total'] + elapsed
+            w['max'] = max(w['max'], elapsed)
+
+    def retry(self, label, func, *args, retry_on=(), deadline=None, base=None, cap=None,
+            **kwargs):
+        """
+        Calls func(*args, **kwargs), retrying while it raises a ClientError whose code is in
+        retry_on, or an exception of a class in retry_on.
+        """
+        start = monotonic()
+        end = start + (deadline or self.deadline)
+        delays = self.delays(base, cap)
+        attempts = 0
+        while True:
+            attempts = attempts + 1
+            try:
+                res = func(*args, **kwargs)
+                break
+            except Exception as e:
+                if not self.retryable(e, retry_on):
+                    raise
+                delay = next(delays)
+                if monotonic() + delay > end:
+                    self.record(label, start, attempts)
+                    raise
+                logger.debug("retry::%s::%s::sleeping %.3fs", label, e, delay)
+                sleep(delay)
+        self.record(label, start, attempts)
+        return res
+
+    def wait_until(self, label, func, *args, deadline=None, base=None, cap=None, **kwargs):
+        """Calls func(*args, **kwargs) until it returns a true value, which is returned."""
+        start = monotonic()
+        end = start + (deadline or self.deadline)
+        delays = self.delays(base, cap)
+        attempts = 0
+        while True:
+            attempts = attempts + 1
+            res = func(*args, **kwargs)
+            if res:
+                break
+            delay = next(delays)
+            if monotonic() + delay > end:
+                self.record(label, start, attempts)
+                raise DeadlineExceeded("{} did not finish in time".format(label))
+            logger.debug("wait_until::%s::sleeping %.3fs", label, delay)
+            sleep(delay)
+        self.record(label, start, attempts)
+        return res
+
+    def stats(self):
+        with self.lock:
+            return dict((k, dict(v)) for k, v in self.waits.items())
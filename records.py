@@ -0,0 +1,139 @@
+from collections.abc import Mapping
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Fields kept of the items nested in a record, by record field.
+NESTED_FIELDS = {
+    'Associations': ('RouteTableAssociationId', 'SubnetId', 'Main', 'AssociationState'),
+    'Routes': ('DestinationCidrBlock', 'GatewayId', 'NatGatewayId', 'State', 'Origin')}
+
+class Record(Mapping):
+    """
+    Record is a resource kept in the state with only the FIELDS subfish reads, in slots
+    instead of a dictionary. It is read like the describe payload it was made from: fields
+    missing from the payload are missing from the record, and nested lists in
+    NESTED_FIELDS keep only the listed keys.
+
+    Reading any other key raises KeyError, and get() returns the default, so reading or
+    storing a record never calls AWS. full() hydrates the record: the full payload is
+    described again by id through the loader the state attached, once, and kept until the
+    record is replaced.
+
+    Methods:
+    from_payload - USER; builds a record from a describe or create payload.
+    full - USER; returns the full describe payload, hydrating the record if needed.
+    bind - INTERNAL; attaches the loader used to hydrate the record.
+    """
+
+    FIELDS = ()
+    # (operation, id parameter, result path) of the describe call that hydrates a record.
+    DESCRIBE = None
+    __slots__ = ('loader', 'payload')
+
+    def __init__(self, values=(), loader=None):
+        values = dict(values)
+        for f in self.FIELDS:
+            setattr(self, f, values.get(f))
+        self.loader = loader
+        self.payload = None
+
+    @classmethod
+    def from_payload(cls, payload, loader=None):
+        values = {}
+        for f in cls.FIELDS:
+            v = payload.get(f)
+            if f in NESTED_FIELDS and v is not None:
+                v = compact(v, NESTED_FIELDS[f])
+            values[f] = v
+        return cls(values, loader)
+
+    def bind(self, loader):
+        self.loader = loader
+        return self
+
+    def full(self):
+        if self.payload is None:
+            if self.loader is None:
+                raise KeyError("{} {} has no loader".format(type(self).__name__,
+                    self.get(self.FIELDS[0])))
+            logger.debug("full::Hydrating::%s", type(self).__name__)
+            self.payload = self.loader(self)
+        return self.payload
+
+    def __getitem__(self, k):
+        if k not in self.FIELDS:
+            raise KeyError(k)
+        v = getattr(self, k)
+        if v is None:
+            raise KeyError(k)
+        return v
+
+    def __contains__(self, k):
+        return k in self.FIELDS and getattr(self, k) is not None
+
+    def __iter__(self):
+        return (f for f in self.FIELDS if getattr(self, f) is not None)
+
+    def __len__(self):
+        return len([f for f in self.FIELDS if getattr(self, f) is not None])
+
+    def __setitem__(self, k, v):
+        if k not in self.FIELDS:
+            raise KeyError("{} does not keep {}".format(type(self).__name__, k))
+        setattr(self, k, v)
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, dict(self))
+
+    def __reduce__(self):
+        # Copies and pickles leave the loader and the hydrated payload behind.
+        return type(self), (dict(self),)
+
+def compact(items, fields):
+    """Returns a list of dictionaries holding only the given fields of each item."""
+    return [dict((f, i[f]) for f in fields if f in i) for i in items]
+
+def record_type(name, fields, describe):
+    """Returns a Record subclass with one slot per field."""
+    return type(name, (Record,), {'FIELDS': fields, 'DESCRIBE': describe,
+        '__slots__': fields, '__module__': __name__})
+
+SubnetRecord = record_type('SubnetRecord', ('SubnetId', 'VpcId', 'CidrBlock',
+    'AvailabilityZone', 'MapPublicIpOnLaunch', 'State', 'Tags'),
+    ('describe_subnets', 'SubnetIds', ('Subnets',)))
+RouteTableRecord = record_type('RouteTableRecord', ('RouteTableId', 'VpcId',
+    'Associations', 'Routes', 'Tags'),
+    ('describe_route_tables', 'RouteTableIds', ('RouteTables',)))
+SecurityGroupRecord = record_type('SecurityGroupRecord', ('GroupId', 'GroupName', 'VpcId',
+    'IpPermissions', 'IpPermissionsEgress', 'Tags'),
+    ('describe_security_groups', 'GroupIds', ('SecurityGroups',)))
+InstanceRecord = record_type('InstanceRecord', ('InstanceId', 'InstanceType', 'SubnetId',
+    'VpcId', 'PrivateIpAddress', 'PublicIpAddress', 'State', 'Tags'),
+    ('describe_instances', 'InstanceIds', ('Reservations', 'Instances')))
+LaunchTemplateRecord = record_type('LaunchTemplateRecord', ('LaunchTemplateId',
+    'LaunchTemplateName', 'DefaultVersionNumber', 'LatestVersionNumber', 'Tags'),
+    ('describe_launch_templates', 'LaunchTemplateIds', ('LaunchTemplates',)))
+
+# State key -> record type its resources are kept as.
+RECORD_TYPES = {
+    'Subnets': SubnetRecord,
+    'RouteTables': RouteTableRecord,
+    'SecurityGroups': SecurityGroupRecord,
+    'Instances': InstanceRecord,
+    'LaunchTemplates': LaunchTemplateRecord}
+
+def to_record(k, item, loader=None):
+    """Returns item as a record if state key k keeps records, or else unchanged."""
+    record = RECORD_TYPES.get(k)
+    if record is None or isinstance(item, record):
+        return item
+    return record.from_payload(item, loader)
+
+def plain(value):
+    """Returns a state value with its records turned into dictionaries, for storing."""
+    if isinstance(value, Record):
+        return dict(value)
+    if isinstance(value, list):
+        return [dict(v) if isinstance(v, Record) else v for v in value]
+    return value
@@ -0,0 +1,216 @@
+from subfish.records import plain
+from collections.abc import Mapping
+from datetime import datetime
+from os import path as os_path, replace, fsync
+from tempfile import NamedTemporaryFile
+from threading import Lock
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+SQLITE_EXTENSIONS=('.db', '.sqlite', '.sqlite3')
+
+# Field that identifies a resource stored under each state key.
+ID_FIELDS = {
+    'Vpc': 'VpcId',
+    'Subnets': 'SubnetId',
+    'RouteTables': 'RouteTableId',
+    'InternetGateway': 'InternetGatewayId',
+    'NatGateways': 'NatGatewayId',
+    'SecurityGroups': 'GroupId',
+    'Instances': 'InstanceId',
+    'LaunchTemplates': 'LaunchTemplateId',
+    'Roles': 'RoleName'}
+
+def _yaml():
+    # PyYAML takes longer to import than the rest of subfish; only YAML stores need it.
+    import yaml
+    return yaml
+
+def get_store(path):
+    """Returns the state store for a path, chosen by its file extension."""
+    if os_path.splitext(path)[1] in SQLITE_EXTENSIONS:
+        return SqliteStore(path)
+    return YamlStore(path)
+
+class YamlStore(object):
+    """
+    YamlStore keeps the whole state in one YAML file, rewritten in full on every write.
+
+    Methods:
+    load - USER; returns the stored state as a dictionary.
+    write - USER; stores the state; keys is the set of keys that changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.writes = 0
+
+    def load(self):
+        logger.debug("load::Executing")
+        try:
+            with open(self.path) as f:
+                yaml = _yaml()
+                return yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)) or {}
+        except FileNotFoundError:
+            logger.debug("load::No state::%s", self.path)
+            return {}
+
+    def write(self, state, keys):
+        logger.debug("write::Executing")
+        # Write a sibling file and rename it so a crash never leaves a partial state file.
+        directory = os_path.dirname(os_path.abspath(self.path))
+        with NamedTemporaryFile('w', dir=directory, delete=False,
+                prefix='.{}.'.format(os_path.basename(self.path))) as f:
+            yaml = _yaml()
+            yaml.dump(dict((k, plain(v)) for k, v in state.items()), f, Dumper=getattr(yaml, 'CSafeDumper', yaml.SafeDumper),
+                default_flow_style=False)
+            f.flush()
+            fsync(f.fileno())
+        replace(f.name, self.path)
+        self.writes = self.writes + 1
+
+def _default(o):
+    if isinstance(o, datetime):
+        return {'$datetime': o.isoformat()}
+    if isinstance(o, Mapping):
+        return dict(o)
+    raise TypeError("Cannot serialize {}".format(type(o)))
+
+def _object_hook(o):
+    if len(o) == 1 and '$datetime' in o:
+        return datetime.fromisoformat(o['$datetime'])
+    return o
+
+def dumps(v):
+    return json.dumps(v, default=_default, sort_keys=True, separators=(',', ':'))
+
+def loads(s):
+    return json.loads(s, object_hook=_object_hook)
+
+class SqliteStore(object):
+    """
+    SqliteStore keeps one row per resource, indexed by state key, VPC id and affinity_group
+    tag. Only rows whose content changed since this store last loaded or wrote them are
+    written, and only rows it knew of are removed, so rows another process added to the
+    same key are kept. The database runs in WAL mode, so readers in other processes are
+    never blocked, and writers are serialized by an immediate transaction.
+
+    Methods:
+    load - USER; returns the stored state as a dictionary.
+    write - USER; stores the changed keys of the state.
+    query - USER; returns resources matching a state key, VPC id or affinity group.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS state_keys (
+            key TEXT PRIMARY KEY,
+            is_list INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS resources (
+            key TEXT NOT NULL,
+            id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            vpc_id TEXT,
+            affinity_group TEXT,
+            body TEXT NOT NULL,
+            PRIMARY KEY (key, id));
+        CREATE INDEX IF NOT EXISTS resources_vpc_id ON resources (vpc_id);
+        CREATE INDEX IF NOT EXISTS resources_affinity_group ON resources (key, affinity_group);
+        """
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.writes = 0
+        self.lock = Lock()
+        # State key -> {id: (position, body)} of the rows last loaded or written.
+        self.known = {}
+        import sqlite3
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None,
+            check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+
+    def rows(self, key, value):
+        items = value if isinstance(value, list) else [value]
+        for position, item in enumerate(items):
+            rid, vpc_id, af = str(position), None, None
+            if isinstance(item, Mapping):
+                rid = str(item.get(ID_FIELDS.get(key), position))
+                vpc_id = item.get('VpcId')
+                af = next((t['Value'] for t in item.get('Tags') or [] \
+                    if t.get('Key') == 'affinity_group'), None)
+            yield rid, position, vpc_id, af, dumps(item)
+
+    def load(self):
+        logger.debug("load::Executing")
+        with self.lock:
+            keys = self.conn.execute("SELECT key, is_list FROM state_keys").fetchall()
+            rows = self.conn.execute("SELECT key, id, position, body FROM resources "
+                "ORDER BY key, position").fetchall()
+            self.known = {}
+            for k, rid, position, body in rows:
+                self.known.setdefault(k, {})[rid] = (position, body)
+        state = dict((k, []) for k, is_list in keys if is_list)
+        for k, rid, position, body in rows:
+            if k in state:
+                state[k].append(loads(body))
+            else:
+                state[k] = loads(body)
+        return state
+
+    def write(self, state, keys):
+        logger.debug("write::Executing::%s", sorted(keys))
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                written = dict((k, self.write_key(k, state.get(k))) for k in keys)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.known.update(written)
+        self.writes = self.writes + 1
+
+    def write_key(self, key, value):
+        """
+        Writes the rows of one state key that differ from the ones this store knew of, and
+        returns the rows it now knows of.
+        """
+        known = dict(self.known.get(key, {}))
+        rows = {}
+        changed = []
+        if value is not None:
+            self.conn.execute("INSERT OR REPLACE INTO state_keys (key, is_list) VALUES (?, ?)",
+                (key, int(isinstance(value, list))))
+            for rid, position, vpc_id, af, body in self.rows(key, value):
+                rows[rid] = (position, body)
+                if known.pop(rid, None) != (position, body):
+                    changed.append((key, rid, position, vpc_id, af, body))
+        logger.debug("write_key::%s::changed::%s::removed::%s", key, len(changed), len(known))
+        self.conn.executemany("INSERT OR REPLACE INTO resources "
+            "(key, id, position, vpc_id, affinity_group, body) VALUES (?, ?, ?, ?, ?, ?)",
+            changed)
+        self.conn.executemany("DELETE FROM resources WHERE key = ? AND id = ?",
+            [(key, rid) for rid in known])
+        if value is None:
+            # The key stays while another process still keeps rows under it.
+            self.conn.execute("DELETE FROM state_keys WHERE key = ? AND NOT EXISTS "
+                "(SELECT 1 FROM resources WHERE key = ?)", (key, key))
+        return rows
+
+    def query(self, key=None, vpc_id=None, affinity_group=None):
+        logger.debug("query::%s::%s::%s", key, vpc_id, affinity_group)
+        clauses, args = [], []
+        for column, value in (('key', key), ('vpc_id', vpc_id),
+                ('affinity_group', affinity_group)):
+            if value is not None:
+                clauses.append("{} = ?".format(column))
+                args.append(str(value))
+        sql = "SELECT body FROM resources"
+        if clauses:
+            sql = "{} WHERE {}".format(sql, " AND ".join(clauses))
+        with self.lock:
+            rows = self.conn.execute(sql + " ORDER BY key, position", args).fetchall()
+        return [loads(body) for body, in rows]
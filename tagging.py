@@ -0,0 +1,69 @@
+from threading import Lock
+import logging
+
+logger = logging.getLogger(__name__)
+
+# create_tags accepts at most this many resources per call.
+MAX_RESOURCES=1000
+# Tagging right after creation can race the resource becoming visible.
+NOT_FOUND_CODES=('InvalidID.NotFound', 'InvalidVpcID.NotFound', 'InvalidSubnetID.NotFound',
+    'InvalidRouteTableID.NotFound', 'InvalidInternetGatewayID.NotFound',
+    'InvalidNatGatewayID.NotFound', 'InvalidGroup.NotFound', 'InvalidAllocationID.NotFound')
+
+def tag_list(tags):
+    """Returns a dictionary of tags as an AWS tag list."""
+    return [{'Key': k, 'Value': str(v)} for k, v in sorted(tags.items())]
+
+def tag_specifications(resource_type, tags):
+    """Returns the TagSpecifications argument of a create call, or nothing if no tags."""
+    if not tags:
+        return {}
+    return {'TagSpecifications': [{'ResourceType': resource_type, 'Tags': tag_list(tags)}]}
+
+class TagBatcher(object):
+    """
+    TagBatcher collects tags for resources that already exist and applies them with as few
+    create_tags calls as possible: resources that get the same tags share a call, up to
+    MAX_RESOURCES per call.
+
+    Methods:
+    add - USER; queues tags for some resources.
+    flush - USER; applies every queued tag and returns the number of create_tags calls.
+    """
+
+    def __init__(self, clients, poller):
+        self.clients = clients
+        self.poller = poller
+        self.pending = {}
+        self.lock = Lock()
+
+    def add(self, resource_ids, tags):
+        logger.debug("add::%s::%s", resource_ids, tags)
+        if not tags:
+            return
+        key = tuple(sorted((k, str(v)) for k, v in tags.items()))
+        with self.lock:
+            self.pending.setdefault(key, set()).update(resource_ids)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        calls = 0
+        for key, resource_ids in pending.items():
+            resource_ids = sorted(resource_ids)
+            for i in range(0, len(resource_ids), MAX_RESOURCES):
+                res = self.poller.retry('create_tags', self.clients.get('ec2').create_tags,
+                    Resources=resource_ids[i:i + MAX_RESOURCES],
+                    Tags=tag_list(dict(key)),
+                    retry_on=NOT_FOUND_CODES)
+                logger.debug("flush::create_tags::meta::%s", res['ResponseMetadata'])
+                calls = calls + 1
+        logger.debug("flush::%s calls", calls)
+        return calls
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.flush()
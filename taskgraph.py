@@ -0,0 +1,85 @@
+from subfish.metrics import bind_call_path
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS=8
+
+class TaskGraph(object):
+    """
+    TaskGraph runs a set of named tasks on a worker pool, starting each task as soon as
+    every task it depends on has finished.
+
+    Methods:
+    add - USER; adds a task with the names of the tasks it depends on.
+    run - USER; runs every task and returns a dictionary of task name to result.
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS):
+        self.max_workers = max_workers
+        self.tasks = {}
+
+    def add(self, name, func, *args, deps=(), **kwargs):
+        logger.debug("add::%s::deps::%s", name, deps)
+        if name in self.tasks:
+            raise ValueError("Duplicate task {}".format(name))
+        self.tasks[name] = (func, args, kwargs, tuple(d for d in deps if d is not None))
+        return name
+
+    def check(self):
+        logger.debug("check::Executing")
+        for name, (func, args, kwargs, deps) in self.tasks.items():
+            for d in deps:
+                if d not in self.tasks:
+                    raise KeyError("Task {} depends on unknown task {}".format(name, d))
+        done = set()
+        pending = dict((n, set(t[3])) for n, t in self.tasks.items())
+        while pending:
+            ready = [n for n, d in pending.items() if d <= done]
+            if not ready:
+                raise ValueError("Dependency cycle between {}".format(sorted(pending)))
+            for n in ready:
+                done.add(n)
+                del(pending[n])
+
+    def run(self):
+        logger.debug("run::Executing::%s tasks", len(self.tasks))
+        self.check()
+        results = {}
+        waiting = dict((n, set(t[3])) for n, t in self.tasks.items())
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while waiting or running:
+                for name in [n for n, d in waiting.items() if not d - set(results)]:
+                    func, args, kwargs, deps = self.tasks[name]
+                    logger.debug("run::Starting::%s", name)
+                    running[pool.submit(bind_call_path(func), *args, **kwargs)] = name
+                    del(waiting[name])
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception:
+                        logger.error("run::Failed::%s", name)
+                        for f in running:
+                            f.cancel()
+                        raise
+                    logger.debug("run::Finished::%s", name)
+        return results
+
+def parallel_map(func, items, max_workers=MAX_WORKERS):
+    """
+    Calls func on every item concurrently and returns the results in order. The first
+    exception raised by any call is re-raised once every call has finished.
+    """
+    items = list(items)
+    logger.debug("parallel_map::%s::%s items", getattr(func, '__name__', func), len(items))
+    if len(items) < 2:
+        return [func(i) for i in items]
+    bound = bind_call_path(func)
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as pool:
+        futures = [pool.submit(bound, i) for i in items]
+        wait(futures)
+    return [f.result() for f in futures]
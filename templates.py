@@ -0,0 +1,94 @@
+from collections import OrderedDict
+from copy import deepcopy
+from os import listdir, stat
+from os.path import abspath
+from threading import Lock
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_CACHE_SIZE=400
+RENDER_CACHE_SIZE=256
+
+_stores = {}
+_stores_lock = Lock()
+
+def get_template_store(path):
+    """Returns the TemplateStore of a directory, shared by every object that uses it."""
+    path = abspath(path)
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = TemplateStore(path)
+        return _stores[path]
+
+class TemplateStore(object):
+    """
+    TemplateStore renders the .json.j2 templates of one directory. Templates are compiled
+    once by a shared jinja2 Environment, which checks the file mtime before reusing a
+    compiled template and keeps compiled bytecode on disk between runs. The directory
+    listing is indexed and only read again when the directory mtime changes, and parsed
+    results are cached per template and variables.
+
+    Methods:
+    names - USER; returns the file names in the directory.
+    has - USER; checks whether the directory has a template.
+    render_json - USER; renders a template and returns the parsed JSON.
+    """
+
+    def __init__(self, path, bytecode_cache=None):
+        logger.debug("__init__::%s", path)
+        self.path = path
+        self.bytecode_cache = bytecode_cache
+        self._env = None
+        self.index = ()
+        self.index_mtime = None
+        self.rendered = OrderedDict()
+        self.lock = Lock()
+
+    @property
+    def env(self):
+        # jinja2 is imported with the first template rendered, not with subfish.
+        if self._env is None:
+            from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+            with self.lock:
+                if self._env is None:
+                    self._env = Environment(
+                        loader=FileSystemLoader(self.path),
+                        auto_reload=True,
+                        cache_size=TEMPLATE_CACHE_SIZE,
+                        bytecode_cache=self.bytecode_cache or FileSystemBytecodeCache())
+        return self._env
+
+    def names(self):
+        try:
+            mtime = stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return ()
+        with self.lock:
+            if mtime != self.index_mtime:
+                logger.debug("names::Indexing::%s", self.path)
+                self.index = frozenset(listdir(self.path))
+                self.index_mtime = mtime
+            return self.index
+
+    def has(self, name):
+        return name in self.names()
+
+    def render_json(self, name, variables=None):
+        logger.debug("render_json::%s", name)
+        variables = variables or {}
+        # Up to date, so a changed file yields a new template and misses the cache.
+        template = self.env.get_template(name)
+        key = (name, json.dumps(variables, sort_keys=True, default=str))
+        with self.lock:
+            hit = self.rendered.get(key)
+            if hit is not None and hit[0] is template:
+                self.rendered.move_to_end(key)
+                return deepcopy(hit[1])
+        data = json.loads(template.render(variables))
+        with self.lock:
+            self.rendered[key] = (template, data)
+            while len(self.rendered) > RENDER_CACHE_SIZE:
+                self.rendered.popitem(last=False)
+        return deepcopy(data)
@@ -0,0 +1,255 @@
+"""
+Offline provisioning benchmarks. Each scenario runs against the stub backend in
+test/stub.py with injected per-call latency and reports its wall-clock time, the
+API calls it made and the state file writes it caused. The run fails when a scenario
+goes over its budget, so that changes making provisioning chattier or slower show up.
+
+    python bench.py [--latency 0.01] [--op-latency CreateNatGateway=0.2] [--self-check]
+        [--json]
+
+Time budgets scale with --latency; per-operation latencies are not budgeted for.
+With --record DIR every scenario is also saved as a cassette, and with --replay DIR the
+scenarios are answered from those cassettes instead of the stub, so a run recorded with
+one version can be played against another and their call profiles compared. Recorded
+and replayed runs poll without jitter, batch waits over a wider tick and leave the
+response cache off, whose hits depend on timing, so only the code decides the calls.
+With --self-check every scenario is recorded and then replayed at the recorded speed,
+and the run fails when the replay calls any operation a different number of times.
+"""
+from os import path as os_path, chdir, getcwd
+from sys import path, exit
+from tempfile import TemporaryDirectory
+from time import monotonic
+from glob import glob
+import argparse
+import json
+import logging
+
+TEST_PATH = os_path.dirname(os_path.abspath(__file__))
+path.insert(0, os_path.dirname(os_path.dirname(TEST_PATH)))
+from subfish.eks import AwsEks
+from subfish.poll import Poller
+from subfish.cassette import Recorder, Player, profile, compare_profiles
+from stub import StubBackend, StubSession
+
+LATENCY=0.01
+WAIT_BASE=0.01
+# Waits submitted within this many seconds share a tick in recorded and replayed runs, so
+# that a replay drifting by a few milliseconds still batches them the way the recording did.
+REPLAY_WAIT_BASE=0.05
+# Seconds added to every time budget for scheduling noise.
+SLACK=0.1
+ENVIRONMENT=[('public-private-access', 2), ('private-access-public', 2), ('private', 2)]
+
+# Scenario -> (API calls, state writes, seconds at LATENCY). Seconds scale with latency.
+# Waiters poll on a timer, so the describe calls of a run vary by a few.
+BUDGETS = {
+    'create_vpc_environment': (58, 3, 0.9),
+    'create_affinity_group-private': (16, 2, 0.3),
+    'create_affinity_group-public': (24, 2, 0.4),
+    'create_affinity_group-public-private-access': (30, 3, 0.5),
+    'create_affinity_group-private-access-public': (16, 2, 0.3),
+    'launch_templates': (9, 3, 0.25),
+    'security_groups': (21, 6, 0.35),
+    'destroy_vpc_environment': (25, 2, 0.25),
+    'apply_converged': (0, 0, 0.05)}
+
+def setup_vpc(aws):
+    aws.create_vpc()
+
+def setup_nat(aws):
+    aws.create_vpc_environment(affinity_groups=[('public-private-access', 2)])
+
+def setup_environment(aws):
+    aws.create_vpc_environment(affinity_groups=ENVIRONMENT)
+
+def teardown(aws):
+    aws.destroy_vpc_environment()
+
+def affinity_group(type):
+    return lambda aws: aws.create_affinity_group(type, 2)
+
+def launch_templates(aws):
+    aws.create_launch_template('HelloWorld')
+    # A new version keeps the key pair created with the template.
+    key_name = glob('.instance_key-*')[0][len('.instance_key-'):]
+    aws.modify_launch_template('HelloWorld', {'key_name': key_name})
+    aws.delete_launch_templates()
+
+SECURITY_GROUPS=('bastion', 'worker', 'control', 'alb')
+
+def security_groups(aws):
+    for sg_name in SECURITY_GROUPS:
+        aws.create_security_group(sg_name)
+    groups = dict((sg_name, {}) for sg_name in SECURITY_GROUPS)
+    aws.sync_security_group_rules(groups)
+    # A re-run finds nothing to change.
+    aws.sync_security_group_rules(groups)
+    # The groups' rules reference each other.
+    aws.delete_security_groups()
+
+# Scenario -> (unmeasured setup, measured run, unmeasured teardown)
+SCENARIOS = {
+    'create_vpc_environment': (None,
+        lambda aws: aws.create_vpc_environment(affinity_groups=ENVIRONMENT), teardown),
+    'create_affinity_group-private': (setup_vpc, affinity_group('private'), teardown),
+    'create_affinity_group-public': (setup_vpc, affinity_group('public'), teardown),
+    'create_affinity_group-public-private-access': (setup_vpc,
+        affinity_group('public-private-access'), teardown),
+    'create_affinity_group-private-access-public': (setup_nat,
+        affinity_group('private-access-public'), teardown),
+    'launch_templates': (None, launch_templates, None),
+    'security_groups': (setup_vpc, security_groups, teardown),
+    'destroy_vpc_environment': (setup_environment, teardown, None),
+    'apply_converged': (setup_environment,
+        lambda aws: aws.create_vpc_environment(affinity_groups=ENVIRONMENT), teardown)}
+
+def api_calls(metrics):
+    calls = {}
+    for op in metrics.snapshot()['operations']:
+        name = op['operation'] if op['service'] == 'ec2' \
+            else "{}.{}".format(op['service'], op['operation'])
+        calls[name] = op['calls']
+    return calls
+
+class SteadyPoller(Poller):
+    """Poller without jitter, so a recording and its replay batch their waits the same."""
+
+    def delays(self, base=None, cap=None):
+        base = base or self.base
+        cap = cap or self.cap
+        attempt = 0
+        while True:
+            yield min(cap, base * 2 ** attempt)
+            attempt = attempt + 1
+
+def run_scenario(name, latency, latencies, wait_base, record=None, replay=None,
+        speed=None, poller=Poller, cache=True):
+    """
+    Runs a scenario and returns its result. Recorded and replayed runs pass cache=False:
+    whether a read hits the response cache depends on how it overlaps with mutations to
+    the microsecond, which a replay does not reproduce. They also pass SteadyPoller.
+    """
+    setup, run, cleanup = SCENARIOS[name]
+    backend = StubBackend(latency, latencies)
+    cassette = "{}.json.gz".format(name)
+    with TemporaryDirectory() as directory:
+        cwd = getcwd()
+        # Launch templates write their key pairs to the working directory.
+        chdir(directory)
+        try:
+            aws = AwsEks(os_path.join(directory, 'state.yml'), config_path=TEST_PATH,
+                session=StubSession(backend), poller=poller(base=wait_base))
+            aws.wait_mux.base = wait_base
+            if not cache:
+                aws.clients.cache = None
+            if record:
+                recorder = aws.clients.instrument(Recorder(os_path.join(record, cassette)))
+            if replay:
+                player = aws.clients.instrument(Player(os_path.join(replay, cassette),
+                    speed=speed))
+            if setup:
+                setup(aws)
+            aws.metrics.reset()
+            writes = aws.store.writes
+            start = monotonic()
+            run(aws)
+            elapsed = monotonic() - start
+            calls = api_calls(aws.metrics)
+            result = {'scenario': name, 'seconds': round(elapsed, 4),
+                'api_calls': sum(calls.values()), 'state_writes': aws.store.writes - writes,
+                'calls': dict(sorted(calls.items()))}
+            if cleanup:
+                cleanup(aws)
+            if record:
+                recorder.save()
+            if replay:
+                # Operations this version calls a different number of times than the
+                # recorded one, over the whole scenario.
+                result['changed'] = dict((op, (b['calls'], a['calls'])) for op, (b, a) \
+                    in compare_profiles(profile(player.interactions),
+                        player.profile()).items())
+        finally:
+            chdir(cwd)
+    return result
+
+def over_budget(result, latency):
+    """Returns the budgets a scenario result goes over, as a list of messages."""
+    calls, writes, seconds = BUDGETS[result['scenario']]
+    seconds = seconds * max(latency / LATENCY, 1) + SLACK
+    failures = []
+    if result['api_calls'] > calls:
+        failures.append("{} API calls > {}".format(result['api_calls'], calls))
+    if result['state_writes'] > writes:
+        failures.append("{} state writes > {}".format(result['state_writes'], writes))
+    if result['seconds'] > seconds:
+        failures.append("{:.3f}s > {:.3f}s".format(result['seconds'], seconds))
+    return failures
+
+def parse_latencies(values):
+    latencies = {}
+    for v in values or []:
+        api, _, seconds = v.partition('=')
+        latencies[api] = float(seconds)
+    return latencies
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--latency', type=float, default=LATENCY,
+        help="seconds each API call takes")
+    parser.add_argument('--op-latency', action='append', metavar='API=SECONDS',
+        help="seconds one API operation takes, e.g. CreateNatGateway=0.2")
+    parser.add_argument('--wait-base', type=float, default=WAIT_BASE,
+        help="base delay of the resource state waiter")
+    parser.add_argument('--record', metavar='DIR', help="save a cassette per scenario")
+    parser.add_argument('--replay', metavar='DIR',
+        help="answer every call from the cassettes in DIR")
+    parser.add_argument('--speed', type=float,
+        help="replay at the recorded latency divided by SPEED, instantly if not given")
+    parser.add_argument('--self-check', action='store_true',
+        help="record each scenario, replay it and fail if the replay made other calls")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+        help="run only this scenario")
+    parser.add_argument('--no-budgets', action='store_true', help="report only")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.CRITICAL)
+    latencies = parse_latencies(args.op_latency)
+    results = []
+    wait_base, options = args.wait_base, {}
+    if args.self_check or args.record or args.replay:
+        wait_base = max(args.wait_base, REPLAY_WAIT_BASE)
+        options = {'poller': SteadyPoller, 'cache': False}
+    for name in args.scenario or SCENARIOS:
+        if args.self_check:
+            with TemporaryDirectory() as cassettes:
+                run_scenario(name, args.latency, latencies, wait_base, record=cassettes,
+                    **options)
+                result = run_scenario(name, args.latency, latencies, wait_base,
+                    replay=cassettes, speed=args.speed or 1, **options)
+        else:
+            result = run_scenario(name, args.latency, latencies, wait_base,
+                record=args.record and os_path.abspath(args.record),
+                replay=args.replay and os_path.abspath(args.replay), speed=args.speed,
+                **options)
+        result['over_budget'] = [] if args.no_budgets \
+            else over_budget(result, args.latency)
+        if args.self_check and result['changed']:
+            result['over_budget'].append("replay changed {}".format(
+                ', '.join(result['changed'])))
+        results.append(result)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("{:<45} {:>9} {:>9} {:>7}".format('scenario', 'seconds', 'api calls',
+            'writes'))
+        for r in results:
+            print("{:<45} {:>9.3f} {:>9} {:>7}  {}".format(r['scenario'], r['seconds'],
+                r['api_calls'], r['state_writes'], '; '.join(r['over_budget'])))
+            for op, (before, after) in r.get('changed', {}).items():
+                print("    {}: {} calls recorded, {} replayed".format(op, before, after))
+    return 1 if [r for r in results if r['over_budget']] else 0
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,103 @@
+"""
+Cold start benchmark. Each run starts a fresh interpreter that imports subfish.eks,
+builds an AwsEks on an existing state file and reads one field from it, the way a
+short-lived CLI or cron invocation does, and reports how long each step took and which
+heavy modules it loaded. The run fails when a step goes over its budget or a module
+that should be deferred was imported.
+
+    python startup.py [--runs 10] [--state yml|db] [--json]
+
+The state file is built once against the stub backend in test/stub.py.
+"""
+from os import path as os_path
+from sys import path, exit, executable
+from statistics import median
+from subprocess import run
+from tempfile import TemporaryDirectory
+import argparse
+import json
+
+TEST_PATH = os_path.dirname(os_path.abspath(__file__))
+ROOT_PATH = os_path.dirname(os_path.dirname(TEST_PATH))
+path.insert(0, ROOT_PATH)
+
+RUNS=10
+# Step -> seconds, as the median over the runs.
+BUDGETS = {
+    'import': 0.15,
+    'construct': 0.01,
+    'query': 0.05}
+# Modules a read-only query must not import, by state store.
+DEFERRED = {
+    'yml': ('botocore.session', 'botocore.client', 'botocore.config', 'jinja2',
+        'sqlite3', 'ipaddress'),
+    'db': ('botocore.session', 'botocore.client', 'botocore.config', 'jinja2', 'yaml',
+        'ipaddress')}
+
+CHILD = """
+from time import perf_counter
+import json, sys
+sys.path.insert(0, {root!r})
+start = perf_counter()
+from subfish.eks import AwsEks
+imported = perf_counter()
+aws = AwsEks({state!r}, config_path={config!r})
+constructed = perf_counter()
+vpc_id = aws['Vpc']['VpcId']
+queried = perf_counter()
+print(json.dumps({{'import': imported - start, 'construct': constructed - imported,
+    'query': queried - constructed, 'vpc_id': vpc_id,
+    'modules': [m for m in {deferred!r} if m in sys.modules]}}))
+"""
+
+def build_state(state):
+    from subfish.eks import AwsEks
+    from subfish.poll import Poller
+    from stub import StubBackend, StubSession
+    aws = AwsEks(state, config_path=TEST_PATH, session=StubSession(StubBackend(0)),
+        poller=Poller(base=0.001))
+    aws.wait_mux.base = 0.001
+    aws.create_vpc_environment(affinity_groups=[('public-private-access', 2),
+        ('private', 2)])
+    return aws['Vpc']['VpcId']
+
+def cold_start(state, kind):
+    code = CHILD.format(root=ROOT_PATH, state=state, config=TEST_PATH,
+        deferred=DEFERRED[kind])
+    res = run([executable, '-c', code], capture_output=True, text=True, check=True)
+    return json.loads(res.stdout)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=RUNS)
+    parser.add_argument('--state', choices=sorted(DEFERRED), default='yml',
+        help="state store to read from")
+    parser.add_argument('--no-budgets', action='store_true', help="report only")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args(argv)
+    with TemporaryDirectory() as directory:
+        state = os_path.join(directory, 'state.{}'.format(args.state))
+        vpc_id = build_state(state)
+        runs = [cold_start(state, args.state) for n in range(args.runs)]
+    failures = []
+    result = {'state': args.state, 'runs': args.runs}
+    for step, budget in BUDGETS.items():
+        result[step] = round(median(r[step] for r in runs), 4)
+        if not args.no_budgets and result[step] > budget:
+            failures.append("{} {:.3f}s > {:.3f}s".format(step, result[step], budget))
+    result['modules'] = sorted(set(m for r in runs for m in r['modules']))
+    if result['modules']:
+        failures.append("imported {}".format(', '.join(result['modules'])))
+    if [r for r in runs if r['vpc_id'] != vpc_id]:
+        failures.append("read the wrong VPC")
+    result['over_budget'] = failures
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print("{:<10} {:>9} {:>9} {:>9}".format('state', 'import', 'construct', 'query'))
+        print("{:<10} {:>9.4f} {:>9.4f} {:>9.4f}  {}".format(result['state'],
+            result['import'], result['construct'], result['query'], '; '.join(failures)))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,743 @@
+"""
+In-memory stand-ins for the EC2, IAM and EKS APIs used by subfish, for running
+provisioning flows offline. Pass StubSession(backend) as the session of any subfish
+object; every call goes through the client's botocore event hooks, sleeps for the
+injected latency and is counted by the backend.
+"""
+from botocore.exceptions import ClientError
+from botocore.hooks import HierarchicalEmitter
+from collections import Counter
+from copy import deepcopy
+from itertools import count
+from threading import RLock
+from time import sleep
+import functools
+
+PAGE_SIZE=1000
+ZONES=('us-east-1a', 'us-east-1b', 'us-east-1c')
+# Operations that can be paginated, with their request and response token names.
+PAGINATED = {
+    'describe_vpcs': 'NextToken', 'describe_subnets': 'NextToken',
+    'describe_route_tables': 'NextToken', 'describe_internet_gateways': 'NextToken',
+    'describe_nat_gateways': 'NextToken', 'describe_security_groups': 'NextToken',
+    'describe_instances': 'NextToken', 'describe_launch_templates': 'NextToken',
+    'list_roles': 'Marker', 'list_policies': 'Marker',
+    'list_attached_role_policies': 'Marker', 'list_clusters': 'NextToken'}
+PEER_FIELDS=('IpRanges', 'Ipv6Ranges', 'PrefixListIds', 'UserIdGroupPairs')
+ACCOUNT_ID='000000000000'
+# Filter name -> resource field, for the filters subfish uses.
+FILTER_FIELDS = {
+    'vpc-id': 'VpcId', 'subnet-id': 'SubnetId', 'instance-id': 'InstanceId',
+    'nat-gateway-id': 'NatGatewayId', 'state': 'State', 'group-name': 'GroupName',
+    'launch-template-name': 'LaunchTemplateName'}
+
+def error(code, message=None, status=400):
+    return {'Error': {'Code': code, 'Message': message or code},
+        'ResponseMetadata': {'HTTPStatusCode': status, 'RetryAttempts': 0}}
+
+def fail(code, operation, message=None):
+    raise ClientError(error(code, message), operation)
+
+def metadata(**kwargs):
+    return dict(kwargs, ResponseMetadata={'HTTPStatusCode': 200, 'RetryAttempts': 0})
+
+def tags_of(kwargs, resource_type):
+    for spec in kwargs.get('TagSpecifications', []):
+        if spec['ResourceType'] == resource_type:
+            return deepcopy(spec['Tags'])
+    return []
+
+def matches(resource, filters):
+    for f in filters or []:
+        name, values = f['Name'], f['Values']
+        if name.startswith('tag:'):
+            found = [t['Value'] for t in resource.get('Tags', []) if t['Key'] == name[4:]]
+        elif name == 'tag-key':
+            found = [t['Key'] for t in resource.get('Tags', [])]
+        elif name == 'attachment.vpc-id':
+            found = [a['VpcId'] for a in resource.get('Attachments', [])]
+        else:
+            found = resource.get(FILTER_FIELDS.get(name, name))
+            if isinstance(found, dict):
+                found = found.get('Name')
+            found = [found]
+        if not set(found) & set(values):
+            return False
+    return True
+
+def rules_of(permissions):
+    """
+    Returns IpPermissions as a dictionary of single-peer rule to peer entry, the unit
+    AWS authorizes and revokes in. Descriptions and owner ids do not tell rules apart.
+    """
+    rules = {}
+    for p in permissions:
+        ports = (None, None) if p['IpProtocol'] == '-1' else (p['FromPort'], p['ToPort'])
+        for field in PEER_FIELDS:
+            for peer in p.get(field, []):
+                name = tuple(sorted((k, v) for k, v in peer.items() \
+                    if k not in ('Description', 'UserId')))
+                rules[(p['IpProtocol'],) + ports + (field, name)] = peer
+    return rules
+
+def permissions_of(rules):
+    """Returns rules as IpPermissions grouped by protocol and ports, the way AWS does."""
+    permissions = {}
+    for (protocol, from_port, to_port, field, name), peer in rules.items():
+        p = permissions.setdefault((protocol, from_port, to_port), {'IpProtocol': protocol})
+        if protocol != '-1':
+            p['FromPort'], p['ToPort'] = from_port, to_port
+        peer = deepcopy(peer)
+        if field == 'UserIdGroupPairs':
+            peer['UserId'] = ACCOUNT_ID
+        p.setdefault(field, []).append(peer)
+    return list(permissions.values())
+
+class StubBackend(object):
+    """
+    StubBackend holds the resources of every stub client and counts their calls.
+
+    Methods:
+    latency_for - INTERNAL; returns the injected latency of an operation.
+    record - INTERNAL; counts a call and sleeps for its latency.
+    total_calls - USER; returns the number of calls made, optionally for one service.
+    reset_calls - USER; clears the call counts.
+    """
+
+    def __init__(self, latency=0.0, latencies=None, page_size=PAGE_SIZE):
+        self.latency = latency
+        self.latencies = dict(latencies or {})
+        self.page_size = page_size
+        self.calls = Counter()
+        self.lock = RLock()
+        self.ids = count(1)
+        self.vpcs, self.subnets, self.route_tables, self.igws = {}, {}, {}, {}
+        self.nat_gateways, self.addresses, self.security_groups = {}, {}, {}
+        self.reservations, self.key_pairs, self.launch_templates = [], {}, {}
+        self.roles, self.clusters = {}, {}
+        self.policies = [{'PolicyName': name, 'PolicyId': name,
+            'Arn': "arn:aws:iam::aws:policy/{}".format(name)} for name in (
+            'AmazonEKSClusterPolicy', 'AmazonEKSServicePolicy', 'AmazonEKSWorkerNodePolicy',
+            'AmazonEKS_CNI_Policy', 'AmazonEC2ContainerRegistryReadOnly')]
+
+    def new_id(self, prefix):
+        return "{}-{:08x}".format(prefix, next(self.ids))
+
+    def latency_for(self, api):
+        return self.latencies.get(api, self.latency)
+
+    def record(self, service, api):
+        with self.lock:
+            self.calls[(service, api)] += 1
+        delay = self.latency_for(api)
+        if delay:
+            sleep(delay)
+
+    def total_calls(self, service=None):
+        with self.lock:
+            return sum(n for (s, a), n in self.calls.items() if service in (None, s))
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+
+    def taggable(self):
+        for resources in (self.vpcs, self.subnets, self.route_tables, self.igws,
+                self.nat_gateways, self.addresses, self.security_groups):
+            yield from resources.items()
+        for r in self.reservations:
+            for i in r['Instances']:
+                yield i['InstanceId'], i
+
+class StubOperation(object):
+    """The parts of a botocore OperationModel that event handlers look at."""
+
+    def __init__(self, service, name):
+        self.name = name
+        self.service_model = StubServiceModel(service)
+
+class StubServiceModel(object):
+    def __init__(self, service):
+        self.service_name = service
+
+class StubHttpResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+class StubMeta(object):
+    def __init__(self, client):
+        self.service_model = StubServiceModel(client.service)
+        self.method_to_api_mapping = dict(client.operations)
+        self.events = HierarchicalEmitter()
+
+def operation(func):
+    """
+    Marks a stub client method as an API operation. Like botocore's _make_api_call, it
+    emits before-parameter-build, before-call (whose handlers may answer the call) and
+    after-call, and raises a ClientError for error responses.
+    """
+    api = ''.join(p.title() for p in func.__name__.split('_'))
+    @functools.wraps(func)
+    def call(self, **kwargs):
+        events = self.meta.events
+        model = StubOperation(self.service, api)
+        context = {}
+        events.emit("before-parameter-build.{}.{}".format(self.service, api),
+            params=kwargs, model=model, context=context)
+        handler, response = events.emit_until_response(
+            "before-call.{}.{}".format(self.service, api),
+            model=model, params=kwargs, request_signer=None, context=context)
+        if response is not None:
+            http, parsed = response
+        else:
+            self.backend.record(self.service, api)
+            try:
+                with self.backend.lock:
+                    http, parsed = StubHttpResponse(200), func(self, **kwargs)
+            except ClientError as e:
+                http, parsed = StubHttpResponse(400), e.response
+        events.emit("after-call.{}.{}".format(self.service, api),
+            http_response=http, parsed=parsed, model=model, context=context)
+        if http.status_code >= 300:
+            raise ClientError(parsed, api)
+        return parsed
+    call.api = api
+    return call
+
+class StubPaginator(object):
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        token = PAGINATED[self.operation]
+        method = getattr(self.client, self.operation)
+        while True:
+            page = method(**kwargs)
+            yield page
+            if not page.get(token if token == 'NextToken' else 'IsTruncated'):
+                return
+            kwargs = dict(kwargs, **{token: page[token]})
+
+class StubClient(object):
+    """Base of the stub clients, with the client methods that are not API operations."""
+
+    service = None
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.operations = [(n, getattr(type(self), n).api) for n in dir(type(self)) \
+            if hasattr(getattr(type(self), n), 'api')]
+        self.meta = StubMeta(self)
+
+    def can_paginate(self, operation):
+        return operation in PAGINATED
+
+    def get_paginator(self, operation):
+        return StubPaginator(self, operation)
+
+    def page(self, key, items, token=None, limit=None):
+        start = int(token or 0)
+        limit = limit or self.backend.page_size
+        res = metadata(**{key: deepcopy(items[start:start + limit])})
+        if start + limit < len(items):
+            if self.service == 'iam':
+                res['IsTruncated'] = True
+                res['Marker'] = str(start + limit)
+            else:
+                res['NextToken'] = str(start + limit)
+        elif self.service == 'iam':
+            res['IsTruncated'] = False
+        return res
+
+class StubEc2(StubClient):
+    service = 'ec2'
+
+    @operation
+    def describe_availability_zones(self, **kwargs):
+        return metadata(AvailabilityZones=[{'ZoneName': z, 'State': 'available'} \
+            for z in ZONES])
+
+    @operation
+    def create_vpc(self, CidrBlock, **kwargs):
+        vpc_id = self.backend.new_id('vpc')
+        self.backend.vpcs[vpc_id] = {'VpcId': vpc_id, 'CidrBlock': CidrBlock,
+            'State': 'available', 'Tags': tags_of(kwargs, 'vpc')}
+        return metadata(Vpc=deepcopy(self.backend.vpcs[vpc_id]))
+
+    @operation
+    def describe_vpcs(self, VpcIds=None, Filters=None, NextToken=None, MaxResults=None):
+        for vpc_id in VpcIds or []:
+            if vpc_id not in self.backend.vpcs:
+                fail('InvalidVpcID.NotFound', 'DescribeVpcs')
+        vpcs = [v for k, v in self.backend.vpcs.items() \
+            if (not VpcIds or k in VpcIds) and matches(v, Filters)]
+        return self.page('Vpcs', vpcs, NextToken, MaxResults)
+
+    @operation
+    def modify_vpc_attribute(self, VpcId, **kwargs):
+        return metadata()
+
+    @operation
+    def delete_vpc(self, VpcId):
+        b = self.backend
+        if [s for s in b.subnets.values() if s['VpcId'] == VpcId] \
+                or [g for g in b.security_groups.values() if g['VpcId'] == VpcId] \
+                or [i for i in b.igws.values() if i['Attachments'] \
+                    and i['Attachments'][0]['VpcId'] == VpcId]:
+            fail('DependencyViolation', 'DeleteVpc')
+        b.route_tables = dict((k, r) for k, r in b.route_tables.items() \
+            if r['VpcId'] != VpcId)
+        del(b.vpcs[VpcId])
+        return metadata()
+
+    @operation
+    def create_subnet(self, VpcId, CidrBlock, AvailabilityZone=None, **kwargs):
+        b = self.backend
+        if [s for s in b.subnets.values() if s['VpcId'] == VpcId \
+                and s['CidrBlock'] == CidrBlock]:
+            fail('InvalidSubnet.Conflict', 'CreateSubnet')
+        subnet_id = b.new_id('subnet')
+        b.subnets[subnet_id] = {'SubnetId': subnet_id, 'VpcId': VpcId,
+            'CidrBlock': CidrBlock, 'AvailabilityZone': AvailabilityZone or ZONES[0],
+            'State': 'available', 'MapPublicIpOnLaunch': False,
+            'Tags': tags_of(kwargs, 'subnet')}
+        return metadata(Subnet=deepcopy(b.subnets[subnet_id]))
+
+    @operation
+    def describe_subnets(self, Filters=None, SubnetIds=None, NextToken=None,
+            MaxResults=None):
+        subnets = [s for k, s in self.backend.subnets.items() \
+            if (not SubnetIds or k in SubnetIds) and matches(s, Filters)]
+        return self.page('Subnets', subnets, NextToken, MaxResults)
+
+    @operation
+    def modify_subnet_attribute(self, SubnetId, MapPublicIpOnLaunch=None, **kwargs):
+        if MapPublicIpOnLaunch is not None:
+            self.backend.subnets[SubnetId]['MapPublicIpOnLaunch'] = \
+                MapPublicIpOnLaunch['Value']
+        return metadata()
+
+    @operation
+    def delete_subnet(self, SubnetId):
+        b = self.backend
+        if SubnetId not in b.subnets:
+            fail('InvalidSubnetID.NotFound', 'DeleteSubnet')
+        if [n for n in b.nat_gateways.values() if n['SubnetId'] == SubnetId \
+                and n['State'] != 'deleted']:
+            fail('DependencyViolation', 'DeleteSubnet')
+        del(b.subnets[SubnetId])
+        return metadata()
+
+    @operation
+    def create_tags(self, Resources, Tags):
+        found = dict(self.backend.taggable())
+        for resource_id in Resources:
+            if resource_id not in found:
+                fail('InvalidID.NotFound', 'CreateTags')
+        keys = [t['Key'] for t in Tags]
+        for resource_id in Resources:
+            r = found[resource_id]
+            r['Tags'] = [t for t in r.get('Tags', []) if t['Key'] not in keys] \
+                + deepcopy(Tags)
+        return metadata()
+
+    @operation
+    def create_route_table(self, VpcId, **kwargs):
+        rt_id = self.backend.new_id('rtb')
+        self.backend.route_tables[rt_id] = {'RouteTableId': rt_id, 'VpcId': VpcId,
+            'Associations': [], 'Routes': [], 'Tags': tags_of(kwargs, 'route-table')}
+        return metadata(RouteTable=deepcopy(self.backend.route_tables[rt_id]))
+
+    @operation
+    def describe_route_tables(self, Filters=None, NextToken=None, MaxResults=None):
+        rts = [r for r in self.backend.route_tables.values() if matches(r, Filters)]
+        return self.page('RouteTables', rts, NextToken, MaxResults)
+
+    @operation
+    def associate_route_table(self, RouteTableId, SubnetId):
+        for rt in self.backend.route_tables.values():
+            if [a for a in rt['Associations'] if a['SubnetId'] == SubnetId]:
+                fail('Resource.AlreadyAssociated', 'AssociateRouteTable')
+        association_id = self.backend.new_id('rtbassoc')
+        self.backend.route_tables[RouteTableId]['Associations'].append({
+            'RouteTableAssociationId': association_id, 'RouteTableId': RouteTableId,
+            'SubnetId': SubnetId, 'Main': False})
+        return metadata(AssociationId=association_id)
+
+    @operation
+    def disassociate_route_table(self, AssociationId):
+        for rt in self.backend.route_tables.values():
+            rt['Associations'] = [a for a in rt['Associations'] \
+                if a['RouteTableAssociationId'] != AssociationId]
+        return metadata()
+
+    @operation
+    def delete_route_table(self, RouteTableId):
+        rt = self.backend.route_tables.get(RouteTableId)
+        if rt is None:
+            fail('InvalidRouteTableID.NotFound', 'DeleteRouteTable')
+        if rt['Associations']:
+            fail('DependencyViolation', 'DeleteRouteTable')
+        del(self.backend.route_tables[RouteTableId])
+        return metadata()
+
+    @operation
+    def create_route(self, RouteTableId, DestinationCidrBlock, **kwargs):
+        rt = self.backend.route_tables[RouteTableId]
+        if [r for r in rt['Routes'] if r['DestinationCidrBlock'] == DestinationCidrBlock]:
+            fail('RouteAlreadyExists', 'CreateRoute')
+        rt['Routes'].append(dict(kwargs, DestinationCidrBlock=DestinationCidrBlock))
+        return metadata(Return=True)
+
+    @operation
+    def replace_route(self, RouteTableId, DestinationCidrBlock, **kwargs):
+        rt = self.backend.route_tables[RouteTableId]
+        rt['Routes'] = [r for r in rt['Routes'] \
+            if r['DestinationCidrBlock'] != DestinationCidrBlock] \
+            + [dict(kwargs, DestinationCidrBlock=DestinationCidrBlock)]
+        return metadata()
+
+    @operation
+    def delete_route(self, RouteTableId, DestinationCidrBlock):
+        rt = self.backend.route_tables[RouteTableId]
+        rt['Routes'] = [r for r in rt['Routes'] \
+            if r['DestinationCidrBlock'] != DestinationCidrBlock]
+        return metadata()
+
+    @operation
+    def create_internet_gateway(self, **kwargs):
+        igw_id = self.backend.new_id('igw')
+        self.backend.igws[igw_id] = {'InternetGatewayId': igw_id, 'Attachments': [],
+            'Tags': tags_of(kwargs, 'internet-gateway')}
+        return metadata(InternetGateway=deepcopy(self.backend.igws[igw_id]))
+
+    @operation
+    def attach_internet_gateway(self, InternetGatewayId, VpcId):
+        self.backend.igws[InternetGatewayId]['Attachments'] = [
+            {'VpcId': VpcId, 'State': 'available'}]
+        return metadata()
+
+    @operation
+    def detach_internet_gateway(self, InternetGatewayId, VpcId):
+        self.backend.igws[InternetGatewayId]['Attachments'] = []
+        return metadata()
+
+    @operation
+    def delete_internet_gateway(self, InternetGatewayId):
+        if self.backend.igws[InternetGatewayId]['Attachments']:
+            fail('DependencyViolation', 'DeleteInternetGateway')
+        del(self.backend.igws[InternetGatewayId])
+        return metadata()
+
+    @operation
+    def describe_internet_gateways(self, Filters=None, NextToken=None, MaxResults=None):
+        igws = [i for i in self.backend.igws.values() if matches(i, Filters)]
+        return self.page('InternetGateways', igws, NextToken, MaxResults)
+
+    @operation
+    def allocate_address(self, Domain='vpc', **kwargs):
+        allocation_id = self.backend.new_id('eipalloc')
+        self.backend.addresses[allocation_id] = {'AllocationId': allocation_id,
+            'Domain': Domain, 'Tags': tags_of(kwargs, 'elastic-ip')}
+        return metadata(AllocationId=allocation_id, Domain=Domain)
+
+    @operation
+    def release_address(self, AllocationId):
+        del(self.backend.addresses[AllocationId])
+        return metadata()
+
+    @operation
+    def create_nat_gateway(self, AllocationId, SubnetId, **kwargs):
+        b = self.backend
+        ngw_id = b.new_id('nat')
+        b.nat_gateways[ngw_id] = {'NatGatewayId': ngw_id, 'SubnetId': SubnetId,
+            'VpcId': b.subnets[SubnetId]['VpcId'], 'State': 'available',
+            'NatGatewayAddresses': [{'AllocationId': AllocationId}],
+            'Tags': tags_of(kwargs, 'natgateway')}
+        return metadata(NatGateway=deepcopy(b.nat_gateways[ngw_id]))
+
+    @operation
+    def describe_nat_gateways(self, Filters=None, NatGatewayIds=None, NextToken=None,
+            MaxResults=None):
+        ngws = [n for k, n in self.backend.nat_gateways.items() \
+            if (not NatGatewayIds or k in NatGatewayIds) and matches(n, Filters)]
+        return self.page('NatGateways', ngws, NextToken, MaxResults)
+
+    @operation
+    def delete_nat_gateway(self, NatGatewayId):
+        self.backend.nat_gateways[NatGatewayId]['State'] = 'deleted'
+        return metadata(NatGatewayId=NatGatewayId)
+
+    @operation
+    def create_security_group(self, GroupName, Description, VpcId, **kwargs):
+        b = self.backend
+        if [g for g in b.security_groups.values() \
+                if g['GroupName'] == GroupName and g['VpcId'] == VpcId]:
+            fail('InvalidGroup.Duplicate', 'CreateSecurityGroup')
+        group_id = b.new_id('sg')
+        b.security_groups[group_id] = {'GroupId': group_id, 'GroupName': GroupName,
+            'Description': Description, 'VpcId': VpcId, 'IpPermissions': [],
+            'IpPermissionsEgress': [], 'Tags': tags_of(kwargs, 'security-group')}
+        return metadata(GroupId=group_id)
+
+    @operation
+    def describe_security_groups(self, Filters=None, GroupIds=None, NextToken=None,
+            MaxResults=None):
+        sgs = [g for k, g in self.backend.security_groups.items() \
+            if (not GroupIds or k in GroupIds) and matches(g, Filters)]
+        return self.page('SecurityGroups', sgs, NextToken, MaxResults)
+
+    @operation
+    def delete_security_group(self, GroupId):
+        b = self.backend
+        if GroupId not in b.security_groups:
+            fail('InvalidGroup.NotFound', 'DeleteSecurityGroup')
+        for g in b.security_groups.values():
+            for p in g['IpPermissions'] + g['IpPermissionsEgress']:
+                if g['GroupId'] != GroupId and [u for u in p.get('UserIdGroupPairs', []) \
+                        if u.get('GroupId') == GroupId]:
+                    fail('DependencyViolation', 'DeleteSecurityGroup')
+        del(b.security_groups[GroupId])
+        return metadata()
+
+    def permissions(self, GroupId, key, IpPermissions, add, api):
+        group = self.backend.security_groups.get(GroupId)
+        if group is None:
+            fail('InvalidGroup.NotFound', api)
+        stored, given = rules_of(group[key]), rules_of(IpPermissions)
+        for rule in given:
+            if add and rule in stored:
+                fail('InvalidPermission.Duplicate', api)
+            if not add and rule not in stored:
+                fail('InvalidPermission.NotFound', api)
+        if add:
+            stored.update(given)
+        else:
+            stored = dict((r, p) for r, p in stored.items() if r not in given)
+        group[key] = permissions_of(stored)
+        return metadata(Return=True)
+
+    @operation
+    def authorize_security_group_ingress(self, GroupId, IpPermissions):
+        return self.permissions(GroupId, 'IpPermissions', IpPermissions, True,
+            'AuthorizeSecurityGroupIngress')
+
+    @operation
+    def authorize_security_group_egress(self, GroupId, IpPermissions):
+        return self.permissions(GroupId, 'IpPermissionsEgress', IpPermissions, True,
+            'AuthorizeSecurityGroupEgress')
+
+    @operation
+    def revoke_security_group_ingress(self, GroupId, IpPermissions):
+        return self.permissions(GroupId, 'IpPermissions', IpPermissions, False,
+            'RevokeSecurityGroupIngress')
+
+    @operation
+    def revoke_security_group_egress(self, GroupId, IpPermissions):
+        return self.permissions(GroupId, 'IpPermissionsEgress', IpPermissions, False,
+            'RevokeSecurityGroupEgress')
+
+    @operation
+    def run_instances(self, MinCount, MaxCount, SubnetId, **kwargs):
+        b = self.backend
+        subnet = b.subnets[SubnetId]
+        instances = [{'InstanceId': b.new_id('i'), 'SubnetId': SubnetId,
+            'VpcId': subnet['VpcId'],
+            'Placement': {'AvailabilityZone': subnet['AvailabilityZone']},
+            'SecurityGroups': [{'GroupId': g} for g in kwargs.get('SecurityGroupIds', [])],
+            'State': {'Name': 'running'}, 'Tags': tags_of(kwargs, 'instance')} \
+            for n in range(MaxCount)]
+        b.reservations.append({'ReservationId': b.new_id('r'), 'Instances': instances})
+        return metadata(Instances=deepcopy(instances))
+
+    @operation
+    def describe_instances(self, Filters=None, InstanceIds=None, NextToken=None,
+            MaxResults=None):
+        reservations = []
+        for r in self.backend.reservations:
+            instances = [i for i in r['Instances'] if matches(i, Filters) \
+                and (not InstanceIds or i['InstanceId'] in InstanceIds)]
+            if instances:
+                reservations.append({'ReservationId': r['ReservationId'],
+                    'Instances': instances})
+        return self.page('Reservations', reservations, NextToken, MaxResults)
+
+    @operation
+    def terminate_instances(self, InstanceIds):
+        for r in self.backend.reservations:
+            for i in r['Instances']:
+                if i['InstanceId'] in InstanceIds:
+                    i['State'] = {'Name': 'terminated'}
+        return metadata(TerminatingInstances=[{'InstanceId': i,
+            'CurrentState': {'Name': 'shutting-down'}} for i in InstanceIds])
+
+    @operation
+    def create_key_pair(self, KeyName, **kwargs):
+        if KeyName in self.backend.key_pairs:
+            fail('InvalidKeyPair.Duplicate', 'CreateKeyPair')
+        self.backend.key_pairs[KeyName] = {'KeyName': KeyName}
+        return metadata(KeyName=KeyName, KeyMaterial='stub-key-material')
+
+    @operation
+    def delete_key_pair(self, KeyName):
+        self.backend.key_pairs.pop(KeyName, None)
+        return metadata()
+
+    @operation
+    def create_launch_template(self, LaunchTemplateName, LaunchTemplateData, **kwargs):
+        b = self.backend
+        if [t for t in b.launch_templates.values() \
+                if t['LaunchTemplateName'] == LaunchTemplateName]:
+            fail('InvalidLaunchTemplateName.AlreadyExistsException', 'CreateLaunchTemplate')
+        lt_id = b.new_id('lt')
+        b.launch_templates[lt_id] = {'LaunchTemplateId': lt_id,
+            'LaunchTemplateName': LaunchTemplateName, 'DefaultVersionNumber': 1,
+            'LatestVersionNumber': 1, 'Versions': [deepcopy(LaunchTemplateData)],
+            'Tags': tags_of(kwargs, 'launch-template')}
+        return metadata(LaunchTemplate=self.template(b.launch_templates[lt_id]))
+
+    def template(self, lt):
+        return dict((k, deepcopy(v)) for k, v in lt.items() if k != 'Versions')
+
+    def find_template(self, LaunchTemplateName=None, LaunchTemplateId=None):
+        for lt in self.backend.launch_templates.values():
+            if LaunchTemplateId in (None, lt['LaunchTemplateId']) \
+                    and LaunchTemplateName in (None, lt['LaunchTemplateName']):
+                return lt
+        fail('InvalidLaunchTemplateName.NotFoundException', 'DescribeLaunchTemplates')
+
+    @operation
+    def create_launch_template_version(self, LaunchTemplateName, LaunchTemplateData,
+            **kwargs):
+        lt = self.find_template(LaunchTemplateName)
+        lt['Versions'].append(deepcopy(LaunchTemplateData))
+        lt['LatestVersionNumber'] = len(lt['Versions'])
+        return metadata(LaunchTemplateVersion={'LaunchTemplateId': lt['LaunchTemplateId'],
+            'VersionNumber': lt['LatestVersionNumber'],
+            'LaunchTemplateData': deepcopy(LaunchTemplateData)})
+
+    @operation
+    def modify_launch_template(self, LaunchTemplateName, DefaultVersion, **kwargs):
+        lt = self.find_template(LaunchTemplateName)
+        lt['DefaultVersionNumber'] = int(DefaultVersion)
+        return metadata(LaunchTemplate=self.template(lt))
+
+    @operation
+    def describe_launch_templates(self, Filters=None, LaunchTemplateIds=None, NextToken=None,
+            MaxResults=None):
+        lts = [self.template(t) for k, t in self.backend.launch_templates.items() \
+            if (not LaunchTemplateIds or k in LaunchTemplateIds) and matches(t, Filters)]
+        return self.page('LaunchTemplates', lts, NextToken, MaxResults)
+
+    @operation
+    def describe_launch_template_versions(self, LaunchTemplateId, Versions=None, **kwargs):
+        lt = self.find_template(LaunchTemplateId=LaunchTemplateId)
+        return metadata(LaunchTemplateVersions=[{'LaunchTemplateId': LaunchTemplateId,
+            'VersionNumber': lt['LatestVersionNumber'],
+            'LaunchTemplateData': deepcopy(lt['Versions'][-1])}])
+
+    @operation
+    def delete_launch_template(self, LaunchTemplateId):
+        lt = self.find_template(LaunchTemplateId=LaunchTemplateId)
+        del(self.backend.launch_templates[LaunchTemplateId])
+        return metadata(LaunchTemplate=self.template(lt))
+
+class StubIam(StubClient):
+    service = 'iam'
+
+    def role(self, role):
+        return dict((k, deepcopy(v)) for k, v in role.items() if k != 'AttachedPolicies')
+
+    @operation
+    def list_roles(self, Marker=None, MaxItems=None, **kwargs):
+        roles = [self.role(r) for r in self.backend.roles.values()]
+        return self.page('Roles', roles, Marker, MaxItems)
+
+    @operation
+    def list_policies(self, Marker=None, MaxItems=None, **kwargs):
+        return self.page('Policies', self.backend.policies, Marker, MaxItems)
+
+    @operation
+    def create_role(self, RoleName, AssumeRolePolicyDocument, **kwargs):
+        if RoleName in self.backend.roles:
+            fail('EntityAlreadyExists', 'CreateRole')
+        self.backend.roles[RoleName] = {'RoleName': RoleName,
+            'RoleId': self.backend.new_id('role'),
+            'Arn': "arn:aws:iam::000000000000:role/{}".format(RoleName),
+            'AssumeRolePolicyDocument': AssumeRolePolicyDocument, 'AttachedPolicies': []}
+        return metadata(Role=self.role(self.backend.roles[RoleName]))
+
+    @operation
+    def get_role(self, RoleName):
+        if RoleName not in self.backend.roles:
+            fail('NoSuchEntity', 'GetRole')
+        return metadata(Role=self.role(self.backend.roles[RoleName]))
+
+    @operation
+    def delete_role(self, RoleName):
+        if RoleName not in self.backend.roles:
+            fail('NoSuchEntity', 'DeleteRole')
+        if self.backend.roles[RoleName]['AttachedPolicies']:
+            fail('DeleteConflict', 'DeleteRole')
+        del(self.backend.roles[RoleName])
+        return metadata()
+
+    @operation
+    def attach_role_policy(self, RoleName, PolicyArn):
+        attached = self.backend.roles[RoleName]['AttachedPolicies']
+        if PolicyArn not in attached:
+            attached.append(PolicyArn)
+        return metadata()
+
+    @operation
+    def detach_role_policy(self, RoleName, PolicyArn):
+        attached = self.backend.roles[RoleName]['AttachedPolicies']
+        if PolicyArn not in attached:
+            fail('NoSuchEntity', 'DetachRolePolicy')
+        attached.remove(PolicyArn)
+        return metadata()
+
+    @operation
+    def list_attached_role_policies(self, RoleName, Marker=None, MaxItems=None):
+        policies = [{'PolicyArn': a, 'PolicyName': a.split('/')[-1]} \
+            for a in self.backend.roles[RoleName]['AttachedPolicies']]
+        return self.page('AttachedPolicies', policies, Marker, MaxItems)
+
+class StubEks(StubClient):
+    service = 'eks'
+
+    @operation
+    def create_cluster(self, name, roleArn, resourcesVpcConfig, **kwargs):
+        if name in self.backend.clusters:
+            fail('ResourceInUseException', 'CreateCluster')
+        self.backend.clusters[name] = {'name': name, 'roleArn': roleArn,
+            'resourcesVpcConfig': deepcopy(resourcesVpcConfig), 'status': 'ACTIVE'}
+        return metadata(cluster=deepcopy(self.backend.clusters[name]))
+
+    @operation
+    def describe_cluster(self, name):
+        if name not in self.backend.clusters:
+            fail('ResourceNotFoundException', 'DescribeCluster')
+        return metadata(cluster=deepcopy(self.backend.clusters[name]))
+
+    @operation
+    def list_clusters(self, nextToken=None, maxResults=None):
+        return self.page('clusters', sorted(self.backend.clusters), nextToken, maxResults)
+
+    @operation
+    def delete_cluster(self, name):
+        if name not in self.backend.clusters:
+            fail('ResourceNotFoundException', 'DeleteCluster')
+        return metadata(cluster=deepcopy(self.backend.clusters.pop(name)))
+
+CLIENTS = {'ec2': StubEc2, 'iam': StubIam, 'eks': StubEks}
+
+class StubSession(object):
+    """Stands in for a botocore session, creating stub clients over one backend."""
+
+    def __init__(self, backend=None):
+        self.backend = backend or StubBackend()
+
+    def create_client(self, service_name, **kwargs):
+        return CLIENTS[service_name](self.backend)
@@ -0,0 +1,99 @@
+from random import random
+from threading import Lock
+import logging
+
+logger = logging.getLogger(__name__)
+
+TRACE_LEVEL=logging.DEBUG
+SAMPLE_RATE=1.0
+# Longest rendering of one traced field, and most list items shown before summarizing.
+MAX_CHARS=240
+MAX_ITEMS=3
+# The ResponseMetadata fields worth keeping; the HTTP headers are left out.
+META_FIELDS=('RequestId', 'HTTPStatusCode', 'RetryAttempts')
+
+_tracers = {}
+_tracers_lock = Lock()
+
+def get_tracer(name):
+    """Returns the Tracer of a module, sharing the module's logger."""
+    with _tracers_lock:
+        if name not in _tracers:
+            _tracers[name] = Tracer(logging.getLogger(name))
+        return _tracers[name]
+
+def configure(sample_rate=None, max_chars=None, prefix=''):
+    """
+    Sets the sample rate and field length of every tracer whose module name starts with
+    prefix, including tracers created later.
+    """
+    global SAMPLE_RATE, MAX_CHARS
+    if not prefix:
+        SAMPLE_RATE = SAMPLE_RATE if sample_rate is None else sample_rate
+        MAX_CHARS = MAX_CHARS if max_chars is None else max_chars
+    with _tracers_lock:
+        for name, tracer in _tracers.items():
+            if name.startswith(prefix):
+                tracer.sample_rate = tracer.sample_rate if sample_rate is None \
+                    else sample_rate
+                tracer.max_chars = tracer.max_chars if max_chars is None else max_chars
+
+def summarize(value, max_chars=MAX_CHARS, max_items=MAX_ITEMS):
+    """
+    Returns a short rendering of an API payload: ResponseMetadata is cut down to
+    META_FIELDS, long lists show their length and first items, and the result is
+    truncated to max_chars.
+    """
+    if isinstance(value, dict) and 'HTTPStatusCode' in value:
+        value = dict((k, value[k]) for k in META_FIELDS if k in value)
+    elif isinstance(value, dict) and 'ResponseMetadata' in value:
+        value = dict((k, v) for k, v in value.items() if k != 'ResponseMetadata')
+    if isinstance(value, (list, tuple)) and len(value) > max_items:
+        text = "<{} items> {}".format(len(value), list(value[:max_items]))
+    else:
+        text = str(value)
+    if len(text) > max_chars:
+        text = "{}...<{} chars>".format(text[:max_chars], len(text))
+    return text
+
+class TraceEvent(object):
+    """A traced event whose fields are only rendered if a handler formats the record."""
+    __slots__ = ('name', 'fields', 'max_chars')
+
+    def __init__(self, name, fields, max_chars):
+        self.name = name
+        self.fields = fields
+        self.max_chars = max_chars
+
+    def __str__(self):
+        return ' '.join([self.name] + ["{}={}".format(k, summarize(v, self.max_chars)) \
+            for k, v in self.fields.items()])
+
+class Tracer(object):
+    """
+    Tracer records structured events with their payloads, in place of formatting whole
+    API responses into log lines. When the module logger does not log TRACE_LEVEL, a call
+    costs one cached level check and nothing is rendered. Otherwise events are kept at
+    sample_rate and logged with their fields summarized, and the raw fields are attached
+    to the log record as trace_event and trace_fields for structured handlers.
+
+    Methods:
+    __call__ - USER; traces an event with keyword fields.
+    enabled - USER; tells whether events would be logged at all, to guard costly fields.
+    """
+
+    def __init__(self, logger, sample_rate=None, max_chars=None):
+        self.logger = logger
+        self.sample_rate = SAMPLE_RATE if sample_rate is None else sample_rate
+        self.max_chars = MAX_CHARS if max_chars is None else max_chars
+
+    def enabled(self):
+        return self.logger.isEnabledFor(TRACE_LEVEL)
+
+    def __call__(self, name, **fields):
+        if not self.logger.isEnabledFor(TRACE_LEVEL):
+            return
+        if self.sample_rate < 1.0 and random() >= self.sample_rate:
+            return
+        self.logger.log(TRACE_LEVEL, "%s", TraceEvent(name, fields, self.max_chars),
+            extra={'trace_event': name, 'trace_fields': fields})
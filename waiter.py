@@ -0,0 +1,162 @@
+from subfish.poll import DeadlineExceeded
+from concurrent.futures import Future
+from threading import Lock, Thread
+from time import monotonic, sleep
+import logging
+
+logger = logging.getLogger(__name__)
+
+BASE_DELAY=1
+MAX_DELAY=15
+TIMEOUT=600
+FILTER_LIMIT=200
+
+def _instances(res):
+    return [i for r in res['Reservations'] for i in r['Instances']]
+
+# Resource type -> (describe operation, id filter, result extractor, id field, state getter)
+RESOURCE_TYPES = {
+    'vpc': ('describe_vpcs', 'vpc-id', lambda res: res['Vpcs'], 'VpcId',
+        lambda r: r['State']),
+    'subnet': ('describe_subnets', 'subnet-id', lambda res: res['Subnets'], 'SubnetId',
+        lambda r: r['State']),
+    'nat_gateway': ('describe_nat_gateways', 'nat-gateway-id', lambda res: res['NatGateways'],
+        'NatGatewayId', lambda r: r['State']),
+    'instance': ('describe_instances', 'instance-id', _instances, 'InstanceId',
+        lambda r: r['State']['Name'])}
+
+# States from which a resource will never reach the target state.
+FAILURE_STATES = {
+    ('nat_gateway', 'available'): ('failed', 'deleting', 'deleted'),
+    ('instance', 'running'): ('shutting-down', 'terminated', 'stopping', 'stopped')}
+
+# Target states reached by resources that no longer show up at all.
+GONE_STATES=('deleted', 'terminated')
+
+class WaitFailed(Exception):
+    pass
+
+class WaitRequest(object):
+    __slots__ = ('rtype', 'ids', 'state', 'deadline', 'future', 'start', 'ticks')
+
+    def __init__(self, rtype, ids, state, timeout):
+        self.rtype = rtype
+        self.ids = set(ids)
+        self.state = state
+        self.start = monotonic()
+        self.deadline = self.start + timeout
+        self.future = Future()
+        self.ticks = 0
+
+class WaitMux(object):
+    """
+    WaitMux waits on many resources at once. Pending (resource type, ids, target state)
+    requests are polled from one background thread with a single filtered describe call
+    per resource type per tick, and each request resolves when all its resources reach
+    the target state.
+
+    Methods:
+    submit - USER; registers a wait and returns a Future of the resources by id.
+    wait - USER; registers a wait and blocks until it resolves.
+    """
+
+    def __init__(self, clients, poller, base=BASE_DELAY, cap=MAX_DELAY):
+        self.clients = clients
+        self.poller = poller
+        self.base = base
+        self.cap = cap
+        self.requests = []
+        self.thread = None
+        self.reset = False
+        self.lock = Lock()
+
+    def submit(self, rtype, ids, state, timeout=TIMEOUT):
+        logger.debug("submit::%s::%s::%s", rtype, ids, state)
+        if rtype not in RESOURCE_TYPES:
+            raise ValueError("Cannot wait on {}".format(rtype))
+        request = WaitRequest(rtype, ids, state, timeout)
+        if not request.ids:
+            request.future.set_result({})
+            return request.future
+        with self.lock:
+            self.requests.append(request)
+            self.reset = True
+            if self.thread is None:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return request.future
+
+    def wait(self, rtype, ids, state, timeout=TIMEOUT):
+        return self.submit(rtype, ids, state, timeout).result()
+
+    def run(self):
+        logger.debug("run::Executing")
+        while True:
+            with self.lock:
+                # New requests start polling at the base delay again.
+                if self.reset:
+                    delays = self.poller.delays(self.base, self.cap)
+                    self.reset = False
+            sleep(next(delays))
+            with self.lock:
+                requests = list(self.requests)
+            for rtype in set(r.rtype for r in requests):
+                pending = [r for r in requests if r.rtype == rtype]
+                try:
+                    found = self.describe(rtype, set().union(*(r.ids for r in pending)))
+                except Exception as e:
+                    logger.error("run::describe::%s::%s", rtype, e)
+                    found = None
+                for r in pending:
+                    self.check(r, found)
+            with self.lock:
+                self.requests = [r for r in self.requests if not r.future.done()]
+                if not self.requests:
+                    self.thread = None
+                    return
+
+    def describe(self, rtype, ids):
+        operation, id_filter, extract, id_field, get_state = RESOURCE_TYPES[rtype]
+        client = self.clients.get('ec2', cached=False)
+        found = {}
+        ids = sorted(ids)
+        for i in range(0, len(ids), FILTER_LIMIT):
+            filters = [{'Name': id_filter, 'Values': ids[i:i + FILTER_LIMIT]}]
+            if client.can_paginate(operation):
+                pages = client.get_paginator(operation).paginate(Filters=filters)
+            else:
+                pages = [getattr(client, operation)(Filters=filters)]
+            for res in pages:
+                for r in extract(res):
+                    found[r[id_field]] = r
+        logger.debug("describe::%s::%s of %s found", rtype, len(found), len(ids))
+        return found
+
+    def check(self, request, found):
+        request.ticks = request.ticks + 1
+        if found is not None:
+            get_state = RESOURCE_TYPES[request.rtype][4]
+            failed = FAILURE_STATES.get((request.rtype, request.state), ())
+            states = dict((i, get_state(found[i]) if i in found else None) \
+                for i in request.ids)
+            bad = [i for i, s in states.items() if s in failed]
+            if bad:
+                self.finish(request, exception=WaitFailed("{} {} reached {}".format(
+                    request.rtype, bad, [states[i] for i in bad])))
+                return
+            if all(s == request.state or s is None and request.state in GONE_STATES \
+                    for s in states.values()):
+                self.finish(request, result=dict((i, found.get(i)) for i in request.ids))
+                return
+        if monotonic() > request.deadline:
+            self.finish(request, exception=DeadlineExceeded(
+                "{} {} did not reach {}".format(request.rtype, sorted(request.ids),
+                    request.state)))
+
+    def finish(self, request, result=None, exception=None):
+        self.poller.record("wait_{}_{}".format(request.rtype, request.state),
+            request.start, request.ticks)
+        if exception is not None:
+            request.future.set_exception(exception)
+        else:
+            request.future.set_result(result)